@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""
+Saved classifier artifacts against the estimators they were saved from.
+"""
+##########################################################
+# Python Compatibility
+
+from __future__ import print_function, division, absolute_import
+from future import standard_library
+standard_library.install_aliases()
+
+##########################################################
+# Standard Library Imports
+
+import os
+
+##########################################################
+# Third Party Imports
+
+import numpy as np
+import pytest
+
+##########################################################
+# Local Imports
+
+from thickshake.augment.classifier.classifier import make_model, save_classifier, get_classifier
+
+##########################################################
+# Fixtures
+
+
+def make_faces(n_classes, n_faces=600, seed=0):
+    """Float32 embeddings around one centre per class, as stored by detect_faces."""
+    random_state = np.random.RandomState(seed)
+    centres = random_state.randn(n_classes, 128)
+    labels = random_state.randint(0, n_classes, n_faces)
+    features = (centres[labels] + random_state.randn(n_faces, 128) * 0.5).astype(np.float32)
+    return features, labels
+
+
+def make_queries(n_queries=2000, seed=1):
+    """Queries at several scales, so the largest saturate every one-vs-rest sigmoid."""
+    random_state = np.random.RandomState(seed)
+    scales = np.repeat([1, 10, 100, 1000], n_queries // 4)[:, np.newaxis]
+    return (random_state.randn(n_queries, 128) * scales).astype(np.float32)
+
+
+##########################################################
+# Tests
+
+
+@pytest.mark.parametrize("classifier_trainer, n_classes", [("sgd", 5), ("sgd", 2), ("ncm", 5)])
+def test_artifact_matches_estimator(tmp_path, classifier_trainer, n_classes):
+    features, labels = make_faces(n_classes)
+    model = make_model(classifier_trainer)
+    model.partial_fit(features, labels, classes=np.arange(n_classes))
+    classifier_file = str(tmp_path / "classifier.pkl")
+    save_classifier(model, ["person %d" % i for i in range(n_classes)], classifier_file)
+    assert not os.path.exists(classifier_file)
+
+    saved_model, class_names = get_classifier(classifier_file)
+    assert class_names == ["person %d" % i for i in range(n_classes)]
+    for queries in [features, make_queries()]:
+        expected = model.predict_proba(queries)
+        probabilities = saved_model.predict_proba(queries)
+        assert not np.isnan(probabilities).any()
+        np.testing.assert_allclose(probabilities, expected, rtol=1e-4, atol=1e-6)
+        np.testing.assert_array_equal(saved_model.predict(queries), model.predict(queries))
+
+
+##########################################################
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""
+Face clustering against a brute-force connected-components result.
+"""
+##########################################################
+# Python Compatibility
+
+from __future__ import print_function, division, absolute_import
+from future import standard_library
+standard_library.install_aliases()
+
+##########################################################
+# Third Party Imports
+
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+##########################################################
+# Local Imports
+
+from thickshake.augment.image.clustering import UnionFind, cluster_embeddings
+from thickshake.augment.image.similarity import FaceIndex, squared_distances
+
+##########################################################
+# Fixtures
+
+THRESHOLD = 0.6
+
+
+def make_index(ivf_min_size, n_clusters=6, per_cluster=100, seed=0):
+    """Tight, well separated clusters of 128-d embeddings in shuffled order."""
+    random_state = np.random.RandomState(seed)
+    centres = random_state.randn(n_clusters, 128) * 2
+    vectors = np.repeat(centres, per_cluster, axis=0) + random_state.randn(n_clusters * per_cluster, 128) * 0.02
+    vectors = vectors[random_state.permutation(len(vectors))].astype(np.float32)
+    index = FaceIndex(ivf_min_size=ivf_min_size)
+    index.add(["face_%d" % i for i in range(len(vectors))], vectors)
+    return index
+
+
+def brute_force_labels(vectors, threshold=THRESHOLD):
+    adjacency = csr_matrix(squared_distances(vectors, vectors) <= threshold ** 2)
+    return connected_components(adjacency, directed=False)[1]
+
+
+def same_partition(a, b):
+    pairs = set(zip(a, b))
+    return len(pairs) == len(set(a)) == len(set(b))
+
+
+##########################################################
+# Tests
+
+
+def test_union_find_merges_chains():
+    sets = UnionFind(6)
+    sets.union(np.array([0, 2, 4]), np.array([1, 3, 5]))
+    sets.union(np.array([1]), np.array([3]))
+    labels = sets.labels()
+    assert labels[0] == labels[1] == labels[2] == labels[3]
+    assert labels[4] == labels[5] != labels[0]
+
+
+@pytest.mark.parametrize("ivf_min_size", [100000, 100], ids=["exact", "ivf"])
+def test_cluster_embeddings_matches_connected_components(ivf_min_size):
+    index = make_index(ivf_min_size)
+    assert (index.centroids is None) == (ivf_min_size > len(index))
+    labels = cluster_embeddings(index, face_cluster_threshold=THRESHOLD)
+    expected = brute_force_labels(np.asarray(index.vectors))
+    assert len(set(labels)) == 6
+    assert same_partition(labels, expected)
+
+
+##########################################################
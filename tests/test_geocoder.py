@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""
+Geocoding against the local stand-in for the Mappify endpoint.
+"""
+##########################################################
+# Python Compatibility
+
+from __future__ import print_function, division, absolute_import
+from future import standard_library
+standard_library.install_aliases()
+
+##########################################################
+# Third Party Imports
+
+import pytest
+
+##########################################################
+# Local Imports
+
+from thickshake.augment.parser.geocoder import geocode_addresses, get_geocode_cache
+from thickshake.augment.parser.local_geocoder import start_local_geocoder
+
+##########################################################
+# Fixtures
+
+
+ADDRESSES = [
+    {"street_number": "12", "street_name": "Hay", "street_type": "Street", "suburb_name": "Perth"},
+    {"street_name": "Stirling", "street_type": "Highway", "suburb_name": "Claremont"},
+    {"street_number": "12", "street_name": "Hay", "street_type": "Street", "suburb_name": "Perth"},
+    {"street_name": "Nowhere", "street_type": "Road", "suburb_name": ""},
+]
+
+
+@pytest.fixture
+def local_geocoder():
+    server, api_url = start_local_geocoder()
+    yield server, api_url
+    server.shutdown()
+    server.server_close()
+
+
+##########################################################
+# Tests
+
+
+def test_geocode_addresses_uses_cache_on_rerun(local_geocoder, tmp_path):
+    server, api_url = local_geocoder
+    kwargs = {
+        "api_url": api_url,
+        "geocode_cache_file": str(tmp_path / "geocode_cache.sqlite"),
+        "geocode_rate_limit": 0,
+    }
+    first = geocode_addresses(ADDRESSES, **kwargs)
+    assert server.request_count == 3
+    assert [location["location_type"] for location in first] == ["geocoded", "geocoded", "geocoded", "parsed"]
+    assert first[0] == first[2]
+
+    cache = get_geocode_cache(kwargs["geocode_cache_file"])
+    hits = cache.hits
+    second = geocode_addresses(ADDRESSES, **kwargs)
+    assert server.request_count == 3
+    assert second == first
+    # One cached lookup per distinct address, including the address the service had no answer for.
+    assert cache.hits - hits == 3
+    found, response = cache.get({"streetAddress": "Nowhere Road", "suburb": "", "state": "WA"})
+    assert found and response is None
+
+
+##########################################################
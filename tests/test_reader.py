@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""
+Streaming MARC-in-JSON reader.
+"""
+##########################################################
+# Python Compatibility
+
+from __future__ import print_function, division, absolute_import
+from future import standard_library
+standard_library.install_aliases()
+
+##########################################################
+# Standard Library Imports
+
+import json
+
+##########################################################
+# Third Party Imports
+
+import pytest
+
+##########################################################
+# Local Imports
+
+from thickshake.interface import reader
+from thickshake.interface.reader import read_file
+
+##########################################################
+# Fixtures
+
+
+def make_record(i):
+    return {
+        "leader": "00000nam a2200000 a 4500",
+        "fields": [
+            {"001": "record-%d" % i},
+            {"245": {"ind1": "1", "ind2": "0", "subfields": [{"a": "Title %d" % i}]}},
+        ],
+    }
+
+
+def write_records(path, records):
+    path.write_text(u"[\n" + u",\n".join(records) + u"\n]\n")
+    return str(path)
+
+
+@pytest.fixture
+def small_reads(monkeypatch):
+    # Records then span several reads.
+    monkeypatch.setattr(reader, "JSON_READ_SIZE", 16)
+
+
+##########################################################
+# Tests
+
+
+def test_read_marc_json_streams_records(tmp_path, small_reads):
+    input_file = write_records(tmp_path / "records.json", [json.dumps(make_record(i)) for i in range(7)])
+    records = list(read_file(input_file))
+    assert [record["001"].value() for record in records] == ["record-%d" % i for i in range(7)]
+    assert records[3]["245"]["a"] == "Title 3"
+
+
+def test_read_marc_json_raises_on_malformed_record(tmp_path, small_reads):
+    records = [json.dumps(make_record(i)) for i in range(7)]
+    records[2] = records[2][:-5] + "}"
+    input_file = write_records(tmp_path / "records.json", records)
+    with pytest.raises(ValueError, match="Malformed JSON record"):
+        list(read_file(input_file))
+
+
+##########################################################
@@ -31,7 +31,7 @@ from thickshake.storage import Store, Database
 ##########################################################
 # Typing Configuration
 
-from typing import Text, List, Any, Union, Dict, Callable, AnyStr
+from typing import Text, List, Any, Union, Dict, Callable, Tuple, AnyStr
 Parser = Any
 FilePath = Text
 DirPath = Text
@@ -41,6 +41,8 @@ Series = Any
 ##########################################################
 # Constants
 
+PARSER_CHUNK_SIZE = env.int("PARSER_CHUNK_SIZE", default=1000)
+
 ##########################################################
 # Initializations
 
@@ -71,19 +73,35 @@ def process_wrapper(main_function, main_path, storage_map, output_map=None, depe
         logger.warning("Database not available.", exc_info=True)
 
 
-def apply_parser(input_table, input_columns, output_table, output_map, parser, sample=0, **kwargs):
-    # type: (AnyStr, List[AnyStr], AnyStr, Dict[AnyStr, AnyStr], Parser, int, **Any) -> None
+def run_parser(input_dataframe, input_columns, parser, batch_parser=None, **kwargs):
+    # type: (DataFrame, List[AnyStr], Parser, Parser, **Any) -> DataFrame
+    """Run a parser over a chunk of rows, calling it once per distinct input."""
+    if batch_parser is not None:
+        return batch_parser(input_dataframe[input_columns], **kwargs)
+    parsed = {} # type: Dict[Any, Dict[AnyStr, Any]]
+    index, output_records = [], []
+    for i, values in zip(input_dataframe.index, input_dataframe[input_columns].itertuples(index=False)):
+        key = tuple(values)
+        if key not in parsed:
+            input_values = key[0] if len(key) == 1 else list(key)
+            parsed[key] = parser(input_values, **kwargs)
+        if parsed[key]:
+            index.append(i)
+            output_records.append(parsed[key])
+    return pd.DataFrame.from_records(output_records, index=index)
+
+
+def apply_parser(input_table, input_columns, output_table, output_map, parser, batch_parser=None, sample=0, parser_chunk_size=PARSER_CHUNK_SIZE, **kwargs):
+    # type: (AnyStr, List[AnyStr], AnyStr, Dict[AnyStr, AnyStr], Parser, Parser, int, int, **Any) -> None
     database = Database(**dict(kwargs, force=False))
-    input_dataframe = database.load_columns(input_table, input_columns, **kwargs)
-    if sample != 0: input_dataframe = input_dataframe.sample(n=sample)
-    total = input_dataframe.shape[0] 
-    for i, row in tqdm(input_dataframe.iterrows(), total=total, desc="Parsing Records (%s)" % (parser.__name__)):
-        input_values = row[input_columns].values
-        if len(input_values) == 1: input_values = input_values[0]
-        output_values = parser(input_values, **kwargs)
-        if output_values:
-            output_series = pd.DataFrame(output_values, index=[i])
-            database.save_record(input_table, output_table, output_map, output_series, **kwargs)
+    total = database.count_records(input_table)
+    if sample: total = min(total, sample)
+    chunks = database.load_columns(input_table, input_columns, chunk_size=parser_chunk_size, sample=sample)
+    with tqdm(total=total, desc="Parsing Records (%s)" % (parser.__name__)) as progress:
+        for chunk in chunks:
+            output_dataframe = run_parser(chunk, input_columns, parser, batch_parser=batch_parser, **kwargs)
+            database.save_records(input_table, output_table, output_map, output_dataframe, **kwargs)
+            progress.update(chunk.shape[0])
 
 
 ##########################################################
@@ -123,6 +141,18 @@ def detect_faces(input_image_dir=None, **kwargs):
     )
 
 
+def cluster_faces(input_image_dir=None, **kwargs):
+    # type: (DirPath, **Any) -> None
+    from thickshake.augment.image.clustering import cluster_faces
+    process_wrapper(
+        main_function = cluster_faces,
+        main_path = "/faces/clusters",
+        dependencies = [detect_faces],
+        storage_map = {"clusters": "/faces/clusters"},
+        input_image_dir=input_image_dir, **kwargs
+    )
+
+
 def identify_faces(input_image_dir=None, **kwargs):
     # type: (DirPath, **Any) -> None
     from thickshake.augment.classifier.classifier import run_face_classifier
@@ -143,13 +173,40 @@ def identify_faces(input_image_dir=None, **kwargs):
     )
 
 
+def read_text(input_image_dir=None, **kwargs):
+    # type: (DirPath, **Any) -> None
+    from thickshake.augment.image.ocr import read_text_in_images
+    process_wrapper(
+        main_function = read_text_in_images,
+        main_path = "/ocr/ocr_text",
+        storage_map = {
+            "bounding_boxes": "/ocr/bounding_boxes",
+            "ocr_text": "/ocr/ocr_text",
+        },
+        input_image_dir=input_image_dir, **kwargs
+    )
+
+
+def search_faces(face_id=None, query_file=None, top_k=5, face_index_nprobe=None, rebuild=False, **kwargs):
+    # type: (AnyStr, FilePath, int, int, bool, **Any) -> List[List[Tuple[AnyStr, float]]]
+    """Find the stored faces nearest to a stored face or to embeddings saved in a .npy file."""
+    import numpy as np
+    from thickshake.augment.image.similarity import update_face_index
+    store = Store(**dict(kwargs, force=False))
+    index = update_face_index(rebuild=rebuild, **dict(kwargs, store_path=store.store_path))
+    if face_id is not None: queries = index.get_vector(face_id)
+    elif query_file is not None: queries = np.load(query_file)
+    else: raise ValueError("Either a face id or a query file is required.")
+    return index.search(queries, k=top_k, nprobe=face_index_nprobe)
+
+
 ##########################################################
 # Metadata Parsing
 
 
 def parse_locations(**kwargs):
     # type: (**Any) -> None
-    from thickshake.augment.parser.geocoder import extract_location
+    from thickshake.augment.parser.geocoder import extract_location, batch_extract_location
     apply_parser(
         input_table = "image",
         input_columns = ["image_note"],
@@ -169,6 +226,7 @@ def parse_locations(**kwargs):
             "location_type": "location_type"
         },
         parser = extract_location,
+        batch_parser = batch_extract_location,
         **kwargs
     )
 
@@ -193,7 +251,7 @@ def parse_links(**kwargs):
 
 def parse_sizes(**kwargs):
     # type: (**Any) -> None
-    from thickshake.augment.parser.links import extract_image_dimensions
+    from thickshake.augment.parser.links import extract_image_dimensions, batch_extract_image_dimensions
     apply_parser(
         input_table = "image",
         input_columns = ["image_url_raw"],
@@ -204,6 +262,7 @@ def parse_sizes(**kwargs):
             "image_width": "image_width"
         },
         parser = extract_image_dimensions,
+        batch_parser = batch_extract_image_dimensions,
         **kwargs
     )
 
@@ -211,6 +270,7 @@ def parse_sizes(**kwargs):
 def parse_dates(**kwargs):
     # type: (**Any) -> None
     from thickshake.augment.parser.dates import extract_date_from_title, combine_dates, split_dates
+    from thickshake.augment.parser.dates import batch_extract_date_from_title, batch_combine_dates, batch_split_dates
     apply_parser(
         input_table = "image",
         input_columns = ["image_note"],
@@ -220,6 +280,7 @@ def parse_dates(**kwargs):
             "date": "image_date_created"
         },
         parser = extract_date_from_title,
+        batch_parser = batch_extract_date_from_title,
         **kwargs
     )
     apply_parser(
@@ -231,6 +292,7 @@ def parse_dates(**kwargs):
             "date": "date_created_parsed"
         },
         parser = combine_dates,
+        batch_parser = batch_combine_dates,
         **kwargs
     )
     apply_parser(
@@ -243,6 +305,7 @@ def parse_dates(**kwargs):
             "end_date": "subject_end_date"
         },
         parser = split_dates,
+        batch_parser = batch_split_dates,
         **kwargs
     )
 
@@ -268,6 +331,7 @@ store:
         landmarks: <image_id, box_num, ...landmarks>
         embeddings: <image_id, box_num, ...embeddings>
         identities: <image_id, box_num, ...bb_anchors, subject_uuid>
+        clusters: <image_id, box_num, cluster_id, cluster_size>
     ocr:
         bounding_boxes: <image_id, box_num, ...bb_anchors>
         ocr_text: <image_id, box_num, ocr_text>
@@ -281,5 +345,6 @@ store:
 /faces/landmarks
 /faces/embeddings
 /faces/identities
+/faces/clusters
 /faces/counts
 """
\ No newline at end of file
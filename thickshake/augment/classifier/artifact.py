@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""
+Face classifier artifacts: weights as .npy files next to a JSON manifest.
+
+    face_classifier.model/
+        manifest.json    kind, class names, embedding size, training hash
+        weights.npy      (n_classes, embedding_size), in the estimator's dtype
+        bias.npy         (n_classes,)
+
+Arrays are memory-mapped on load, so a process reads only the pages it
+touches and processes on one machine share them through the page cache.
+Nothing in an artifact is executed on load, unlike a pickle.
+"""
+##########################################################
+# Python Compatibility
+
+from __future__ import print_function, division, absolute_import
+from builtins import open
+from future import standard_library
+standard_library.install_aliases()
+
+##########################################################
+# Standard Library Imports
+
+import hashlib
+import json
+import logging
+import os
+
+##########################################################
+# Third Party Imports
+
+import numpy as np
+from scipy.special import expit
+
+##########################################################
+# Local Imports
+
+##########################################################
+# Typing Configuration
+
+from typing import Text, List, Tuple, Dict, Optional, Any, AnyStr
+DirPath = Text
+FilePath = Text
+NPArray = Any
+Model = Any
+
+##########################################################
+# Constants
+
+ARTIFACT_FORMAT_VERSION = 1
+ARTIFACT_SUFFIX = ".model"
+MANIFEST_FILE = "manifest.json"
+
+##########################################################
+# Logging Configuration
+
+logger = logging.getLogger(__name__)
+_artifacts = {} # type: Dict[DirPath, Tuple[float, FaceModel]]
+
+##########################################################
+# Classes
+
+
+class FaceModel(object):
+    """Prediction-only linear face classifier rebuilt from an artifact.
+
+    kind "logistic" scores one-vs-rest logistic regressions and normalises
+    them as scikit-learn's SGDClassifier does; kind "nearest_mean" takes a
+    softmax over negative squared distances to the class means, as
+    NearestClassMeanClassifier does.
+    """
+
+    def __init__(self, manifest, arrays):
+        # type: (Dict[AnyStr, Any], Dict[AnyStr, NPArray]) -> None
+        self.manifest = manifest
+        self.kind = manifest["kind"]
+        self.class_names = manifest["class_names"]
+        self.classes_ = np.arange(len(self.class_names))
+        self.weights = arrays["weights"]
+        self.bias = arrays["bias"]
+
+
+    def decision_function(self, features):
+        # type: (NPArray) -> NPArray
+        # Promoted as scikit-learn promotes them: float32 weights score float32 features in float32.
+        return np.dot(np.asarray(features), self.weights.T) + self.bias
+
+
+    def predict_proba(self, features):
+        # type: (NPArray) -> NPArray
+        scores = self.decision_function(features)
+        if self.kind == "logistic":
+            if scores.shape[1] == 1:
+                positive = expit(scores[:, 0])
+                return np.column_stack([1 - positive, positive])
+            probabilities = expit(scores)
+            totals = probabilities.sum(axis=1)
+            # Rows where every sigmoid underflows are uniform, as in scikit-learn.
+            all_zero = totals == 0
+            probabilities[all_zero] = 1
+            totals[all_zero] = scores.shape[1]
+            return probabilities / totals[:, np.newaxis]
+        # For class means m, -|x - m|^2 / t = (2 x.m - |m|^2) / t - |x|^2 / t; the last term cancels in the softmax.
+        scores = scores - scores.max(axis=1)[:, np.newaxis]
+        probabilities = np.exp(scores)
+        return probabilities / probabilities.sum(axis=1)[:, np.newaxis]
+
+
+    def predict(self, features):
+        # type: (NPArray) -> NPArray
+        """Class with the highest raw score, which stays exact when probabilities saturate."""
+        scores = self.decision_function(features)
+        if scores.shape[1] == 1: return self.classes_[(scores[:, 0] > 0).astype(np.int64)]
+        return self.classes_[np.argmax(scores, axis=1)]
+
+
+##########################################################
+# Functions
+
+
+def get_artifact_dir(classifier_file):
+    # type: (FilePath) -> DirPath
+    return os.path.splitext(classifier_file)[0] + ARTIFACT_SUFFIX
+
+
+def hash_training_set(rows, labels, class_names):
+    # type: (NPArray, NPArray, List[AnyStr]) -> AnyStr
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(rows, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(labels, dtype=np.int64).tobytes())
+    digest.update(json.dumps(list(class_names)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_model_weights(model):
+    # type: (Model) -> Optional[Tuple[AnyStr, NPArray, NPArray]]
+    """Kind, weights and bias for models an artifact can represent exactly, otherwise None."""
+    model_type = type(model).__name__
+    if model_type == "NearestClassMeanClassifier":
+        means = model.sums / np.maximum(model.counts, 1)[:, np.newaxis]
+        bias = -(means ** 2).sum(axis=1)
+        bias[model.counts == 0] = -np.inf
+        return "nearest_mean", 2 * means / model.temperature, bias / model.temperature
+    if model_type == "SGDClassifier" and model.loss in ("log", "log_loss"):
+        return "logistic", model.coef_, model.intercept_
+    return None
+
+
+def can_save_artifact(model):
+    # type: (Model) -> bool
+    return get_model_weights(model) is not None
+
+
+def save_arrays(artifact_dir, arrays):
+    # type: (DirPath, Dict[AnyStr, NPArray]) -> None
+    for name, array in arrays.items():
+        # Replace rather than overwrite, so processes mapping the old files keep valid pages.
+        path = os.path.join(artifact_dir, "%s.npy" % name)
+        with open(path + ".tmp", "wb") as f:
+            np.save(f, array)
+        os.rename(path + ".tmp", path)
+
+
+def save_artifact(model, class_names, artifact_dir, training_hash=None):
+    # type: (Model, List[AnyStr], DirPath, Optional[AnyStr]) -> None
+    kind, weights, bias = get_model_weights(model)
+    if not os.path.exists(artifact_dir): os.makedirs(artifact_dir)
+    save_arrays(artifact_dir, {
+        "weights": np.ascontiguousarray(weights),
+        "bias": np.ascontiguousarray(bias, dtype=weights.dtype),
+    })
+    manifest = {
+        "format_version": ARTIFACT_FORMAT_VERSION,
+        "kind": kind,
+        "class_names": [str(class_name) for class_name in class_names],
+        "embedding_size": int(weights.shape[1]),
+        "training_hash": training_hash,
+    }
+    # The manifest is written last; its modification time marks a complete artifact.
+    manifest_path = os.path.join(artifact_dir, MANIFEST_FILE)
+    with open(manifest_path + ".tmp", "w") as f:
+        f.write(json.dumps(manifest, indent=2))
+    os.rename(manifest_path + ".tmp", manifest_path)
+    logger.info('Saved classifier artifact to "%s"' % artifact_dir)
+
+
+def load_artifact(artifact_dir, mmap_mode="r"):
+    # type: (DirPath, Optional[AnyStr]) -> FaceModel
+    """Load an artifact once per process, reloading it only if it has been saved again."""
+    manifest_path = os.path.join(artifact_dir, MANIFEST_FILE)
+    modified_time = os.path.getmtime(manifest_path)
+    cached = _artifacts.get(artifact_dir)
+    if cached is None or cached[0] != modified_time:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["format_version"] > ARTIFACT_FORMAT_VERSION:
+            raise ValueError("Classifier artifact %s has unsupported format version %s" % (artifact_dir, manifest["format_version"]))
+        arrays = {
+            name: np.load(os.path.join(artifact_dir, "%s.npy" % name), mmap_mode=mmap_mode)
+            for name in ["weights", "bias"]
+        }
+        _artifacts[artifact_dir] = cached = (modified_time, FaceModel(manifest, arrays))
+    return cached[1]
+
+
+##########################################################
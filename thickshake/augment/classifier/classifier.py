@@ -13,27 +13,38 @@ standard_library.install_aliases()
 ##########################################################
 # Standard Library Imports
 
+from collections import OrderedDict
 import logging
+from multiprocessing import Pool
 import os
 import pickle
+import shutil
 import sys
+import time
 
 ##########################################################
 # Third Party Imports
 
+from envparse import env
 import numpy as np
-import tensorflow as tf
+import pandas as pd
+from sklearn.linear_model import SGDClassifier
 from sklearn.svm import SVC
 
 ##########################################################
 # Local Imports
 
-from thickshake.augment.classifier.dataset import load_dataset, split_dataset, decompose
+from thickshake.augment.classifier.artifact import can_save_artifact, save_artifact, load_artifact, get_artifact_dir, hash_training_set
+from thickshake.augment.classifier.dataset import load_dataset, load_labelled_rows, iter_dataset_chunks, split_dataset
+from thickshake.storage import Store
+from thickshake.storage.store import FACE_STORE_INDEX, read_face_embeddings, split_face_id
 
 ##########################################################
 # Typing Configuration
 
-from typing import Text, List, Tuple, Dict, Any, AnyStr
+from typing import Text, List, Tuple, Dict, Optional, Callable, Any, AnyStr
+NPArray = Any
+Model = Any
 Features = Any
 Label = Any
 Dataset = Any
@@ -44,74 +55,288 @@ DataFrame = Any
 ##########################################################
 # Constants
 
+CLASSIFIER_FILE = env.str("CLASSIFIER_FILE", default="/home/app/data/output/classifier.pkl")
+FACE_CLASSIFIER_THRESHOLD = env.float("FACE_CLASSIFIER_THRESHOLD", default=0.5)
+FACE_CLASSIFIER_BATCH_SIZE = env.int("FACE_CLASSIFIER_BATCH_SIZE", default=10000)
+CLASSIFIER_TRAINER = env.str("CLASSIFIER_TRAINER", default="svc")
+CLASSIFIER_CHUNK_SIZE = env.int("CLASSIFIER_CHUNK_SIZE", default=10000)
+NUM_EPOCHS = env.int("NUM_EPOCHS", default=5)
+SGD_LOG_LOSS = "log_loss" if "log_loss" in SGDClassifier.loss_functions else "log" # renamed in scikit-learn 1.1
+FACE_BOXES_PATH = "/faces/bounding_boxes"
+FACE_BOX_COLUMNS = ["face_box_x", "face_box_y", "face_box_w", "face_box_h"]
+
 ##########################################################
 # Logging Configuration
 
 logger = logging.getLogger(__name__)
+_classifiers = {} # type: Dict[FilePath, Tuple[float, Model, List[AnyStr]]]
+
+##########################################################
+# Classes
+
+
+class NearestClassMeanClassifier(object):
+    """Predicts the class whose mean embedding is closest, trained incrementally from running sums.
+
+    Probabilities are a softmax over negative squared distances to the
+    class means, so a face far from every mean gets a flat, low-confidence
+    distribution.
+    """
+
+    def __init__(self, temperature=0.05):
+        # type: (float) -> None
+        self.temperature = temperature
+        self.classes_ = None # type: Optional[NPArray]
+        self.sums = None # type: Optional[NPArray]
+        self.counts = None # type: Optional[NPArray]
+
+
+    def partial_fit(self, features, labels, classes=None):
+        # type: (NPArray, NPArray, Optional[NPArray]) -> NearestClassMeanClassifier
+        if self.classes_ is None:
+            self.classes_ = np.asarray(classes)
+            self.sums = np.zeros((len(self.classes_), features.shape[1]), dtype=np.float64)
+            self.counts = np.zeros(len(self.classes_), dtype=np.int64)
+        label_indices = np.searchsorted(self.classes_, labels)
+        np.add.at(self.sums, label_indices, features)
+        self.counts += np.bincount(label_indices, minlength=len(self.classes_))
+        return self
+
+
+    def fit(self, features, labels):
+        # type: (NPArray, NPArray) -> NearestClassMeanClassifier
+        self.classes_ = None
+        return self.partial_fit(features, labels, classes=np.unique(labels))
+
+
+    def predict_proba(self, features):
+        # type: (NPArray) -> NPArray
+        means = self.sums / np.maximum(self.counts, 1)[:, np.newaxis]
+        distances = (features ** 2).sum(axis=1)[:, np.newaxis] - 2 * np.dot(features, means.T) + (means ** 2).sum(axis=1)
+        distances[:, self.counts == 0] = np.inf
+        scores = -(distances - distances.min(axis=1)[:, np.newaxis]) / self.temperature
+        probabilities = np.exp(scores)
+        return probabilities / probabilities.sum(axis=1)[:, np.newaxis]
+
+
+    def predict(self, features):
+        # type: (NPArray) -> NPArray
+        return self.classes_[np.argmax(self.predict_proba(features), axis=1)]
+
 
 ##########################################################
 # Functions
 
 
-def train_classifier(dataset, class_names, classifier_file):
-    # type: (Dataset, List[AnyStr], FilePath) -> None
-    features, labels = decompose(dataset)
-    logger.info('Training classifier on {} images'.format(len(labels)))
-    model = SVC(kernel='linear', probability=True, verbose=False)
-    model.fit(features, labels)
+def make_model(classifier_trainer=CLASSIFIER_TRAINER):
+    # type: (AnyStr) -> Model
+    if classifier_trainer == "svc": return SVC(kernel='linear', probability=True, verbose=False)
+    if classifier_trainer == "sgd": return SGDClassifier(loss=SGD_LOG_LOSS, alpha=1e-4)
+    if classifier_trainer == "ncm": return NearestClassMeanClassifier()
+    raise ValueError('Unknown classifier trainer "%s"' % classifier_trainer)
+
+
+def save_classifier(model, class_names, classifier_file, training_hash=None):
+    # type: (Model, List[AnyStr], FilePath, Optional[AnyStr]) -> None
+    """Save linear models as an array artifact beside classifier_file, and anything else as a pickle."""
+    artifact_dir = get_artifact_dir(classifier_file)
+    if can_save_artifact(model):
+        save_artifact(model, class_names, artifact_dir, training_hash)
+        if os.path.exists(classifier_file): os.remove(classifier_file)
+        return None
     with open(classifier_file, 'wb') as outfile:
         pickle.dump((model, class_names), outfile)
+    if os.path.exists(artifact_dir): shutil.rmtree(artifact_dir)
     logger.info('Saved classifier model to file "%s"' % classifier_file)
 
 
-def test_classifier(dataset, classifier_file):
-    # type: (Dataset, FilePath) -> None
-    features, labels = decompose(dataset)
+def train_classifier_incrementally(rows, labels, class_names, classifier_file, image_data_file=None, classifier_trainer="sgd", classifier_chunk_size=CLASSIFIER_CHUNK_SIZE, num_epochs=NUM_EPOCHS, **kwargs):
+    # type: (NPArray, NPArray, List[AnyStr], FilePath, FilePath, AnyStr, int, int, **Any) -> None
+    """Fit with partial_fit over chunks streamed from the embedding store, never holding every feature in memory."""
+    logger.info('Training %s classifier on %d images' % (classifier_trainer, len(labels)))
+    model = make_model(classifier_trainer)
+    classes = np.arange(len(class_names))
+    # Class means are exact after one pass; SGD needs several.
+    epochs = 1 if classifier_trainer == "ncm" else num_epochs
+    for epoch in range(epochs):
+        for features, chunk_labels in iter_dataset_chunks(image_data_file, rows, labels, classifier_chunk_size, shuffle=True):
+            model.partial_fit(features, chunk_labels, classes=classes)
+    save_classifier(model, class_names, classifier_file, hash_training_set(rows, labels, class_names))
+
+
+def train_classifier(features, labels, class_names, classifier_file):
+    # type: (NPArray, NPArray, List[AnyStr], FilePath) -> None
+    logger.info('Training classifier on {} images'.format(len(labels)))
+    model = make_model("svc")
+    model.fit(features, labels)
+    save_classifier(model, class_names, classifier_file)
+
+
+def test_classifier(features, labels, classifier_file):
+    # type: (NPArray, NPArray, FilePath) -> None
     logger.info('Evaluating classifier on {} images'.format(len(labels)))
+    model, class_names = get_classifier(classifier_file)
+    best_class_indices, best_class_probabilities = predict_batches(model, features)
+    # Columns of predict_proba follow model.classes_, which omits classes missing from the training split.
+    predicted_labels = model.classes_[best_class_indices]
+    for i in range(len(predicted_labels)):
+        logger.info('%4d  %s: %.3f' % (i, class_names[predicted_labels[i]], best_class_probabilities[i]))
+    accuracy = np.mean(np.equal(predicted_labels, labels))
+    logger.info('Accuracy: %.3f' % accuracy)
+
+
+def get_classifier(classifier_file=CLASSIFIER_FILE):
+    # type: (FilePath) -> Tuple[Model, List[AnyStr]]
+    """Load a classifier once per process, reloading it only if it has been saved again."""
+    artifact_dir = get_artifact_dir(classifier_file)
+    if os.path.isdir(artifact_dir):
+        model = load_artifact(artifact_dir)
+        return model, model.class_names
     if not os.path.exists(classifier_file):
         raise ValueError('Pickled classifier not found, have you trained first?')
-    with open(classifier_file, 'rb') as f:
-        model, class_names = pickle.load(f)
-        predictions = model.predict_proba(features, )
-        best_class_indices = np.argmax(predictions, axis=1)
-        best_class_probabilities = predictions[np.arange(len(best_class_indices)), best_class_indices]
-        for i in range(len(best_class_indices)):
-            logger.info('%4d  %s: %.3f' % (i, class_names[best_class_indices[i]], best_class_probabilities[i]))
-        accuracy = np.mean(np.equal(best_class_indices, labels))
-        logger.info('Accuracy: %.3f' % accuracy)
-
-
-def apply_constraints(df, label_key):
-    # type: (DataFrame, AnyStr) -> DataFrame
-    if label_key == "subject_name": 
-        df = df[df["subject_type"] != "Company"] # remove companies
-        df = df[~df['subject_relation'].AnyStr.contains("photo", na=False)] # remove photographers
-        df = df[~df['subject_name'].AnyStr.contains("photo", na=False)] # remove photographers
-    return df
-
-
-#TODO:
-def run_classifier(label_key, classifier_file, is_train=True, is_test=True, **kwargs):
-    # type: (AnyStr, FilePath, bool, bool, **Any) -> None
-    df = load_dataset(**kwargs)
-    df = apply_constraints(df, label_key)
-    X, y = df[df.columns.drop(label_key)], df[label_key]
-    class_names = list(set(y))
-    dataset_train, dataset_test = split_dataset(df, **kwargs)
-    if is_train: train_classifier(dataset_train, class_names, classifier_file)
-    if is_test: test_classifier(dataset_test, classifier_file)
-
-
-#TODO
-def run_face_classifier(**kwargs):
-    pass
+    modified_time = os.path.getmtime(classifier_file)
+    cached = _classifiers.get(classifier_file)
+    if cached is None or cached[0] != modified_time:
+        with open(classifier_file, 'rb') as f:
+            model, class_names = pickle.load(f)
+        _classifiers[classifier_file] = cached = (modified_time, model, class_names)
+    return cached[1], cached[2]
+
+
+def predict_batches(model, features, batch_size=FACE_CLASSIFIER_BATCH_SIZE):
+    # type: (Model, NPArray, int) -> Tuple[NPArray, NPArray]
+    """Best class index and its probability for every row, predicted batch_size rows at a time."""
+    best_class_indices = np.empty(len(features), dtype=np.int64)
+    best_class_probabilities = np.empty(len(features), dtype=np.float64)
+    for start in range(0, len(features), batch_size):
+        predictions = model.predict_proba(features[start:start + batch_size])
+        stop = start + len(predictions)
+        best_class_indices[start:stop] = np.argmax(predictions, axis=1)
+        best_class_probabilities[start:stop] = predictions[np.arange(len(predictions)), best_class_indices[start:stop]]
+    return best_class_indices, best_class_probabilities
+
+
+def get_face_boxes(store, boxes_path=FACE_BOXES_PATH):
+    # type: (Store, AnyStr) -> DataFrame
+    """Pivot the long-format bounding boxes to one row of x, y, w, h per face."""
+    df = store.get_dataframe(boxes_path)
+    boxes = df.set_index(FACE_STORE_INDEX + ["component"])["value"].unstack()
+    boxes.columns = FACE_BOX_COLUMNS
+    return boxes
+
+
+def run_classifier(label_key, classifier_file=CLASSIFIER_FILE, classifier_trainer=CLASSIFIER_TRAINER, is_train=True, is_test=True, **kwargs):
+    # type: (AnyStr, FilePath, AnyStr, bool, bool, **Any) -> None
+    if classifier_trainer == "svc":
+        features, labels = load_dataset(label_key=label_key, **kwargs)
+        class_names, label_indices = np.unique(labels, return_inverse=True)
+        features_train, features_test, labels_train, labels_test = split_dataset(features, label_indices, **kwargs)
+        if is_train: train_classifier(features_train, labels_train, list(class_names), classifier_file)
+        if is_test: test_classifier(features_test, labels_test, classifier_file)
+        return None
+    rows, labels = load_labelled_rows(label_key=label_key, **kwargs)
+    class_names, label_indices = np.unique(labels, return_inverse=True)
+    rows_train, rows_test, labels_train, labels_test = split_dataset(rows, label_indices, **kwargs)
+    order_train, order_test = np.argsort(rows_train), np.argsort(rows_test)
+    if is_train:
+        train_classifier_incrementally(
+            rows_train[order_train], labels_train[order_train], list(class_names),
+            classifier_file, classifier_trainer=classifier_trainer, **kwargs
+        )
+    if is_test:
+        chunks = list(iter_dataset_chunks(kwargs["image_data_file"], rows_test[order_test], labels_test[order_test]))
+        test_classifier(np.concatenate([f for f, _ in chunks]), np.concatenate([l for _, l in chunks]), classifier_file)
+
+
+def run_face_classifier(storage_map=None, classifier_file=CLASSIFIER_FILE, face_classifier_threshold=FACE_CLASSIFIER_THRESHOLD, face_classifier_batch_size=FACE_CLASSIFIER_BATCH_SIZE, **kwargs):
+    # type: (Dict[AnyStr, AnyStr], FilePath, float, int, **Any) -> None
+    """Label every stored face in one pass, keeping predictions at or above the confidence threshold."""
+    model, class_names = get_classifier(classifier_file)
+    store = Store(**kwargs)
+    face_ids, embeddings = read_face_embeddings(store.store_path)
+    face_ids = np.array(face_ids)
+    best_class_indices, best_class_probabilities = predict_batches(model, embeddings, face_classifier_batch_size)
+    confident = best_class_probabilities >= face_classifier_threshold
+    logger.info("Identified %d of %d faces with confidence >= %.2f.", confident.sum(), len(face_ids), face_classifier_threshold)
+    if not confident.any(): return None
+    image_ids, box_numbers = zip(*[split_face_id(face_id) for face_id in face_ids[confident]])
+    df = pd.DataFrame(OrderedDict([
+        ("image_id", image_ids),
+        ("box_number", box_numbers),
+        ("label", np.array(class_names, dtype=object)[model.classes_[best_class_indices[confident]]]),
+        ("confidence", best_class_probabilities[confident]),
+    ]))
+    df = df.join(get_face_boxes(store), on=FACE_STORE_INDEX)
+    store.save(storage_map["identities"], df, index=FACE_STORE_INDEX)
 
 
 ##########################################################
+# Main
+
+
+def get_peak_rss_mb():
+    # type: () -> Optional[float]
+    """This process's peak resident set size, which unlike tracemalloc includes libsvm's allocations."""
+    try: import resource
+    except ImportError: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak / 1e6 if sys.platform == "darwin" else peak / 1e3
+
+
+def make_benchmark_split(n_faces, n_classes, seed):
+    # type: (int, int, int) -> Tuple[NPArray, NPArray, NPArray, NPArray]
+    random_state = np.random.RandomState(seed)
+    centres = random_state.randn(n_classes, 128) * 0.07
+    labels = random_state.randint(0, n_classes, n_faces)
+    features = (centres[labels] + random_state.randn(n_faces, 128) * 0.18).astype(np.float32)
+    return split_dataset(features, labels, split_ratio=0.8, random_state=seed)
+
+
+def benchmark_trainer(name, n_faces, n_classes, chunk_size, num_epochs, seed):
+    # type: (AnyStr, int, int, int, int, int) -> Dict[AnyStr, Optional[float]]
+    """Fit and score one trainer; peak_mb is how far the fit raised the process's peak RSS."""
+    features_train, features_test, labels_train, labels_test = make_benchmark_split(n_faces, n_classes, seed)
+    random_state = np.random.RandomState(seed)
+    classes = np.arange(n_classes)
+    model = make_model(name)
+    rss_before = get_peak_rss_mb()
+    start_time = time.time()
+    if name == "svc": model.fit(features_train, labels_train)
+    else:
+        for epoch in range(num_epochs if name == "sgd" else 1):
+            for start in random_state.permutation(np.arange(0, len(labels_train), chunk_size)):
+                model.partial_fit(features_train[start:start + chunk_size], labels_train[start:start + chunk_size], classes=classes)
+    elapsed = time.time() - start_time
+    rss_after = get_peak_rss_mb()
+    best_class_indices, _ = predict_batches(model, features_test)
+    accuracy = np.mean(np.equal(model.classes_[best_class_indices], labels_test))
+    peak = rss_after - rss_before if rss_before is not None else None
+    return {"fit_seconds": elapsed, "peak_mb": peak, "accuracy": accuracy}
+
+
+def benchmark(n_faces=20000, n_classes=200, chunk_size=CLASSIFIER_CHUNK_SIZE, num_epochs=NUM_EPOCHS, seed=0):
+    # type: (int, int, int, int, int) -> Dict[AnyStr, Dict[AnyStr, Optional[float]]]
+    """Compare SVC with the incremental trainers on one split of synthetic embedding clusters.
+
+    Each trainer runs in a fresh process, so one trainer's peak RSS does
+    not hide another's.
+    """
+    results = {}
+    for name in ["svc", "sgd", "ncm"]:
+        pool = Pool(1)
+        try: results[name] = pool.apply(benchmark_trainer, (name, n_faces, n_classes, chunk_size, num_epochs, seed))
+        finally:
+            pool.close()
+            pool.join()
+    return results
 
 
 def main():
-    run_classifier()
+    results = benchmark()
+    for name, result in sorted(results.items()):
+        peak = "%.1f MB" % result["peak_mb"] if result["peak_mb"] is not None else "n/a"
+        print("%s: fit %.2fs, peak RSS +%s, accuracy %.3f" % (name, result["fit_seconds"], peak, result["accuracy"]))
 
 
 if __name__ == '__main__':
@@ -6,7 +6,7 @@
 # Python Compatibility
 
 from __future__ import print_function, division, absolute_import
-from builtins import zip, range
+from builtins import range
 from future import standard_library
 
 standard_library.install_aliases()
@@ -14,10 +14,9 @@ standard_library.install_aliases()
 ##########################################################
 # Standard Library Imports
 
+from collections import OrderedDict
 import json
 import logging
-import os
-import numbers
 import random
 
 ##########################################################
@@ -26,25 +25,20 @@ import random
 import h5py
 import numpy as np
 import pandas as pd
-import tensorflow as tf
-from tqdm import tqdm
 from sklearn.model_selection import train_test_split
 
 ##########################################################
 # Local Imports
 
-from thickshake.storage import Store
+from thickshake.storage.store import FACE_EMBEDDINGS_PATH, read_array, read_array_rows, split_face_id
 
 ##########################################################
 # Typing Configuration
 
-from typing import Text, List, Tuple, Dict, Any, AnyStr
-Features = Any
-Label = Any
-Dataset = Any
+from typing import Text, List, Tuple, Dict, Optional, Iterator, Any, AnyStr
 FilePath = Any
-DBConfig = Any
 DataFrame = Any
+NPArray = Any
 
 
 ##########################################################
@@ -56,118 +50,93 @@ logger = logging.getLogger(__name__)
 # Functions
 
 
-def decompose(dataset):
-    # type: (Dataset) -> Tuple[List[Features], List[Label]]
-    return zip(*[(record["features"], record["label"]) for record in dataset])
-
-
-def compose(features, labels):
-    # type: (List[Features], List[Label]) -> Dataset
-    return [{'features': fx, "label": lx} for fx, lx in zip(features, labels)]
-
-
-def filter_dataset(dataset, min_images_per_label=10):
-    # type: (Dataset, int) -> Dataset
-    counts = {} # type: Dict[AnyStr, int]
-    for record in dataset:
-        label = record["label"]
-        if label in counts: counts[label] = 0
-        else: counts[label] += 1
-    filter_dataset = {}
-    for record in dataset:
-        label = record["label"]
-        if counts[label] > min_images_per_label:
-            filter_dataset[label] = dataset[label]
-    return filter_dataset
-
-
-def split_dataset(dataset, split_ratio=0.8, **kwargs):
-    # type: (Dataset, float, **Any) -> Tuple[Dataset, Dataset]
-    X, y = decompose(dataset)
-    X_train, X_test, y_train, y_test = train_test_split(X, y, train_size=split_ratio, stratify=y)
-    dataset_train = compose(X_train, y_train)
-    dataset_test = compose(X_test, y_test)
-    return dataset_train, dataset_test
-
-
-def get_image_ids(image_data_file, sample_size=0, **kwargs):
-    # type: (FilePath, int, **Any) -> List[AnyStr]
-    with h5py.File(image_data_file, "r") as f:
-        face_ids = list(f["embeddings"].keys())
-        if sample_size != 0:
-             face_ids = random.sample(face_ids, sample_size)
-        image_ids = [("_").join(face_id.split("_")[0:-2]) for face_id in face_ids]
-        return image_ids
-
-
-#FIXME
-def get_face_columns(image_data_file):
-    # type: (FilePath) -> List[AnyStr]
-    with h5py.File(image_data_file, "r") as f:
-        embedding_size = 128 # f["embeddings"].attrs["size"]
-        face_columns = ["facial_feature_%s" % val for val in range(embedding_size)]
-        return face_columns
-
-#FIXME
-def get_metadata_columns(metadata_file):
-    # type: (FilePath) -> List[AnyStr]
-    with h5py.File(metadata_file, "r") as f:
-        metadata_columns = list(f.attrs["columns"])
-        return metadata_columns
-
-
-def get_face_embedddings(image_id, image_data_file, **kwargs):
-    # type: (AnyStr, FilePath, **Any) -> DataFrame
-    with h5py.File(image_data_file, "r") as f:
-        embedding_keys = f["embeddings"].keys()
-        embedding_keys_subset = [key for key in embedding_keys if key.startswith(image_id)]
-        embeddings = [f["embeddings"][key].value.tolist() for key in embedding_keys_subset]
-        embeddings = [x for emb  in embeddings for x in emb]
-        face_columns = get_face_columns(image_data_file)
-        df = pd.DataFrame(data=embeddings, columns=face_columns)
-        df["face_id"] = pd.Series(embedding_keys_subset, index=df.index)
-        df['image_id'] = pd.Series(image_id, index=df.index)
-        df.set_index("image_id", inplace=True)
-        return df
-
-
-def get_metadata(image_id, metadata_file, **kwargs):
-    # type: (AnyStr, FilePath, **Any) -> DataFrame
-    with h5py.File(metadata_file, "r") as f:
-        records = f.get(image_id, None)
-        metadata_columns = get_metadata_columns(metadata_file)
-        metadata = [json.loads(record.value[0]) for record in records.values()] if records else None
-        df = pd.DataFrame(data=metadata, columns=metadata_columns)
-        df.set_index("image_id", inplace=True)
-    return df
+def filter_dataset(rows, labels, min_images_per_label=10):
+    # type: (NPArray, NPArray, int) -> Tuple[NPArray, NPArray]
+    """Drop rows whose label has fewer than min_images_per_label faces."""
+    _, label_indices, counts = np.unique(labels, return_inverse=True, return_counts=True)
+    keep = counts[label_indices] >= min_images_per_label
+    return rows[keep], labels[keep]
+
 
+def split_dataset(features, labels, split_ratio=0.8, random_state=None, **kwargs):
+    # type: (NPArray, NPArray, float, Optional[int], **Any) -> Tuple[NPArray, NPArray, NPArray, NPArray]
+    return train_test_split(features, labels, train_size=split_ratio, stratify=labels, random_state=random_state)
 
-def merge_datasets(a, b):
-    # type: (DataFrame, DataFrame) -> DataFrame
-    dataset = pd.merge(a, b, left_index=True, right_index=True, how="outer")
-    return dataset
 
+def get_face_image_ids(face_ids):
+    # type: (List[AnyStr]) -> List[AnyStr]
+    return [split_face_id(face_id)[0] for face_id in face_ids]
 
-#FIXME:
-def get_records(image_id, metadata_file, image_data_file, **kwargs):
-    # type: (AnyStr, DBConfig, FilePath, **Any) -> DataFrame
-    faces = get_face_embedddings(image_id, image_data_file, **kwargs)
-    metadata = get_metadata(image_id, metadata_file, **kwargs)
-    dataset = merge_datasets(faces, metadata)
-    return dataset
+
+def load_metadata(metadata_file):
+    # type: (FilePath) -> DataFrame
+    """Every metadata record in one pass over the file."""
+    with h5py.File(metadata_file, "r") as f:
+        metadata_columns = list(f.attrs["columns"])
+        metadata = [json.loads(record[0]) for records in f.values() for record in records.values()]
+    return pd.DataFrame(data=metadata, columns=metadata_columns)
 
 
-#FIXME
-def load_dataset(metadata_file, image_data_file, **kwargs):
-    # type: (DBConfig, FilePath, **Any) -> DataFrame
-    image_ids = get_image_ids(image_data_file, **kwargs)
-    df = pd.DataFrame()
-    for image_id in tqdm(image_ids, desc="Loading Records"):
-        records = get_records(image_id, metadata_file, image_data_file, **kwargs)
-        df = pd.concat([df, records])
+def apply_constraints(df, label_key):
+    # type: (DataFrame, AnyStr) -> DataFrame
+    if label_key == "subject_name": 
+        df = df[df["subject_type"] != "Company"] # remove companies
+        df = df[~df['subject_relation'].str.contains("photo", na=False)] # remove photographers
+        df = df[~df['subject_name'].str.contains("photo", na=False)] # remove photographers
     return df
 
 
+def load_labelled_rows(metadata_file, image_data_file, label_key="subject_name", sample_size=0, min_images_per_label=0, embeddings_path=FACE_EMBEDDINGS_PATH, **kwargs):
+    # type: (FilePath, FilePath, AnyStr, int, int, AnyStr, **Any) -> Tuple[NPArray, NPArray]
+    """Embedding row and label of every face whose image has a label, hash-joining face ids to metadata on image_id."""
+    face_ids = [face_id.decode("utf-8") for face_id in read_array(image_data_file, embeddings_path + "/face_ids")]
+    rows = np.arange(len(face_ids))
+    if sample_size != 0:
+        rows = np.sort(random.sample(range(len(face_ids)), min(sample_size, len(face_ids))))
+    faces = pd.DataFrame(OrderedDict([
+        ("image_id", get_face_image_ids([face_ids[i] for i in rows])),
+        ("face_row", rows),
+    ]))
+    metadata = apply_constraints(load_metadata(metadata_file), label_key)
+    metadata = metadata.loc[metadata[label_key].notnull(), ["image_id", label_key]]
+    dataset = faces.merge(metadata, on="image_id", how="inner")
+    rows, labels = dataset["face_row"].values, np.asarray(dataset[label_key], dtype=object)
+    if min_images_per_label: rows, labels = filter_dataset(rows, labels, min_images_per_label)
+    logger.info("Found %d labelled faces among %d stored faces.", len(labels), len(face_ids))
+    return rows, labels
+
+
+def load_dataset(metadata_file, image_data_file, embeddings_path=FACE_EMBEDDINGS_PATH, **kwargs):
+    # type: (FilePath, FilePath, AnyStr, **Any) -> Tuple[NPArray, NPArray]
+    """Features and labels for every labelled face, reading each file once."""
+    rows, labels = load_labelled_rows(metadata_file, image_data_file, embeddings_path=embeddings_path, **kwargs)
+    embeddings = read_array(image_data_file, embeddings_path + "/vectors")
+    return np.ascontiguousarray(embeddings[rows]), labels
+
+
+def iter_dataset_chunks(image_data_file, rows, labels, chunk_size=10000, shuffle=False, embeddings_path=FACE_EMBEDDINGS_PATH):
+    # type: (FilePath, NPArray, NPArray, int, bool, AnyStr) -> Iterator[Tuple[NPArray, NPArray]]
+    """Stream features and labels for sorted embedding rows, one chunk at a time.
+
+    Without shuffle, each chunk is one contiguous slice of the store. With
+    shuffle, rows are dealt to chunks by a random permutation, because
+    faces are stored in image order and neighbouring rows share labels;
+    each chunk's rows are read in increasing order and returned shuffled.
+    """
+    if shuffle:
+        permutation = np.random.permutation(len(rows))
+        rows, labels = rows[permutation], labels[permutation]
+    for start in range(0, len(rows), chunk_size):
+        chunk_rows, chunk_labels = rows[start:start + chunk_size], labels[start:start + chunk_size]
+        if not shuffle:
+            block = read_array(image_data_file, embeddings_path + "/vectors", start=chunk_rows[0], stop=chunk_rows[-1] + 1)
+            yield block[chunk_rows - chunk_rows[0]], chunk_labels
+            continue
+        sorted_rows = np.sort(chunk_rows)
+        features = read_array_rows(image_data_file, embeddings_path + "/vectors", sorted_rows)
+        yield features[np.searchsorted(sorted_rows, chunk_rows)], chunk_labels
+
+
 ##########################################################
 # Main
 
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""
+"""
+##########################################################
+# Python Compatibility
+
+from __future__ import print_function, division, absolute_import
+from builtins import range
+from future import standard_library
+standard_library.install_aliases()
+
+##########################################################
+# Standard Library Imports
+
+from collections import OrderedDict
+import logging
+import time
+
+##########################################################
+# Third Party Imports
+
+from envparse import env
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+##########################################################
+# Local Imports
+
+from thickshake.storage import Store
+from thickshake.storage.store import FACE_STORE_INDEX, split_face_id
+from thickshake.augment.image.similarity import FACE_INDEX_NPROBE, update_face_index, squared_distances, top_k
+
+##########################################################
+# Typing Configuration
+
+from typing import Text, List, Any, Optional, Tuple, Iterator, Dict, AnyStr
+NPArray = Any
+DataFrame = Any
+Edges = Tuple[NPArray, NPArray]
+
+##########################################################
+# Constants
+
+FACE_CLUSTER_THRESHOLD = env.float("FACE_CLUSTER_THRESHOLD", default=0.6)
+FACE_CLUSTER_CHUNK_ROWS = env.int("FACE_CLUSTER_CHUNK_ROWS", default=2048)
+
+##########################################################
+# Logging Configuration
+
+logger = logging.getLogger(__name__)
+
+##########################################################
+# Classes
+
+
+class UnionFind(object):
+    """Disjoint sets over 0..n-1, merged a whole array of edges at a time."""
+
+    def __init__(self, n):
+        # type: (int) -> None
+        self.parent = np.arange(n, dtype=np.int64)
+
+
+    def find(self, nodes):
+        # type: (NPArray) -> NPArray
+        """Roots of nodes, compressing the paths walked."""
+        roots = self.parent[nodes]
+        while True:
+            grandparents = self.parent[roots]
+            if np.array_equal(grandparents, roots): break
+            roots = grandparents
+        self.parent[nodes] = roots
+        return roots
+
+
+    def union(self, a, b):
+        # type: (NPArray, NPArray) -> None
+        """Hook the larger root of each edge under the smaller until every edge lies within one set."""
+        while len(a):
+            root_a, root_b = self.find(a), self.find(b)
+            split = root_a != root_b
+            if not split.any(): break
+            a, b, root_a, root_b = a[split], b[split], root_a[split], root_b[split]
+            np.minimum.at(self.parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+
+
+    def labels(self):
+        # type: () -> NPArray
+        return self.find(np.arange(len(self.parent)))
+
+
+##########################################################
+# Functions
+
+
+def threshold_edges(queries, vectors, vector_norms, threshold, query_offset, vector_offset, upper=False):
+    # type: (NPArray, NPArray, NPArray, float, int, int, bool) -> Edges
+    rows, columns = np.nonzero(squared_distances(queries, vectors, vector_norms) <= threshold ** 2)
+    a, b = rows + query_offset, columns + vector_offset
+    if upper:
+        keep = a < b
+        a, b = a[keep], b[keep]
+    return a, b
+
+
+def iter_exact_edges(vectors, norms, threshold=FACE_CLUSTER_THRESHOLD, chunk_rows=FACE_CLUSTER_CHUNK_ROWS):
+    # type: (NPArray, NPArray, float, int) -> Iterator[Edges]
+    """Every pair within threshold, one chunk x chunk block of the upper triangle at a time."""
+    n = len(vectors)
+    for i in tqdm(range(0, n, chunk_rows), desc="Clustering Faces"):
+        queries = vectors[i:i + chunk_rows]
+        for j in range(i, n, chunk_rows):
+            yield threshold_edges(queries, vectors[j:j + chunk_rows], norms[j:j + chunk_rows], threshold, i, j, upper=(i == j))
+
+
+def probe_lists(vectors, centroids, nprobe, chunk_rows=FACE_CLUSTER_CHUNK_ROWS):
+    # type: (NPArray, NPArray, int, int) -> NPArray
+    probes = np.empty((len(vectors), min(nprobe, len(centroids))), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_rows):
+        chunk = vectors[start:start + chunk_rows]
+        probes[start:start + len(chunk)] = top_k(squared_distances(chunk, centroids), nprobe)
+    return probes
+
+
+def iter_ivf_edges(index, threshold=FACE_CLUSTER_THRESHOLD, nprobe=None, chunk_rows=FACE_CLUSTER_CHUNK_ROWS):
+    # type: (Any, float, Optional[int], int) -> Iterator[Edges]
+    """Pairs within threshold between each face and the faces in its nprobe nearest index lists.
+
+    Queries are grouped by the list they probe, so each distance block is
+    a gathered set of queries against one contiguous list.
+    """
+    if nprobe is None: nprobe = FACE_INDEX_NPROBE
+    offsets = index.get_offsets()
+    probes = probe_lists(index.vectors, index.centroids, nprobe)
+    by_list = np.argsort(probes, axis=None, kind="mergesort")
+    query_rows = by_list // probes.shape[1]
+    list_starts = np.searchsorted(probes.reshape(-1)[by_list], np.arange(len(index.centroids) + 1))
+    for j in tqdm(range(len(index.centroids)), desc="Clustering Faces"):
+        j_start, j_stop = offsets[j], offsets[j + 1]
+        if j_start == j_stop: continue
+        queries = query_rows[list_starts[j]:list_starts[j + 1]]
+        for q in range(0, len(queries), chunk_rows):
+            rows = queries[q:q + chunk_rows]
+            a, b = threshold_edges(
+                index.vectors[rows], index.vectors[j_start:j_stop], index.norms[j_start:j_stop],
+                threshold, 0, j_start
+            )
+            a = rows[a]
+            keep = a != b
+            yield a[keep], b[keep]
+
+
+def cluster_embeddings(index, face_cluster_threshold=FACE_CLUSTER_THRESHOLD, face_index_nprobe=None, **kwargs):
+    # type: (Any, float, Optional[int], **Any) -> NPArray
+    """Label faces joined by any chain of neighbours closer than the threshold with the same cluster."""
+    if index.centroids is None:
+        edges = iter_exact_edges(index.vectors, index.norms, face_cluster_threshold)
+    else: edges = iter_ivf_edges(index, face_cluster_threshold, face_index_nprobe)
+    sets = UnionFind(len(index))
+    n_edges = 0
+    for a, b in edges:
+        sets.union(a, b)
+        n_edges += len(a)
+    logger.info("Merged %d neighbouring face pairs.", n_edges)
+    return np.unique(sets.labels(), return_inverse=True)[1]
+
+
+def make_cluster_frame(face_ids, labels):
+    # type: (NPArray, NPArray) -> DataFrame
+    image_ids, box_numbers = zip(*[split_face_id(face_id) for face_id in face_ids])
+    return pd.DataFrame(OrderedDict([
+        ("image_id", image_ids),
+        ("box_number", box_numbers),
+        ("cluster_id", labels),
+        ("cluster_size", np.bincount(labels)[labels]),
+    ]))
+
+
+def cluster_faces(storage_map=None, force=False, **kwargs):
+    # type: (Dict[AnyStr, AnyStr], bool, **Any) -> None
+    """Cluster every stored face embedding and save a cluster id per face."""
+    store = Store(force=force, **kwargs)
+    index = update_face_index(**dict(kwargs, store_path=store.store_path, rebuild=force))
+    if len(index) == 0: return None
+    start_time = time.time()
+    labels = cluster_embeddings(index, **kwargs)
+    df = make_cluster_frame(index.face_ids, labels)
+    store.save(storage_map["clusters"], df, index=FACE_STORE_INDEX)
+    logger.info("Grouped %d faces into %d clusters in %.1fs.", len(labels), labels.max() + 1, time.time() - start_time)
+
+
+##########################################################
+# Main
+
+
+def main():
+    pass
+
+
+if __name__ == "__main__":
+    main()
+
+
+##########################################################
@@ -14,8 +14,13 @@ standard_library.install_aliases()
 ##########################################################
 # Standard Library Imports
 
+from collections import deque, namedtuple, OrderedDict
 import logging
+from multiprocessing import Pool
 import os
+import queue
+import threading
+import time
 
 ##########################################################
 # Third Party Imports
@@ -31,13 +36,14 @@ from tqdm import tqdm
 # Local Imports
 
 from thickshake.storage import Store
+from thickshake.storage.store import FACE_STORE_INDEX, split_face_id
 from thickshake.augment.image.utils import get_image, handle_image, rect_to_bb
 from thickshake.utils import get_files_in_directory, check_output_directory
 
 ##########################################################
 #Typing Configuration
 
-from typing import Text, List, Any, Optional, Tuple, Iterable, Dict, AnyStr
+from typing import Text, List, Any, Optional, Tuple, Iterable, Iterator, Dict, AnyStr
 
 FilePath = Text 
 DirPath = Text 
@@ -45,8 +51,11 @@ ImageType = Any
 Rectangle = Any
 Recognizer = Any
 Predictor = Any
+Detector = Any
+Shape = Any
 DataFrame = Any
 NPArray = Any
+FaceResult = namedtuple("FaceResult", ["face_id", "face_box", "landmarks", "embeddings"])
 
 ##########################################################
 # Constants
@@ -58,12 +67,113 @@ IMG_FACE_RECOGNIZER_FILE = env.str("IMG_FACE_RECOGNIZER_FILE", default="%s/dlib_
 IMG_FACE_TEMPLATE_FILE = env.str("IMG_FACE_TEMPLATE_FILE", default="%s/openface_68_face_template.npy" % DATA_DIR_PATH)
 KEY_INDICES = env.list("KEY_INDICES", default=[39, 42, 57], subcast=int) # INNER_EYES_AND_BOTTOM_LIP
 FACE_SIZE = env.int("FACE_SIZE", default=200)
+FACE_WRITE_BUFFER_SIZE = env.int("FACE_WRITE_BUFFER_SIZE", default=1000)
+FACE_ID_SIZE = 64
 
 ##########################################################
 # Initialization
 
 logger = logging.getLogger(__name__)
 
+_face_worker_kwargs = {} # type: Dict[AnyStr, Any]
+
+##########################################################
+# Classes
+
+
+class FaceModelRegistry(object):
+    """Loads each face model once per process, on first use, and records how long each load took."""
+
+    def __init__(self):
+        # type: () -> None
+        self.models = {} # type: Dict[Tuple[AnyStr, Optional[FilePath]], Any]
+        self.load_times = {} # type: Dict[Tuple[AnyStr, Optional[FilePath]], float]
+        self.lock = threading.Lock()
+
+
+    def get(self, name, path=None):
+        # type: (AnyStr, Optional[FilePath]) -> Any
+        key = (name, path)
+        model = self.models.get(key)
+        if model is None:
+            with self.lock:
+                model = self.models.get(key)
+                if model is None:
+                    start_time = time.time()
+                    model = MODEL_LOADERS[name](path)
+                    self.load_times[key] = time.time() - start_time
+                    self.models[key] = model
+                    logger.info("Loaded face %s in %.2fs.", name, self.load_times[key])
+        return model
+
+
+    def get_load_time(self):
+        # type: () -> float
+        return sum(self.load_times.values())
+
+
+class FaceWriter(object):
+    """Buffers face results in preallocated arrays and appends them to the Store in large flushes."""
+
+    def __init__(self, storage_map=None, face_write_buffer_size=FACE_WRITE_BUFFER_SIZE, **kwargs):
+        # type: (Dict[AnyStr, AnyStr], int, **Any) -> None
+        self.storage_map = storage_map
+        self.buffer_size = max(1, face_write_buffer_size)
+        self.store = Store(**kwargs)
+        self.boxes = np.zeros((self.buffer_size, 4), dtype=np.int64)
+        self.embeddings = np.zeros((self.buffer_size, 128), dtype=np.float32)
+        self.landmarks = None # type: Optional[NPArray]
+        self.image_ids = [] # type: List[AnyStr]
+        self.box_numbers = [] # type: List[AnyStr]
+        self.face_ids = [] # type: List[bytes]
+        self.count = 0
+
+
+    def add(self, face):
+        # type: (FaceResult) -> None
+        if self.count == self.buffer_size: self.flush()
+        if self.landmarks is None:
+            self.landmarks = np.zeros((self.buffer_size,) + face.landmarks.shape, dtype=np.float32)
+        i = self.count
+        self.boxes[i] = face.face_box
+        self.landmarks[i] = face.landmarks
+        self.embeddings[i] = face.embeddings.reshape(-1)
+        image_id, box_number = split_face_id(face.face_id)
+        self.image_ids.append(image_id)
+        self.box_numbers.append(box_number)
+        self.face_ids.append(face.face_id.encode("utf-8"))
+        self.count += 1
+
+
+    def add_many(self, faces):
+        # type: (Iterable[FaceResult]) -> None
+        for face in faces: self.add(face)
+
+
+    def flush(self):
+        # type: () -> None
+        """Write everything buffered with one open of the store file."""
+        n = self.count
+        if n == 0: return None
+        datasets = {
+            self.storage_map["landmarks"]: make_face_frame(self.landmarks[:n], ["point", "component"], self.image_ids, self.box_numbers),
+            self.storage_map["bounding_boxes"]: make_face_frame(self.boxes[:n], ["component"], self.image_ids, self.box_numbers),
+        }
+        self.store.save_many(datasets, index=FACE_STORE_INDEX)
+        embeddings_path = self.storage_map["embeddings"]
+        self.store.append_arrays({
+            embeddings_path + "/vectors": self.embeddings[:n],
+            embeddings_path + "/face_ids": np.array(self.face_ids, dtype="S%d" % FACE_ID_SIZE),
+        })
+        self.image_ids, self.box_numbers, self.face_ids = [], [], []
+        self.count = 0
+
+
+    def compact(self):
+        # type: () -> None
+        """Lay the embedding matrix out contiguously once all faces are written, so readers can map it."""
+        self.store.compact_array(self.storage_map["embeddings"] + "/vectors")
+
 ##########################################################
 # Functions
 
@@ -76,62 +186,62 @@ def prepare_template(face_template_file):
     return minmax_template
 
 
-def find_faces_in_image(image):
-    # type: (ImageType) -> List[Rectangle]
-    detector = dlib.get_frontal_face_detector()
-    faces = detector(image, 1)
-    return faces
+MODEL_LOADERS = {
+    "template": prepare_template,
+    "detector": lambda path: dlib.get_frontal_face_detector(),
+    "predictor": dlib.shape_predictor,
+    "recognizer": dlib.face_recognition_model_v1,
+}
+face_models = FaceModelRegistry()
 
 
-def split_face_id(face_id):
-    # type: (AnyStr) -> Tuple[AnyStr, AnyStr]
-    face_id_parts = face_id.split("_")
-    image_id = "_".join(face_id_parts[0:2])
-    box_number = face_id_parts[2]
-    return image_id, box_number
+def find_faces_in_image(image, detector=None):
+    # type: (ImageType, Optional[Detector]) -> List[Rectangle]
+    faces = get_detector(detector)(image, 1)
+    return faces
 
 
-def make_dataframe(array, value_name, index_names, face_id):
-    # type: (NPArray, AnyStr, List[AnyStr], AnyStr) -> DataFrame
-    index = pd.MultiIndex.from_product([range(s)for s in array.shape], names=index_names)
-    df = pd.Series(array.flatten(), index=index, name=value_name)
-    df = df.reset_index()
-    image_id, box_number = split_face_id(face_id)
-    df["image_id"] = image_id
-    df["box_number"] = box_number
-    return df
+def make_face_frame(arrays, index_names, image_ids, box_numbers, value_name="value"):
+    # type: (NPArray, List[AnyStr], List[AnyStr], List[AnyStr], AnyStr) -> DataFrame
+    """Flatten a stack of per-face arrays into the store's long format in one pass."""
+    n, shape = arrays.shape[0], arrays.shape[1:]
+    per_face = int(np.prod(shape))
+    grid = np.indices(shape).reshape(len(shape), -1)
+    columns = [(name, np.tile(component, n)) for name, component in zip(index_names, grid)]
+    columns.append((value_name, arrays.reshape(-1)))
+    columns.append(("image_id", np.repeat(np.array(image_ids, dtype=object), per_face)))
+    columns.append(("box_number", np.repeat(np.array(box_numbers, dtype=object), per_face)))
+    return pd.DataFrame(OrderedDict(columns))
 
 
-def save_face_dataset(face_id, array, storage_path=None, index_names=None, **kwargs):
-    # type: (AnyStr, NPArray, AnyStr, Optional[List[AnyStr]], **Any) -> None
-    if storage_path is None: return None
-    from thickshake.storage import Store
-    store = Store(**kwargs)
-    df = make_dataframe(array, value_name="value", index_names=index_names, face_id=face_id)
-    store.save(storage_path, df, index=["image_id", "box_number"], **kwargs)
+def predict_face_shapes(image, face_boxes, predictor=None, **kwargs):
+    # type: (ImageType, List[Rectangle], Predictor, **Any) -> List[Shape]
+    predictor = get_predictor(predictor)
+    return [predictor(image, face_box) for face_box in face_boxes]
 
 
-def extract_face_landmarks(image, face_box, face_id, predictor=None, storage_map=None, **kwargs):
-    # type: (ImageType, Rectangle, AnyStr, Predictor, Dict[AnyStr, AnyStr], **Any) -> List[Any]
-    points = predictor(image, face_box)
-    landmarks = list(map(lambda p: (p.x, p.y), points.parts()))
+def extract_face_landmarks(shape):
+    # type: (Shape) -> NPArray
+    landmarks = list(map(lambda p: (p.x, p.y), shape.parts()))
     landmarks_np = np.float32(landmarks)
-    save_face_dataset(face_id, landmarks_np, storage_path=storage_map["landmarks"], index_names=['point', 'component'], **kwargs)
     return landmarks_np
 
 
-def extract_face_embeddings(image, face_box, face_id, predictor=None, recognizer=None, storage_map=None, **kwargs):
-    # type: (ImageType, Rectangle, AnyStr, Predictor, Recognizer, Dict[AnyStr, AnyStr], **Any) -> List[float]
-    points = predictor(image, face_box)
-    embeddings = recognizer.compute_face_descriptor(image, points)
-    embeddings_np = np.float32(embeddings)[np.newaxis, :]
-    save_face_dataset(face_id, embeddings_np, storage_path=storage_map["embeddings"], index_names=['point', 'component'], **kwargs)
-    return embeddings_np
+def extract_face_embeddings(image, shapes, recognizer=None, **kwargs):
+    # type: (ImageType, List[Shape], Recognizer, **Any) -> NPArray
+    """Compute descriptors for every face in an image in one call; returns an (n, 128) array."""
+    if not shapes: return np.zeros((0, 128), dtype=np.float32)
+    recognizer = get_recognizer(recognizer)
+    detections = dlib.full_object_detections()
+    for shape in shapes: detections.append(shape)
+    embeddings = recognizer.compute_face_descriptor(image, detections)
+    return np.float32([np.float32(embedding) for embedding in embeddings])
 
 
 def normalize_face(image, landmarks, face_id, image_file, template=None, key_indices=KEY_INDICES, face_size=FACE_SIZE, **kwargs):
     # type: (ImageType, List[Any], AnyStr, FilePath, List[float], List[int], int, **Any) -> ImageType
     key_indices_np = np.array(key_indices)
+    template = get_template(template)
     H = cv2.getAffineTransform(landmarks[key_indices_np], face_size * template[key_indices_np])
     image_face = cv2.warpAffine(image, H, (face_size, face_size))
     handle_image(image_face, input_file=image_file, sub_folder="faces", **kwargs)
@@ -150,25 +260,32 @@ def annotate_image(image, face_box, face_id, landmarks, **kwargs):
 
 def get_template(template=None, template_path=IMG_FACE_TEMPLATE_FILE, **kwargs):
     # type: (Optional[List[int]], FilePath, **Any) -> List[int]
-    return prepare_template(template_path) if template is None else template
+    return face_models.get("template", template_path) if template is None else template
+
+
+def get_detector(detector=None, **kwargs):
+    # type: (Optional[Detector], **Any) -> Detector
+    return face_models.get("detector") if detector is None else detector
 
 
 def get_predictor(predictor=None, predictor_path=IMG_FACE_PREDICTOR_FILE, **kwargs):
     # type: (Optional[Predictor], FilePath, **Any) -> Predictor
-    return dlib.shape_predictor(predictor_path) if predictor is None else predictor
+    return face_models.get("predictor", predictor_path) if predictor is None else predictor
 
 
 def get_recognizer(recognizer=None, recognizer_path=IMG_FACE_RECOGNIZER_FILE, **kwargs):
     # type: (Optional[Recognizer], FilePath, **Any) -> Recognizer
-    return dlib.face_recognition_model_v1(recognizer_path) if recognizer is None else recognizer
+    return face_models.get("recognizer", recognizer_path) if recognizer is None else recognizer
 
 
 def get_dependencies(**kwargs):
-    # type: (**Any) -> Tuple[List[int], Predictor, Recognizer]
-    template = get_template(**kwargs)
-    predictor = get_predictor(**kwargs)
-    recognizer = get_recognizer(**kwargs)
-    return template, predictor, recognizer
+    # type: (**Any) -> Dict[AnyStr, Any]
+    return {
+        "template": get_template(**kwargs),
+        "detector": get_detector(**kwargs),
+        "predictor": get_predictor(**kwargs),
+        "recognizer": get_recognizer(**kwargs),
+    }
 
 
 def generate_face_id(image_file, face_number, **kwargs):
@@ -180,44 +297,96 @@ def generate_face_id(image_file, face_number, **kwargs):
     return face_id
 
 
-def save_face_box(face_id, face_box, storage_map=None, **kwargs):
-    # type: (AnyStr, int, Optional[Dict[AnyStr, AnyStr]], **Any) -> None
-    face_box = np.array(rect_to_bb(face_box))
-    save_face_dataset(face_id, face_box, storage_path=storage_map["bounding_boxes"], index_names=['component'], **kwargs)
-
-
-def extract_faces_from_image(image_file, **kwargs):
-    # type: (FilePath, **Any) -> ImageType
-    image = get_image(image_file)
+def extract_faces_from_image(image_file, image=None, detector=None, **kwargs):
+    # type: (FilePath, Optional[ImageType], Optional[Detector], **Any) -> List[FaceResult]
+    if image is None: image = get_image(image_file)
     image_annotated = image.copy()
-    faces = find_faces_in_image(image)
-    for face_number, face_box in enumerate(faces):
+    face_boxes = list(find_faces_in_image(image, detector=detector))
+    shapes = predict_face_shapes(image, face_boxes, **kwargs)
+    embeddings = extract_face_embeddings(image, shapes, **kwargs)
+    faces = []
+    for face_number, (face_box, shape) in enumerate(zip(face_boxes, shapes)):
         face_id = generate_face_id(image_file, face_number, **kwargs)
-        landmarks = extract_face_landmarks(image, face_box, face_id, **kwargs)
+        landmarks = extract_face_landmarks(shape)
         image_face = normalize_face(image, landmarks, face_id, image_file, **kwargs)
-        embeddings = extract_face_embeddings(image, face_box, face_id, **kwargs)
-        save_face_box(face_id, face_box, **kwargs)
-        image_annotated = annotate_image(image_annotated, face_box, face_id, landmarks, **kwargs) 
+        faces.append(FaceResult(face_id, rect_to_bb(face_box), landmarks, embeddings[face_number][np.newaxis, :]))
+        image_annotated = annotate_image(image_annotated, face_box, face_id, landmarks, **kwargs)
     handle_image(image_annotated, input_file=image_file, sub_folder="faces_annotated", **kwargs)
-    return image_annotated
+    return faces
 
 
-#TODO: Make asynchronous, see https://hackernoon.com/building-a-facial-recognition-pipeline-with-deep-learning-in-tensorflow-66e7645015b8
-def extract_faces_from_images(input_image_dir=None, output_image_dir=None, **kwargs):
-    # type: (DirPath, DirPath, **Any) -> None
+def iter_images(image_files, queue_size=2):
+    # type: (List[FilePath], int) -> Iterator[Tuple[FilePath, ImageType]]
+    """Decode and enhance images on a background thread, staying at most queue_size images ahead."""
+    images = queue.Queue(maxsize=queue_size) # type: queue.Queue
+    def read_images():
+        for image_file in image_files:
+            try: images.put((image_file, get_image(image_file)))
+            except Exception: logger.warning("Image %s could not be read.", image_file)
+        images.put(None)
+    reader = threading.Thread(target=read_images)
+    reader.daemon = True
+    reader.start()
+    while True:
+        item = images.get()
+        if item is None: return
+        yield item
+
+
+def _init_face_worker(kwargs):
+    # type: (Dict[AnyStr, Any]) -> None
+    global _face_worker_kwargs
+    _face_worker_kwargs = dict(kwargs, **get_dependencies(**kwargs))
+
+
+def _extract_faces_in_worker(image_file, image):
+    # type: (FilePath, ImageType) -> List[FaceResult]
+    return extract_faces_from_image(image_file, image=image, **_face_worker_kwargs)
+
+
+def iter_serial_faces(image_files, **kwargs):
+    # type: (List[FilePath], **Any) -> Iterator[List[FaceResult]]
+    kwargs = dict(kwargs, **get_dependencies(**kwargs))
+    for image_file, image in iter_images(image_files):
+        yield extract_faces_from_image(image_file, image=image, **kwargs)
+
+
+def iter_parallel_faces(image_files, workers=2, **kwargs):
+    # type: (List[FilePath], int, **Any) -> Iterator[List[FaceResult]]
+    """Detect faces across a process pool, each worker loading the dlib models once; at most two images in flight per worker."""
+    pool = Pool(workers, initializer=_init_face_worker, initargs=(kwargs,))
+    try:
+        in_flight = deque() # type: deque
+        for image_file, image in iter_images(image_files, queue_size=workers * 2):
+            in_flight.append(pool.apply_async(_extract_faces_in_worker, (image_file, image)))
+            if len(in_flight) >= workers * 2:
+                yield in_flight.popleft().get()
+        while in_flight:
+            yield in_flight.popleft().get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def extract_faces_from_images(input_image_dir=None, output_image_dir=None, workers=1, **kwargs):
+    # type: (DirPath, DirPath, int, **Any) -> None
+    """Read images on a thread, detect faces in one or more processes, and write every result from this process."""
     image_files = get_files_in_directory(input_image_dir, **kwargs)
     check_output_directory(output_image_dir, **kwargs)
-    template, predictor, recognizer = get_dependencies(**kwargs)
-    for image_file in tqdm(image_files, desc="Extracting Faces"):
-        image_annotated = extract_faces_from_image(
-            image_file,
-            input_image_dir=input_image_dir,
-            output_image_dir=output_image_dir,
-            template=template,
-            predictor=predictor,
-            recognizer=recognizer,
-            **kwargs
-        )
+    kwargs = dict(kwargs, input_image_dir=input_image_dir, output_image_dir=output_image_dir)
+    if workers is not None and workers > 1:
+        results = iter_parallel_faces(image_files, workers, **kwargs)
+    else: results = iter_serial_faces(image_files, **kwargs)
+    writer = FaceWriter(**kwargs)
+    start_time = time.time()
+    try:
+        for faces in tqdm(results, total=len(image_files), desc="Extracting Faces"):
+            writer.add_many(faces)
+    finally: writer.flush()
+    writer.compact()
+    elapsed = time.time() - start_time
+    logger.info("Extracted faces from %d images in %.1fs (model loading in this process: %.2fs).", len(image_files), elapsed, face_models.get_load_time())
 
 ##########################################################
 # Main
@@ -6,16 +6,21 @@
 # Python Compatibility
 
 from __future__ import print_function, division, absolute_import
-from builtins import range, open, map
+from builtins import range, open, map, str
 from future import standard_library
 standard_library.install_aliases()
 
 ##########################################################
 # Standard Library Imports
 
+from collections import OrderedDict
+import hashlib
 import logging
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 import os
 from functools import partial
+import threading
 
 ##########################################################
 # Third Party Imports
@@ -25,21 +30,28 @@ from envparse import env
 import hyperopt
 from PIL import Image
 import numpy as np
+import pandas as pd
 import pyocr
+from tqdm import tqdm
 
 ##########################################################
 # Local Imports
 
 from thickshake.augment.image.utils import crop
 from thickshake.storage import Store
+from thickshake.utils import get_files_in_directory
 
 ##########################################################
 # Typing Configuration
 
-from typing import Text, Any, Set, List, Dict, AnyStr
+from typing import Text, Any, Set, List, Dict, Optional, Tuple, AnyStr
 FilePath = Text
 ImageType = Any
 Rectangle = Any
+NPArray = Any
+DataFrame = Any
+TextCache = Dict[Tuple[Any, AnyStr], AnyStr]
+DirPath = Text
 
 ##########################################################
 # Constants
@@ -51,10 +63,17 @@ CLASSIFIER_NM1_PATH = env.str("CLASSIFIER_NM1_PATH", default="%s/trained_classif
 CLASSIFIER_NM2_PATH = env.str("CLASSIFIER_NM2_PATH", default="%s/trained_classifierNM2.xml" % DATA_DIR_PATH)
 CLASSIFIER_ER_GROUP_PATH = env.str("CLASSIFIER_ER_GROUP_PATH", default="%s/trained_classifier_erGrouping.xml" % DATA_DIR_PATH)
 
+OCR_MAX_EVALS = env.int("OCR_MAX_EVALS", default=25)
+OCR_SCORE_THRESHOLD = env.float("OCR_SCORE_THRESHOLD", default=0.9)
+OCR_CHANNEL_THREADS = env.int("OCR_CHANNEL_THREADS", default=4)
+OCR_STORE_INDEX = ["image_id", "box_number"]
+MAX_BLEED = 50
+
+# Whole-pixel steps: fractional bleeds and thresholds produce the same crops as their integer neighbours.
 SEARCH_SPACE = hyperopt.hp.choice('params',[
     {
-        "bleed": hyperopt.hp.uniform("bleed", 0, 50),
-        "binary": hyperopt.hp.uniform("binary", 0, 255),
+        "bleed": hyperopt.hp.quniform("bleed", 0, MAX_BLEED, 1),
+        "binary": hyperopt.hp.quniform("binary", 0, 255, 1),
     }
 ])
 
@@ -62,6 +81,9 @@ SEARCH_SPACE = hyperopt.hp.choice('params',[
 # Initialization
 
 logger = logging.getLogger(__name__)
+_ocr_tools = [] # type: List[Any]
+_worker_dictionary = None # type: Optional[Set[AnyStr]]
+_ocr_engines = {} # type: Dict[Tuple, OCREngine]
 
 ##########################################################
 # Functions
@@ -76,24 +98,20 @@ def load_dictionary(dictionary_file=DICTIONARY_PATH):
         return dictionary
 
 
-def get_text_boxes(image):
-    # type: (ImageType) -> List[Rectangle]
-    channels = cv2.text.computeNMChannels(image)
+def get_channels(image):
+    # type: (ImageType) -> List[NPArray]
+    """The Neumann-Matas channels of an image and the inverse of each, bar the gradient channel."""
+    channels = list(cv2.text.computeNMChannels(image))
     cn = len(channels)-1
     for c in range(0,cn):
         channels.append((255-channels[c]))
-    rects_array = [] # type: List[Rectangle]
-    for channel in channels:
-        erc1 = cv2.text.loadClassifierNM1(CLASSIFIER_NM1_PATH)
-        er1 = cv2.text.createERFilterNM1(erc1,4,0.00015,0.15,0.2,True,0.1)
-        erc2 = cv2.text.loadClassifierNM2(CLASSIFIER_NM2_PATH)
-        er2 = cv2.text.createERFilterNM2(erc2,0.5)
-        regions = cv2.text.detectRegions(channel,er1,er2)
-        rects = cv2.text.erGrouping(image, channel, [x.tolist() for x in regions],
-            cv2.text.ERGROUPING_ORIENTATION_ANY,CLASSIFIER_ER_GROUP_PATH,0.5)
-        rects_array.extend(rects)
-    return rects_array
-    
+    return channels
+
+
+def get_text_boxes(image):
+    # type: (ImageType) -> List[Rectangle]
+    return get_ocr_engine().get_text_boxes(image)
+
 
 def calc_accuracy(text, dictionary):
     # type: (AnyStr, Set[AnyStr]) -> float
@@ -108,43 +126,223 @@ def calc_accuracy(text, dictionary):
     return score
 
 
+def get_ocr_tool():
+    # type: () -> Any
+    if not _ocr_tools: _ocr_tools.append(pyocr.get_available_tools()[0])
+    return _ocr_tools[0]
+
+
 def image_to_string(image):
     # type: (ImageType) -> AnyStr
-    tools = pyocr.get_available_tools()
-    tool = tools[0]
+    tool = get_ocr_tool()
     text = tool.image_to_string(image)
     return text
 
 
-def extract_text(params, image, box):
-    # type: (Dict[AnyStr, Any], ImageType, Rectangle) -> AnyStr
+def binarize(image, threshold):
+    # type: (ImageType, float) -> ImageType
+    """Set each band's values below threshold to 0 and the rest to 255, as image.point would."""
+    pixels = np.asarray(image)
+    return Image.fromarray(np.where(pixels < threshold, 0, 255).astype(np.uint8))
+
+
+def extract_text(params, image, box, cache=None):
+    # type: (Dict[AnyStr, Any], ImageType, Rectangle, Optional[TextCache]) -> AnyStr
     image_crop = crop(image, box, params["bleed"])
-    image_binary = image_crop.point(lambda x: 0 if x < params["binary"] else 255)
-    text = image_to_string(image_binary)
-    return text
+    image_binary = binarize(image_crop, params["binary"])
+    if cache is None: return image_to_string(image_binary)
+    # Keyed on the binarised pixels, so parameters that give an identical crop share one OCR call.
+    key = (image_binary.size, hashlib.md5(image_binary.tobytes()).hexdigest())
+    if key not in cache: cache[key] = image_to_string(image_binary)
+    return cache[key]
 
 
-def _objective(params, image, box, dictionary):
-    # type: (Dict[AnyStr, Any], ImageType, Rectangle, Set[AnyStr]) -> float
-    text = extract_text(params, image, box)
+def _objective(params, image, box, dictionary, cache=None):
+    # type: (Dict[AnyStr, Any], ImageType, Rectangle, Set[AnyStr], Optional[TextCache]) -> float
+    text = extract_text(params, image, box, cache)
     score = calc_accuracy(text, dictionary)
     return score * -1
 
 
+def _is_legible(score_threshold, trials, *args):
+    # type: (float, Any, *Any) -> Tuple[bool, List[Any]]
+    return -trials.best_trial["result"]["loss"] >= score_threshold, []
+
+
+def search_box_text(image, box, dictionary, ocr_max_evals=OCR_MAX_EVALS, ocr_score_threshold=OCR_SCORE_THRESHOLD):
+    # type: (ImageType, Rectangle, Set[AnyStr], int, float) -> AnyStr
+    """Search crop and threshold parameters for the most legible text, stopping once the dictionary score is good enough."""
+    cache = {} # type: TextCache
+    objective = partial(_objective, image=image, box=box, dictionary=dictionary, cache=cache)
+    best_params = hyperopt.fmin(
+        objective, space=SEARCH_SPACE, algo=hyperopt.tpe.suggest, max_evals=ocr_max_evals,
+        early_stop_fn=partial(_is_legible, ocr_score_threshold), show_progressbar=False
+    )
+    return extract_text(hyperopt.space_eval(SEARCH_SPACE, best_params), image, box, cache)
+
+
+def make_box_task(image, box):
+    # type: (ImageType, Rectangle) -> Tuple[NPArray, Rectangle]
+    """The box's neighbourhood at the largest bleed, and the box relative to it, small enough to send to a worker."""
+    region = np.asarray(crop(image, box, MAX_BLEED))
+    return region, (MAX_BLEED, MAX_BLEED, box[2], box[3])
+
+
+def _init_ocr_worker(dictionary):
+    # type: (Set[AnyStr]) -> None
+    global _worker_dictionary
+    _worker_dictionary = dictionary
+
+
+def _search_box_text_in_worker(task, **kwargs):
+    # type: (Tuple[NPArray, Rectangle], **Any) -> AnyStr
+    region, box = task
+    return search_box_text(Image.fromarray(region), box, _worker_dictionary, **kwargs)
+
+
+def get_image_id(image_file):
+    # type: (FilePath) -> AnyStr
+    image_id_parts = os.path.basename(image_file).split("_")
+    return "_".join(image_id_parts[1:3])
+
+
+##########################################################
+# Classes
+
+
+class OCREngine(object):
+    """Text detection and recognition state shared by every image in a run.
+
+    The ER classifiers, dictionary and pyocr tool are loaded once. ER
+    filters hold per-run state, so each channel thread builds its own pair
+    from the shared classifiers; OpenCV releases the GIL while detecting,
+    so channels are searched concurrently. With workers > 1, box text is
+    searched in a process pool that lives until close().
+    """
+
+    def __init__(self, dictionary_file=DICTIONARY_PATH, workers=1, ocr_channel_threads=OCR_CHANNEL_THREADS, ocr_max_evals=OCR_MAX_EVALS, ocr_score_threshold=OCR_SCORE_THRESHOLD):
+        # type: (FilePath, int, int, int, float) -> None
+        self.dictionary = load_dictionary(dictionary_file)
+        self.tool = get_ocr_tool()
+        self.erc1 = cv2.text.loadClassifierNM1(CLASSIFIER_NM1_PATH)
+        self.erc2 = cv2.text.loadClassifierNM2(CLASSIFIER_NM2_PATH)
+        self.filters = threading.local()
+        self.threads = ThreadPool(ocr_channel_threads) if ocr_channel_threads > 1 else None
+        self.workers = workers
+        self.pool = None # type: Optional[Any]
+        self.search_kwargs = {"ocr_max_evals": ocr_max_evals, "ocr_score_threshold": ocr_score_threshold}
+
+
+    def get_filters(self):
+        # type: () -> Tuple[Any, Any]
+        if not hasattr(self.filters, "er1"):
+            self.filters.er1 = cv2.text.createERFilterNM1(self.erc1,4,0.00015,0.15,0.2,True,0.1)
+            self.filters.er2 = cv2.text.createERFilterNM2(self.erc2,0.5)
+        return self.filters.er1, self.filters.er2
+
+
+    def detect_channel(self, image, channel):
+        # type: (ImageType, NPArray) -> List[Rectangle]
+        er1, er2 = self.get_filters()
+        regions = cv2.text.detectRegions(channel,er1,er2)
+        rects = cv2.text.erGrouping(image, channel, [x.tolist() for x in regions],
+            cv2.text.ERGROUPING_ORIENTATION_ANY,CLASSIFIER_ER_GROUP_PATH,0.5)
+        return list(rects)
+
+
+    def get_text_boxes(self, image):
+        # type: (ImageType) -> List[Rectangle]
+        detect = partial(self.detect_channel, image)
+        channels = get_channels(image)
+        channel_rects = self.threads.map(detect, channels) if self.threads is not None else [detect(channel) for channel in channels]
+        return [rect for rects in channel_rects for rect in rects]
+
+
+    def get_pool(self):
+        # type: () -> Any
+        if self.pool is None:
+            self.pool = Pool(self.workers, initializer=_init_ocr_worker, initargs=(self.dictionary,))
+        return self.pool
+
+
+    def read_boxes(self, image_file):
+        # type: (FilePath) -> List[Tuple[Rectangle, AnyStr]]
+        """Every distinct text box in an image with the text read from it."""
+        boxes = self.get_text_boxes(cv2.imread(image_file))
+        boxes = sorted(set(map(tuple, boxes)))
+        image = Image.open(image_file)
+        if self.workers is not None and self.workers > 1 and len(boxes) > 1:
+            tasks = [make_box_task(image, box) for box in boxes]
+            texts = self.get_pool().map(partial(_search_box_text_in_worker, **self.search_kwargs), tasks)
+        else: texts = [search_box_text(image, box, self.dictionary, **self.search_kwargs) for box in boxes]
+        return list(zip(boxes, texts))
+
+
+    def read_text(self, image_file):
+        # type: (FilePath) -> List[AnyStr]
+        text_image = [text_box for _, text_box in self.read_boxes(image_file) if text_box] # type: List[AnyStr]
+        return text_image
+
+
+    def close(self):
+        # type: () -> None
+        """Stop the box search processes; the engine starts new ones if it is used again."""
+        if self.pool is None: return None
+        self.pool.close()
+        self.pool.join()
+        self.pool = None
+
+
+##########################################################
+# Functions
+
+
+def get_ocr_engine(dictionary_file=DICTIONARY_PATH, workers=1, ocr_channel_threads=OCR_CHANNEL_THREADS, ocr_max_evals=OCR_MAX_EVALS, ocr_score_threshold=OCR_SCORE_THRESHOLD, **kwargs):
+    # type: (FilePath, int, int, int, float, **Any) -> OCREngine
+    """One engine per process for each combination of settings."""
+    key = (dictionary_file, workers, ocr_channel_threads, ocr_max_evals, ocr_score_threshold)
+    if key not in _ocr_engines:
+        _ocr_engines[key] = OCREngine(dictionary_file, workers, ocr_channel_threads, ocr_max_evals, ocr_score_threshold)
+    return _ocr_engines[key]
+
+
 def read_text(image_file, **kwargs):
     # type: (FilePath, **Any) -> List[AnyStr]
-    dictionary = load_dictionary()
-    image = cv2.imread(image_file)
-    boxes = get_text_boxes(image)
-    image = Image.open(image_file)
-    text_image = [] # type: List[AnyStr]
-    boxes = set(map(tuple, boxes))
-    for box in boxes:
-        objective = partial(_objective, image=image, box=box, dictionary=dictionary)
-        best_params = hyperopt.fmin(objective, space=SEARCH_SPACE, algo=hyperopt.tpe.suggest, max_evals=25)
-        text_box = extract_text(best_params, image, box)
-        if text_box: text_image.append(text_box)
-    return text_image
+    return get_ocr_engine(**kwargs).read_text(image_file)
+
+
+def make_text_frames(rows):
+    # type: (List[Tuple[AnyStr, AnyStr, Rectangle, AnyStr]]) -> Tuple[DataFrame, DataFrame]
+    image_ids, box_numbers, boxes, texts = zip(*rows)
+    boxes = np.array(boxes, dtype=np.int64).reshape(-1, 4)
+    bounding_boxes = pd.DataFrame(OrderedDict([
+        ("image_id", image_ids),
+        ("box_number", box_numbers),
+        ("ocr_box_x", boxes[:, 0]),
+        ("ocr_box_y", boxes[:, 1]),
+        ("ocr_box_w", boxes[:, 2]),
+        ("ocr_box_h", boxes[:, 3]),
+    ]))
+    ocr_text = pd.DataFrame(OrderedDict([("image_id", image_ids), ("box_number", box_numbers), ("ocr_text", texts)]))
+    return bounding_boxes, ocr_text
+
+
+def read_text_in_images(input_image_dir=None, storage_map=None, **kwargs):
+    # type: (DirPath, Dict[AnyStr, AnyStr], **Any) -> None
+    """Read the text in every image with one engine, and save the boxes and text in one write."""
+    image_files = get_files_in_directory(input_image_dir, **kwargs)
+    engine = get_ocr_engine(**kwargs)
+    rows = [] # type: List[Tuple[AnyStr, AnyStr, Rectangle, AnyStr]]
+    try:
+        for image_file in tqdm(image_files, desc="Reading Text"):
+            image_id = get_image_id(image_file)
+            for box_number, (box, text) in enumerate(engine.read_boxes(image_file)):
+                if text: rows.append((image_id, str(box_number), box, text))
+    finally: engine.close()
+    if not rows: return None
+    bounding_boxes, ocr_text = make_text_frames(rows)
+    store = Store(**kwargs)
+    store.save_many({storage_map["bounding_boxes"]: bounding_boxes, storage_map["ocr_text"]: ocr_text}, index=OCR_STORE_INDEX)
 
 
 ##########################################################
@@ -0,0 +1,313 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""
+"""
+##########################################################
+# Python Compatibility
+
+from __future__ import print_function, division, absolute_import
+from builtins import range
+from future import standard_library
+standard_library.install_aliases()
+
+##########################################################
+# Standard Library Imports
+
+import hashlib
+import json
+import logging
+import os
+
+##########################################################
+# Third Party Imports
+
+from envparse import env
+import numpy as np
+
+##########################################################
+# Local Imports
+
+from thickshake.storage.store import FACE_EMBEDDINGS_PATH, read_array
+
+##########################################################
+# Typing Configuration
+
+from typing import Text, List, Optional, Tuple, Dict, Any, AnyStr
+FilePath = Text
+DirPath = Text
+NPArray = Any
+Match = Tuple[AnyStr, float]
+
+##########################################################
+# Constants
+
+FACE_INDEX_DIR_NAME = "face_index"
+FACE_INDEX_IVF_MIN_SIZE = env.int("FACE_INDEX_IVF_MIN_SIZE", default=50000)
+FACE_INDEX_NPROBE = env.int("FACE_INDEX_NPROBE", default=8)
+FACE_INDEX_TRAIN_ITERATIONS = 10
+FACE_INDEX_CHUNK_ROWS = 65536
+FACE_INDEX_ARRAYS = ["vectors", "norms", "face_ids", "assignments", "centroids"]
+
+##########################################################
+# Logging Configuration
+
+logger = logging.getLogger(__name__)
+
+##########################################################
+# Helpers
+
+
+def squared_distances(queries, vectors, vector_norms=None):
+    # type: (NPArray, NPArray, Optional[NPArray]) -> NPArray
+    """Pairwise squared Euclidean distances as one matrix product, |q|^2 - 2 q.v + |v|^2."""
+    if vector_norms is None: vector_norms = np.einsum("ij,ij->i", vectors, vectors)
+    query_norms = np.einsum("ij,ij->i", queries, queries)
+    distances = query_norms[:, np.newaxis] - 2 * np.dot(queries, vectors.T) + vector_norms[np.newaxis, :]
+    return np.maximum(distances, 0, out=distances)
+
+
+def nearest_centroids(vectors, centroids, chunk_rows=FACE_INDEX_CHUNK_ROWS):
+    # type: (NPArray, NPArray, int) -> NPArray
+    centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), chunk_rows):
+        chunk = vectors[start:start + chunk_rows]
+        assignments[start:start + len(chunk)] = squared_distances(chunk, centroids, centroid_norms).argmin(axis=1)
+    return assignments
+
+
+def train_centroids(vectors, n_lists, iterations=FACE_INDEX_TRAIN_ITERATIONS, seed=0):
+    # type: (NPArray, int, int, int) -> NPArray
+    """Lloyd's k-means on a sample of at most 256 points per list."""
+    random_state = np.random.RandomState(seed)
+    sample_size = min(len(vectors), n_lists * 256)
+    sample = np.asarray(vectors[np.sort(random_state.choice(len(vectors), sample_size, replace=False))])
+    centroids = sample[random_state.choice(len(sample), n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = nearest_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        counts = np.bincount(assignments, minlength=n_lists)
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+    return centroids
+
+
+def top_k(distances, k):
+    # type: (NPArray, int) -> NPArray
+    """Indices of the k smallest distances in each row, nearest first."""
+    k = min(k, distances.shape[1])
+    if k == 0: return np.zeros((distances.shape[0], 0), dtype=np.int64)
+    rows = np.arange(distances.shape[0])[:, np.newaxis]
+    candidates = np.argpartition(distances, k - 1, axis=1)[:, :k]
+    order = distances[rows, candidates].argsort(axis=1)
+    return candidates[rows, order]
+
+
+def get_face_index_dir(store_path):
+    # type: (FilePath) -> DirPath
+    return os.path.join(os.path.dirname(os.path.abspath(store_path)), FACE_INDEX_DIR_NAME)
+
+
+##########################################################
+# Classes
+
+
+class FaceIndex(object):
+    """Nearest-neighbour index over stored face embeddings.
+
+    Small collections are searched exactly with one BLAS matrix product.
+    Once the collection reaches ivf_min_size, vectors are bucketed by their
+    nearest k-means centroid (an inverted file) and a query only scans the
+    nprobe closest buckets. Arrays are saved as .npy files so large
+    indexes can be memory-mapped on load.
+    """
+
+    def __init__(self, ivf_min_size=FACE_INDEX_IVF_MIN_SIZE):
+        # type: (int) -> None
+        self.ivf_min_size = ivf_min_size
+        self.vectors = np.zeros((0, 128), dtype=np.float32)
+        self.norms = np.zeros(0, dtype=np.float32)
+        self.face_ids = np.zeros(0, dtype="U64")
+        self.centroids = None # type: Optional[NPArray]
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self._offsets = None # type: Optional[NPArray]
+        self.store_fingerprint = None # type: Optional[Dict[AnyStr, Any]]
+
+
+    def __len__(self):
+        # type: () -> int
+        return len(self.face_ids)
+
+
+    def add(self, face_ids, vectors):
+        # type: (List[AnyStr], NPArray) -> None
+        """Add vectors; assign them to buckets, training the buckets once the index is large enough."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.vectors = np.concatenate([self.vectors, vectors])
+        self.norms = np.concatenate([self.norms, np.einsum("ij,ij->i", vectors, vectors)])
+        self.face_ids = np.concatenate([self.face_ids, np.array(face_ids, dtype="U64")])
+        if self.centroids is not None:
+            self.assignments = np.concatenate([self.assignments, nearest_centroids(vectors, self.centroids)])
+        elif len(self) >= self.ivf_min_size:
+            self.train()
+        self._offsets = None
+
+
+    def train(self, n_lists=None):
+        # type: (Optional[int]) -> None
+        if n_lists is None: n_lists = int(min(4096, max(1, np.sqrt(len(self)))))
+        logger.info("Training face index with %d lists over %d faces.", n_lists, len(self))
+        self.centroids = train_centroids(self.vectors, n_lists)
+        self.assignments = nearest_centroids(self.vectors, self.centroids)
+        self._offsets = None
+
+
+    def get_offsets(self):
+        # type: () -> NPArray
+        """Keep rows ordered by bucket so bucket i is the contiguous slice offsets[i]:offsets[i + 1]."""
+        if self._offsets is None:
+            if np.any(self.assignments[1:] < self.assignments[:-1]):
+                order = np.argsort(self.assignments, kind="mergesort")
+                for name in ["vectors", "norms", "face_ids", "assignments"]:
+                    setattr(self, name, getattr(self, name)[order])
+            self._offsets = np.searchsorted(self.assignments, np.arange(len(self.centroids) + 1))
+        return self._offsets
+
+
+    def search(self, queries, k=5, nprobe=None):
+        # type: (NPArray, int, Optional[int]) -> List[List[Match]]
+        """Return the k nearest stored faces to each query as (face_id, distance), nearest first."""
+        if nprobe is None: nprobe = FACE_INDEX_NPROBE
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        if self.centroids is None: return self.search_exact(queries, k)
+        offsets = self.get_offsets()
+        probes = top_k(squared_distances(queries, self.centroids), nprobe)
+        results = []
+        for query, probe in zip(queries, probes):
+            slices = [slice(offsets[i], offsets[i + 1]) for i in probe]
+            candidates = np.concatenate([np.arange(s.start, s.stop) for s in slices])
+            distances = np.concatenate([
+                squared_distances(query[np.newaxis], self.vectors[s], self.norms[s]) for s in slices
+            ], axis=1)
+            nearest = top_k(distances, k)[0]
+            results.append(self.make_matches(candidates[nearest], distances[0, nearest]))
+        return results
+
+
+    def search_exact(self, queries, k=5):
+        # type: (NPArray, int) -> List[List[Match]]
+        distances = squared_distances(queries, self.vectors, self.norms)
+        nearest = top_k(distances, k)
+        return [self.make_matches(rows, row_distances[rows]) for rows, row_distances in zip(nearest, distances)]
+
+
+    def make_matches(self, rows, squared):
+        # type: (NPArray, NPArray) -> List[Match]
+        return [(str(self.face_ids[row]), float(np.sqrt(distance))) for row, distance in zip(rows, squared)]
+
+
+    def get_vector(self, face_id):
+        # type: (AnyStr) -> NPArray
+        rows = np.flatnonzero(self.face_ids == face_id)
+        if len(rows) == 0: raise KeyError("Face %s is not in the index." % face_id)
+        return self.vectors[rows[0]]
+
+
+    def save(self, index_dir):
+        # type: (DirPath) -> None
+        if not os.path.exists(index_dir): os.makedirs(index_dir)
+        if self.centroids is not None: self.get_offsets()
+        for name in FACE_INDEX_ARRAYS:
+            array = getattr(self, name)
+            path = os.path.join(index_dir, "%s.npy" % name)
+            if array is None:
+                if os.path.exists(path): os.remove(path)
+                continue
+            # Replace rather than overwrite, so indexes mapped from the old files stay valid.
+            with open(path + ".tmp", "wb") as f:
+                np.save(f, array)
+            os.rename(path + ".tmp", path)
+        with open(os.path.join(index_dir, "index.json"), "w") as f:
+            json.dump({
+                "size": len(self), "ivf_min_size": self.ivf_min_size, "trained": self.centroids is not None,
+                "store_fingerprint": self.store_fingerprint,
+            }, f)
+
+
+    @classmethod
+    def load(cls, index_dir, mmap_mode=None):
+        # type: (DirPath, Optional[AnyStr]) -> FaceIndex
+        with open(os.path.join(index_dir, "index.json")) as f:
+            meta = json.load(f)
+        index = cls(ivf_min_size=meta["ivf_min_size"])
+        index.store_fingerprint = meta.get("store_fingerprint")
+        for name in FACE_INDEX_ARRAYS:
+            path = os.path.join(index_dir, "%s.npy" % name)
+            if os.path.exists(path): setattr(index, name, np.load(path, mmap_mode=mmap_mode))
+        return index
+
+
+##########################################################
+# Functions
+
+
+def get_store_fingerprint(store_path, size, embeddings_path=FACE_EMBEDDINGS_PATH):
+    # type: (FilePath, int, AnyStr) -> Optional[Dict[AnyStr, Any]]
+    """Identify the first size rows of the stored embeddings by their first and last face ids and last vector."""
+    if size == 0: return None
+    face_ids = read_array(store_path, embeddings_path + "/face_ids", start=size - 1, stop=size)
+    if len(face_ids) == 0: return None
+    first_face_id = read_array(store_path, embeddings_path + "/face_ids", start=0, stop=1)[0]
+    last_vector = read_array(store_path, embeddings_path + "/vectors", start=size - 1, stop=size)
+    return {
+        "size": size,
+        "first_face_id": first_face_id.decode("utf-8"),
+        "last_face_id": face_ids[0].decode("utf-8"),
+        "last_vector": hashlib.sha1(np.ascontiguousarray(last_vector, dtype=np.float32).tobytes()).hexdigest(),
+    }
+
+
+def update_face_index(store_path, index_dir=None, rebuild=False, face_index_ivf_min_size=FACE_INDEX_IVF_MIN_SIZE, embeddings_path=FACE_EMBEDDINGS_PATH, **kwargs):
+    # type: (FilePath, Optional[DirPath], bool, int, AnyStr, **Any) -> FaceIndex
+    """Bring the on-disk index up to date with the store, adding only faces appended since the last update.
+
+    The index is rebuilt if the store no longer starts with the faces it
+    was built from, as after detect_faces --force.
+    """
+    if index_dir is None: index_dir = get_face_index_dir(store_path)
+    fresh = rebuild or not os.path.exists(os.path.join(index_dir, "index.json"))
+    index = FaceIndex(ivf_min_size=face_index_ivf_min_size) if fresh else FaceIndex.load(index_dir, mmap_mode="r")
+    if len(index) and index.store_fingerprint != get_store_fingerprint(store_path, len(index), embeddings_path):
+        logger.info("Face index does not match the store; rebuilding it.")
+        index, fresh = FaceIndex(ivf_min_size=face_index_ivf_min_size), True
+    start = len(index)
+    vectors = read_array(store_path, embeddings_path + "/vectors", start=start)
+    if len(vectors) or fresh:
+        face_ids = [face_id.decode("utf-8") for face_id in read_array(store_path, embeddings_path + "/face_ids", start=start)]
+        if len(vectors): index.add(face_ids, vectors)
+        index.store_fingerprint = get_store_fingerprint(store_path, len(index), embeddings_path)
+        index.save(index_dir)
+        logger.info("Added %d faces to the face index (%d total).", len(face_ids), len(index))
+    return index
+
+
+def load_face_index(store_path, index_dir=None, mmap_mode="r"):
+    # type: (FilePath, Optional[DirPath], Optional[AnyStr]) -> FaceIndex
+    if index_dir is None: index_dir = get_face_index_dir(store_path)
+    return FaceIndex.load(index_dir, mmap_mode=mmap_mode)
+
+
+##########################################################
+# Main
+
+
+def main():
+    pass
+
+
+if __name__ == "__main__":
+    main()
+
+
+##########################################################
@@ -16,11 +16,14 @@ standard_library.install_aliases()
 import datetime
 import logging
 import re
+import time
 
 ##########################################################
 # Third Party Imports
 
 import datefinder
+from envparse import env
+import pandas as pd
 
 ##########################################################
 # Local Imports
@@ -28,34 +31,88 @@ import datefinder
 ##########################################################
 # Typing Configuration
 
-from typing import Text, List, Optional, Any, Dict, AnyStr
+from typing import Text, List, Optional, Any, Dict, Iterable, Pattern, AnyStr
 Date = Any
 Dates = Dict[AnyStr, Date]
+DataFrame = Any
+Series = Any
 
 ##########################################################
 # Constants
 
+DATE_CACHE_SIZE = env.int("DATE_CACHE_SIZE", default=100000)
+MIN_DATE = datetime.date(year=1800, month=1, day=1)
+
+YEAR_PATTERN = r"([1-2][0-9]{3})"
+APPROX_PATTERN = r"\s*[\[\(]?\s*(?:c(?:irca|a)?\.?\s*)?"
+UNCERTAIN_PATTERN = r"\s*\??\s*[\]\)]?\s*\.?\s*"
+DATE_RULES = [
+    re.compile("^%s%s%s$" % (APPROX_PATTERN, YEAR_PATTERN, UNCERTAIN_PATTERN), re.IGNORECASE),
+    re.compile(r"^%s%s\s*-\s*%s%s$" % (APPROX_PATTERN, YEAR_PATTERN, YEAR_PATTERN, UNCERTAIN_PATTERN), re.IGNORECASE),
+] # type: List[Pattern]
+
 
 ##########################################################
 # Initializations
 
 logger = logging.getLogger(__name__)
 
+_date_cache = {} # type: Dict[AnyStr, List[Date]]
+
 ##########################################################
 # Functions
 
-def get_possible_dates(date_string):
+
+def filter_dates(dates):
+    # type: (List[Date]) -> List[Date]
+    max_date = datetime.datetime.now().date()
+    return [date for date in dates if date < max_date and date > MIN_DATE]
+
+
+def find_dates(date_string):
     # type: (AnyStr) -> List[Date]
+    """Fall back to datefinder, then to a bare year, for strings the rules don't cover."""
     try:
         dates = [dt.date() for dt in datefinder.find_dates(date_string)]
         dates[0]
     except:
         years = re.findall(".*([1-2][0-9]{3})", date_string)
         dates = [datetime.date(year=int(year), month=1, day=1) for year in years]
-    max_date = datetime.datetime.now().date()
-    min_date = datetime.date(year=1800,month=1,day=1)
-    dates = [date for date in dates if date < max_date and date > min_date]
-    return dates
+    return filter_dates(dates)
+
+
+def match_date_rules(date_strings):
+    # type: (Series) -> Dict[AnyStr, List[Date]]
+    """Resolve catalogue-style years and year ranges with vectorised regex rules."""
+    matched = {} # type: Dict[AnyStr, List[Date]]
+    for rule in DATE_RULES:
+        if date_strings.empty: break
+        years = date_strings.str.extract(rule, expand=True)
+        found = years[0].notnull()
+        for date_string, row in zip(date_strings[found], years[found].itertuples(index=False)):
+            dates = [datetime.date(year=int(year), month=1, day=1) for year in row]
+            matched[date_string] = filter_dates(dates)
+        date_strings = date_strings[~found]
+    return matched
+
+
+def parse_date_strings(date_strings, date_cache_size=DATE_CACHE_SIZE):
+    # type: (Iterable[AnyStr], int) -> Dict[AnyStr, List[Date]]
+    """Parse each distinct date string once, memoising the results across calls."""
+    unique_strings = set(s for s in date_strings if s)
+    pending = [s for s in unique_strings if s not in _date_cache]
+    if pending:
+        if len(_date_cache) + len(pending) > date_cache_size: _date_cache.clear()
+        matched = match_date_rules(pd.Series(pending, dtype=object))
+        for date_string in pending:
+            if date_string not in matched: matched[date_string] = find_dates(date_string)
+        _date_cache.update(matched)
+    return {s: _date_cache.get(s, []) for s in unique_strings}
+
+
+def get_possible_dates(date_string):
+    # type: (AnyStr) -> List[Date]
+    return list(parse_date_strings([date_string]).get(date_string, []))
 
 
 def select_date(possible_dates, method="first"):
@@ -106,12 +163,71 @@ def split_dates(text, **kwargs):
     return {"start_date": date_start, "end_date": date_end}
 
 
+##########################################################
+# Batch Parsers
+
+
+def get_column(input_dataframe, position=0):
+    # type: (DataFrame, int) -> List[Optional[AnyStr]]
+    column = input_dataframe.iloc[:, position]
+    return [value if pd.notnull(value) and value else None for value in column]
+
+
+def select_dates(date_strings, method="first", date_cache_size=DATE_CACHE_SIZE, **kwargs):
+    # type: (Series, AnyStr, int, **Any) -> List[Optional[Date]]
+    possible_dates = parse_date_strings(date_strings, date_cache_size)
+    return [select_date(possible_dates.get(s, []), method=method) if s else None for s in date_strings]
+
+
+def batch_extract_date_from_title(input_dataframe, method="first", **kwargs):
+    # type: (DataFrame, AnyStr, **Any) -> DataFrame
+    date_strings = [" ".join(t.split(" ")[1:]) if t else None for t in get_column(input_dataframe)]
+    dates = select_dates(date_strings, method=method, **kwargs)
+    return pd.DataFrame({"date": dates}, index=input_dataframe.index)
+
+
+def batch_combine_dates(input_dataframe, **kwargs):
+    # type: (DataFrame, **Any) -> DataFrame
+    exact, approx = get_column(input_dataframe, 0), get_column(input_dataframe, 1)
+    date_strings = [e if e else a for e, a in zip(exact, approx)]
+    dates = select_dates(date_strings, **kwargs)
+    return pd.DataFrame({"date": dates}, index=input_dataframe.index)
+
+
+def batch_split_dates(input_dataframe, **kwargs):
+    # type: (DataFrame, **Any) -> DataFrame
+    parts = [text.split("-") if text else [] for text in get_column(input_dataframe)]
+    start_dates = select_dates([p[0] if len(p) >= 1 else None for p in parts], **kwargs)
+    end_dates = select_dates([p[1] if len(p) >= 2 else None for p in parts], **kwargs)
+    return pd.DataFrame({"start_date": start_dates, "end_date": end_dates}, index=input_dataframe.index)
+
+
 ##########################################################
 # Main
 
 
+def benchmark(n=20000, distinct=500):
+    # type: (int, int) -> Dict[AnyStr, float]
+    """Compare per-string datefinder parsing with the rule-based, memoised batch path."""
+    samples = ["ca. %d" % (1850 + i) for i in range(distinct // 4)]
+    samples += ["[%d?]" % (1850 + i) for i in range(distinct // 4)]
+    samples += ["%d-%d" % (1850 + i, 1855 + i) for i in range(distinct // 4)]
+    samples += ["%d March %d" % (1 + i % 28, 1850 + i) for i in range(distinct - len(samples))]
+    date_strings = [samples[i % len(samples)] for i in range(n)]
+    start_time = time.time()
+    for date_string in date_strings: find_dates(date_string)
+    before = n / (time.time() - start_time)
+    _date_cache.clear()
+    start_time = time.time()
+    parse_date_strings(date_strings)
+    after = n / (time.time() - start_time)
+    return {"before": before, "after": after}
+
+
 def main():
-    pass
+    results = benchmark()
+    print("Per-string: %.1f strings/s" % results["before"])
+    print("Batched:    %.1f strings/s" % results["after"])
 
 
 if __name__ == "__main__":
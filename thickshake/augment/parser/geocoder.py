@@ -16,6 +16,7 @@ standard_library.install_aliases()
 import csv
 import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import time
@@ -27,17 +28,19 @@ from envparse import env
 import geopy.distance
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
 ##########################################################
 # Local Imports
 
-from thickshake.utils import deep_get, consolidate_list
+from thickshake.storage.response_cache import ResponseCache
+from thickshake.utils import deep_get, consolidate_list, RateLimiter
 
 ##########################################################
 # Typing Configuration
 
-from typing import Text, Any, List, Dict, Optional, Pattern, Match, Iterable, AnyStr
+from typing import Text, Any, List, Dict, Optional, Pattern, Match, Iterable, Tuple, AnyStr
 Address = Dict[AnyStr, Optional[AnyStr]]
 Location = Dict[AnyStr, Optional[AnyStr]]
 Series = Iterable[Any]
@@ -50,6 +53,15 @@ Url = AnyStr
 
 MAPPIFY_BASE_URL = env.str("MAPPIFY_BASE_URL", default="https://mappify.io/api/rpc/address/geocode/") # type: Url
 MAPPIFY_API_KEY = env.str("MAPPIFY_API_KEY", default=None) # type: Optional[AnyStr]
+GEOCODE_CACHE_PATH = env.str("GEOCODE_CACHE", default="./data/output/geocode_cache.sqlite") # type: FilePath
+GEOCODE_CACHE_TTL = env.int("GEOCODE_CACHE_TTL", default=30*24*60*60)
+GEOCODE_NEGATIVE_TTL = env.int("GEOCODE_NEGATIVE_TTL", default=24*60*60)
+GEOCODE_CONCURRENCY = env.int("GEOCODE_CONCURRENCY", default=8)
+GEOCODE_RATE_LIMIT = env.float("GEOCODE_RATE_LIMIT", default=10.0)
+GEOCODE_MAX_RETRIES = env.int("GEOCODE_MAX_RETRIES", default=3)
+GEOCODE_BACKOFF = env.float("GEOCODE_BACKOFF", default=0.5)
+GEOCODE_TIMEOUT = env.float("GEOCODE_TIMEOUT", default=10.0)
+GEOCODING_CLIENT_SETTINGS = ["geocode_concurrency", "geocode_rate_limit", "geocode_max_retries", "geocode_backoff", "geocode_timeout"]
 
 CURRENT_FILE_DIR, _ = os.path.split(__file__)
 DATA_DIR_PATH = "%s/../../_data/parser/locations" % CURRENT_FILE_DIR
@@ -63,6 +75,73 @@ MTD_LOC_DEFAULT_STATE = "WA" # type: AnyStr
 
 logger = logging.getLogger(__name__)
 
+_address_regexes = {} # type: Dict[Any, Any]
+_geocode_caches = {} # type: Dict[FilePath, ResponseCache]
+_geocoding_clients = {} # type: Dict[Any, GeocodingClient]
+
+##########################################################
+# Classes
+
+
+class GeocodingClient(object):
+    """Pooled, rate-limited Mappify client that retries transient failures with backoff."""
+
+    def __init__(self, api_url=MAPPIFY_BASE_URL, geocode_concurrency=GEOCODE_CONCURRENCY,
+            geocode_rate_limit=GEOCODE_RATE_LIMIT, geocode_max_retries=GEOCODE_MAX_RETRIES,
+            geocode_backoff=GEOCODE_BACKOFF, geocode_timeout=GEOCODE_TIMEOUT, **kwargs):
+        # type: (Url, int, float, int, float, float, **Any) -> None
+        self.api_url = api_url
+        self.concurrency = max(1, geocode_concurrency)
+        self.max_retries = geocode_max_retries
+        self.backoff = geocode_backoff
+        self.timeout = geocode_timeout
+        self.rate_limiter = RateLimiter(geocode_rate_limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+
+    def geocode(self, params):
+        # type: (Dict[AnyStr, AnyStr]) -> Optional[Dict[AnyStr, Any]]
+        """Return the response body, or None when there is no result; raise once retries run out."""
+        attempt = 0
+        while True:
+            self.rate_limiter.wait()
+            try:
+                res = self.session.post(self.api_url, json=params, timeout=self.timeout)
+                if res.status_code == 429 or res.status_code >= 500: res.raise_for_status()
+            except requests.RequestException:
+                if attempt >= self.max_retries: raise
+                time.sleep(self.backoff * (2 ** attempt))
+                attempt += 1
+                continue
+            res.raise_for_status()
+            res_body = res.json()
+            if not res_body.get("result"): return None
+            return res_body
+
+
+    def try_geocode(self, params):
+        # type: (Dict[AnyStr, AnyStr]) -> Tuple[bool, Optional[Dict[AnyStr, Any]]]
+        try: return True, self.geocode(params)
+        except (requests.RequestException, ValueError):
+            logger.debug("Geocoding failed for %s.", params, exc_info=True)
+            return False, None
+
+
+    def geocode_many(self, params_list):
+        # type: (List[Dict[AnyStr, AnyStr]]) -> List[Tuple[bool, Optional[Dict[AnyStr, Any]]]]
+        """Geocode a batch concurrently; results are (succeeded, response) in input order."""
+        if len(params_list) <= 1 or self.concurrency == 1:
+            return [self.try_geocode(params) for params in params_list]
+        pool = ThreadPool(min(self.concurrency, len(params_list)))
+        try: return pool.map(self.try_geocode, params_list)
+        finally:
+            pool.close()
+            pool.join()
+
+
 ##########################################################
 # Helpers
 
@@ -78,13 +157,66 @@ def read_csv_to_dict(csv_file):
         return outdict
 
 
-def prepare_search_string(input_file):
-    # type: (FilePath) -> AnyStr
-    """Read search terms from CSV files and concatentate into string for Regex."""
+def read_search_terms(input_file):
+    # type: (FilePath) -> List[AnyStr]
+    """Read every search term from a CSV file, in all columns, once each."""
     search_dict = read_csv_to_dict(input_file)
-    search_list = ["|".join(search_dict[key]) for key in search_dict.keys()]
-    search_string = "".join(search_list)
-    return search_string
+    search_terms = [term.strip() for key in search_dict.keys() for term in search_dict[key] if term and term.strip()]
+    return sorted(set(search_terms), key=lambda term: term.lower())
+
+
+def build_trie_pattern(search_terms):
+    # type: (List[AnyStr]) -> AnyStr
+    """Compile search terms into a prefix-trie Regex so shared prefixes are only matched once."""
+    trie = {} # type: Dict[AnyStr, Any]
+    for term in search_terms:
+        node = trie
+        for char in term.lower():
+            node = node.setdefault(char, {})
+        node[""] = {}
+    def to_pattern(node):
+        # type: (Dict[AnyStr, Any]) -> AnyStr
+        optional = "" in node
+        alternatives = [re.escape(char) + to_pattern(child) for char, child in sorted(node.items()) if char != ""]
+        if not alternatives: return ""
+        if len(alternatives) == 1 and not optional: return alternatives[0]
+        pattern = "(?:%s)" % "|".join(alternatives)
+        return pattern + "?" if optional else pattern
+    return to_pattern(trie)
+
+
+def get_lexicon_pattern(input_file):
+    # type: (FilePath) -> AnyStr
+    key = ("lexicon", input_file)
+    if key not in _address_regexes:
+        _address_regexes[key] = build_trie_pattern(read_search_terms(input_file))
+    return _address_regexes[key]
+
+
+def get_suburb_regex(suburb_names_file=MTD_LOC_SUBURB_NAMES_FILE):
+    # type: (FilePath) -> Pattern[AnyStr]
+    key = ("suburb", suburb_names_file)
+    if key not in _address_regexes:
+        suburb_names = get_lexicon_pattern(suburb_names_file)
+        _address_regexes[key] = re.compile(r'\b(?:{0})\b'.format(suburb_names), re.IGNORECASE)
+    return _address_regexes[key]
+
+
+def get_address_regex(street_types_file=MTD_LOC_STREET_TYPES_FILE, suburb_names_file=MTD_LOC_SUBURB_NAMES_FILE):
+    # type: (FilePath, FilePath) -> Pattern[AnyStr]
+    """Build the address Regex once per pair of lexicon files."""
+    key = ("address", street_types_file, suburb_names_file)
+    if key not in _address_regexes:
+        street_types = get_lexicon_pattern(street_types_file)
+        suburb_names = get_lexicon_pattern(suburb_names_file)
+        _address_regexes[key] = re.compile(
+            r'(?:.*?),\s*' +
+            r'(?P<street_number>\d+)?\s*' +
+            r'(?P<street_name>.*?)?\s*' +
+            r'(?P<street_type>\b(?:{0})\b)?,*\s*'.format(street_types) +
+            r'(?P<suburb_name>\b(?:{0})\b)'.format(suburb_names), re.IGNORECASE
+        )
+    return _address_regexes[key]
 
 
 def get_matches_from_regex(compiled_regex, target_text):
@@ -122,19 +254,14 @@ def title_case(text):
 
 def parse_address(location_text, street_types_file=MTD_LOC_STREET_TYPES_FILE, suburb_names_file=MTD_LOC_SUBURB_NAMES_FILE):
     # type: (AnyStr, FilePath, FilePath) -> Optional[Address]
-    street_types = prepare_search_string(street_types_file)
-    suburb_names = prepare_search_string(suburb_names_file)
-    re_main = re.compile(
-        r'(?:.*?),\s*' +
-        r'(?P<street_number>\d+)?\s*' +
-        r'(?P<street_name>.*?)?\s*' +
-        r'(?P<street_type>\b(?:{0})\b)?,*\s*'.format(street_types) +
-        r'(?P<suburb_name>\b(?:{0})\b)'.format(suburb_names), re.IGNORECASE
-    )
-    try: addresses = get_matches_from_regex(re_main, location_text)
+    if not location_text or "," not in location_text: return None
+    re_suburb = get_suburb_regex(suburb_names_file)
+    if not re_suburb.search(location_text, location_text.index(",")): return None
+    re_main = get_address_regex(street_types_file, suburb_names_file)
+    try: match = re_main.search(location_text)
     except: return None
-    if not addresses: return None
-    address = addresses[0]
+    if not match: return None
+    address = {k:v for k,v in match.groupdict().items() if v is not None}
     return address
 
 
@@ -151,49 +278,93 @@ def generate_params(address, api_key=MAPPIFY_API_KEY, default_state=MTD_LOC_DEFA
     return params_dict
 
 
-def geocode_address(address, api_url=MAPPIFY_BASE_URL):
-    # type: (Address, AnyStr) -> Location
-    params = generate_params(address)
-    if params["streetAddress"] != "":
-        res = requests.post(api_url, json=params)
-        try:
-            res_body = res.json()
-            results = res_body["result"]
-            if isinstance(results, list):
-                response = choose_best_location(results)
-            else: response = results
-            location = {
-                "building_name": title_case(response["buildingName"]),
-                "street_number": get_street_number(response),
-                "street_name": title_case(response["streetName"]),
-                "street_type": title_case(response["streetType"]),
-                "suburb": title_case(response["suburb"]),
-                "state": response["state"],
-                "post_code": response["postCode"],
-                "latitude": deep_get(response, "location", "lat"),
-                "longitude": deep_get(response, "location", "lon"),
-                "confidence": res_body["confidence"],
-                "location_type": "geocoded",
-            }
-        except:
-            location = {
-                "street_number": address.get("street_number", None),
-                "street_name": address.get("street_name", None),
-                "street_type": address.get("street_type", None),
-                "suburb": params.get("suburb", None),
-                "state": params.get("state", None),
-                "location_type": "parsed",
-            }
-    else: 
-        location = {
-            "street_number": address.get("street_number", None),
-            "street_name": address.get("street_name", None),
-            "street_type": address.get("street_type", None),
-            "suburb": params.get("suburb", None),
-            "state": params.get("state", None),
-            "location_type": "parsed",
-        }
-    return location
+def get_geocode_cache(geocode_cache_file=GEOCODE_CACHE_PATH, geocode_cache_ttl=GEOCODE_CACHE_TTL, geocode_negative_ttl=GEOCODE_NEGATIVE_TTL):
+    # type: (FilePath, int, int) -> ResponseCache
+    """Open each geocode cache file once per process."""
+    if geocode_cache_file not in _geocode_caches:
+        _geocode_caches[geocode_cache_file] = ResponseCache(
+            geocode_cache_file, ttl=geocode_cache_ttl,
+            negative_ttl=geocode_negative_ttl, ignore_keys=["apiKey"]
+        )
+    return _geocode_caches[geocode_cache_file]
+
+
+def get_geocoding_client(api_url=MAPPIFY_BASE_URL, **kwargs):
+    # type: (Url, **Any) -> GeocodingClient
+    """Share one client (and its connection pool) per endpoint and settings."""
+    settings = {k:v for k,v in kwargs.items() if k in GEOCODING_CLIENT_SETTINGS}
+    key = (api_url,) + tuple(sorted(settings.items()))
+    if key not in _geocoding_clients:
+        _geocoding_clients[key] = GeocodingClient(api_url=api_url, **settings)
+    return _geocoding_clients[key]
+
+
+def parsed_location(address, params):
+    # type: (Address, Dict[AnyStr, AnyStr]) -> Location
+    return {
+        "street_number": address.get("street_number", None),
+        "street_name": address.get("street_name", None),
+        "street_type": address.get("street_type", None),
+        "suburb": params.get("suburb", None),
+        "state": params.get("state", None),
+        "location_type": "parsed",
+    }
+
+
+def geocoded_location(res_body):
+    # type: (Dict[AnyStr, Any]) -> Location
+    results = res_body["result"]
+    if isinstance(results, list):
+        response = choose_best_location(results)
+    else: response = results
+    return {
+        "building_name": title_case(response["buildingName"]),
+        "street_number": get_street_number(response),
+        "street_name": title_case(response["streetName"]),
+        "street_type": title_case(response["streetType"]),
+        "suburb": title_case(response["suburb"]),
+        "state": response["state"],
+        "post_code": response["postCode"],
+        "latitude": deep_get(response, "location", "lat"),
+        "longitude": deep_get(response, "location", "lon"),
+        "confidence": res_body["confidence"],
+        "location_type": "geocoded",
+    }
+
+
+def geocode_addresses(addresses, api_url=MAPPIFY_BASE_URL, geocode_cache_file=GEOCODE_CACHE_PATH, geocode_cache_ttl=GEOCODE_CACHE_TTL, geocode_negative_ttl=GEOCODE_NEGATIVE_TTL, **kwargs):
+    # type: (List[Address], AnyStr, FilePath, int, int, **Any) -> List[Location]
+    """Geocode parsed addresses, requesting each distinct uncached address once and concurrently."""
+    cache = get_geocode_cache(geocode_cache_file, geocode_cache_ttl, geocode_negative_ttl)
+    params_list = [generate_params(address) for address in addresses]
+    responses = {} # type: Dict[AnyStr, Optional[Dict[AnyStr, Any]]]
+    pending = {} # type: Dict[AnyStr, Dict[AnyStr, AnyStr]]
+    for params in params_list:
+        if params["streetAddress"] == "": continue
+        key = cache.make_key(params)
+        if key in responses or key in pending: continue
+        found, res_body = cache.get(params)
+        if found: responses[key] = res_body
+        else: pending[key] = params
+    if pending:
+        client = get_geocoding_client(api_url, **kwargs)
+        keys = list(pending.keys())
+        for key, (succeeded, res_body) in zip(keys, client.geocode_many([pending[key] for key in keys])):
+            if not succeeded: continue
+            cache.put(pending[key], res_body)
+            responses[key] = res_body
+    locations = []
+    for address, params in zip(addresses, params_list):
+        res_body = responses.get(cache.make_key(params)) if params["streetAddress"] != "" else None
+        try: location = geocoded_location(res_body) if res_body is not None else parsed_location(address, params)
+        except: location = parsed_location(address, params)
+        locations.append(location)
+    return locations
+
+
+def geocode_address(address, **kwargs):
+    # type: (Address, **Any) -> Location
+    return geocode_addresses([address], **kwargs)[0]
 
 
 def extract_location(location_text, **kwargs):
@@ -201,9 +372,22 @@ def extract_location(location_text, **kwargs):
     """Parse and geocode location from text."""
     address = parse_address(location_text)
     if not address: return {}
-    location = geocode_address(address)
+    location = geocode_address(address, **kwargs)
     return location
 
+
+def batch_extract_location(input_dataframe, **kwargs):
+    # type: (Any, **Any) -> Any
+    """Parse every note in a chunk, then geocode the distinct addresses concurrently."""
+    index, addresses = [], []
+    for i, location_text in zip(input_dataframe.index, input_dataframe.iloc[:, 0]):
+        address = parse_address(location_text) if isinstance(location_text, str) else None
+        if not address: continue
+        index.append(i)
+        addresses.append(address)
+    locations = geocode_addresses(addresses, **kwargs)
+    return pd.DataFrame.from_records(locations, index=index)
+
 ##########################################################
 # Main
 
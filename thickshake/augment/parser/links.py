@@ -13,49 +13,234 @@ standard_library.install_aliases()
 # Standard Library Imports
 
 import logging
+from multiprocessing.pool import ThreadPool
+import os
+import struct
 
 ##########################################################
 # Third Party Imports
 
 from envparse import env
-from PIL import ImageFile
+import pandas as pd
+from PIL import Image, ImageFile
 import requests
+from requests.adapters import HTTPAdapter
 
 ##########################################################
 # Local Imports
 
-from typing import Text, Optional, Dict, Any, AnyStr
+from typing import Text, Optional, Dict, List, Tuple, Iterable, Any, AnyStr
 FilePath = Text
+DirPath = Text
 Size = Dict[AnyStr, AnyStr]
+Dimensions = Optional[Tuple[int, int]]
+DataFrame = Any
 
 ##########################################################
 # Environmental Variables
 
 SLWA_BASE_URL = env.str("SLWA_BASE_URL", default = "http://purl.slwa.wa.gov.au/")
+IMAGE_PROBE_CONCURRENCY = env.int("IMAGE_PROBE_CONCURRENCY", default=16)
+IMAGE_PROBE_BYTES = env.int("IMAGE_PROBE_BYTES", default=32768)
+IMAGE_PROBE_TIMEOUT = env.float("IMAGE_PROBE_TIMEOUT", default=10.0)
+IMAGE_HEADER_MAX_BYTES = 1024 * 1024
+IMAGE_PROBER_SETTINGS = ["image_probe_concurrency", "image_probe_bytes", "image_probe_timeout"]
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - set([0xC4, 0xC8, 0xCC])
+JPEG_STANDALONE_MARKERS = set([0x01, 0xD8]) | set(range(0xD0, 0xD8))
 
 ##########################################################
 # Logging Configuration
 
 logger = logging.getLogger(__name__)
 
+_local_image_indexes = {} # type: Dict[DirPath, Dict[AnyStr, FilePath]]
+_image_probers = {} # type: Dict[Any, ImageProber]
+
+##########################################################
+# Header Parsing
+
+
+def get_jpeg_dimensions(data):
+    # type: (bytearray) -> Dimensions
+    i = 2
+    while i + 9 <= len(data):
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in JPEG_STANDALONE_MARKERS:
+            i += 2
+            continue
+        if marker in JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">HH", bytes(data[i + 5:i + 9]))
+            return width, height
+        i += 2 + ((data[i + 2] << 8) | data[i + 3])
+    return None
+
+
+def read_image_dimensions(data):
+    # type: (bytes) -> Dimensions
+    """Read width and height from JPEG, PNG or GIF header bytes; None if they aren't there (yet)."""
+    data = bytearray(data)
+    if data[:8] == PNG_SIGNATURE and len(data) >= 24 and data[12:16] == b"IHDR":
+        return struct.unpack(">II", bytes(data[16:24]))
+    if data[:4] == b"GIF8" and len(data) >= 10:
+        return struct.unpack("<HH", bytes(data[6:10]))
+    if data[:2] == b"\xff\xd8":
+        return get_jpeg_dimensions(data)
+    return None
+
+
+def read_dimensions_from_chunks(chunks):
+    # type: (Iterable[bytes]) -> Dimensions
+    """Read dimensions from a byte stream, stopping as soon as the header has been seen."""
+    header = b""
+    parser = ImageFile.Parser()
+    for chunk in chunks:
+        if not chunk: continue
+        if len(header) < IMAGE_HEADER_MAX_BYTES:
+            header += chunk
+            dimensions = read_image_dimensions(header)
+            if dimensions: return dimensions
+        parser.feed(chunk)
+        if parser.image: return parser.image.size
+    return None
+
+
+def iter_file_chunks(file_path, chunk_size=IMAGE_PROBE_BYTES):
+    # type: (FilePath, int) -> Iterable[bytes]
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk: return
+            yield chunk
+
+
+def get_local_image_index(input_image_dir):
+    # type: (DirPath) -> Dict[AnyStr, FilePath]
+    """Map image labels to files in the input image directory, listing it once."""
+    if input_image_dir not in _local_image_indexes:
+        index = {} # type: Dict[AnyStr, FilePath]
+        if input_image_dir and os.path.isdir(input_image_dir):
+            for file_name in os.listdir(input_image_dir):
+                label, ext = os.path.splitext(file_name)
+                if ext.lower() not in (".jpg", ".jpeg", ".png", ".gif"): continue
+                file_path = os.path.join(input_image_dir, file_name)
+                index.setdefault(label, file_path)
+                if label.endswith("_master"): index.setdefault(label[:-len("_master")], file_path)
+        _local_image_indexes[input_image_dir] = index
+    return _local_image_indexes[input_image_dir]
+
+
+def get_local_image_dimensions(file_path):
+    # type: (FilePath) -> Dimensions
+    try:
+        dimensions = read_dimensions_from_chunks(iter_file_chunks(file_path))
+        if dimensions: return dimensions
+        with Image.open(file_path) as image: return image.size
+    except (IOError, OSError):
+        logger.warning("Local image %s could not be read.", file_path)
+        return None
+
+
+##########################################################
+# Classes
+
+
+class ImageProber(object):
+    """Sizes remote images over pooled keep-alive connections, fetching only header bytes where the server allows."""
+
+    def __init__(self, image_probe_concurrency=IMAGE_PROBE_CONCURRENCY, image_probe_bytes=IMAGE_PROBE_BYTES,
+            image_probe_timeout=IMAGE_PROBE_TIMEOUT, **kwargs):
+        # type: (int, int, float, **Any) -> None
+        self.concurrency = max(1, image_probe_concurrency)
+        self.probe_bytes = image_probe_bytes
+        self.timeout = image_probe_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.concurrency, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+
+    def iter_chunks(self, image_url):
+        # type: (AnyStr) -> Iterable[bytes]
+        """Stream the first probe_bytes with a Range request, then the rest of the file only if still needed."""
+        headers = {"Range": "bytes=0-%d" % (self.probe_bytes - 1)}
+        received = 0
+        with self.session.get(image_url, headers=headers, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            partial = r.status_code == 206
+            for chunk in r.iter_content(chunk_size=8192):
+                received += len(chunk)
+                yield chunk
+        if not partial or received < self.probe_bytes: return
+        headers = {"Range": "bytes=%d-" % received}
+        with self.session.get(image_url, headers=headers, stream=True, timeout=self.timeout) as r:
+            if r.status_code != 206: return
+            for chunk in r.iter_content(chunk_size=8192):
+                yield chunk
+
+
+    def probe(self, image_url):
+        # type: (AnyStr) -> Dimensions
+        try: return read_dimensions_from_chunks(self.iter_chunks(image_url))
+        except (requests.RequestException, IOError, ValueError):
+            logger.warning("Image not found. Size could not be determined.")
+            return None
+
+
+    def probe_many(self, image_urls):
+        # type: (List[AnyStr]) -> List[Dimensions]
+        """Size a batch of images concurrently; results are in input order."""
+        if len(image_urls) <= 1 or self.concurrency == 1:
+            return [self.probe(image_url) for image_url in image_urls]
+        pool = ThreadPool(min(self.concurrency, len(image_urls)))
+        try: return pool.map(self.probe, image_urls)
+        finally:
+            pool.close()
+            pool.join()
+
+
 ##########################################################
 # Functions
 
 
+def get_image_prober(**kwargs):
+    # type: (**Any) -> ImageProber
+    settings = {k:v for k,v in kwargs.items() if k in IMAGE_PROBER_SETTINGS}
+    key = tuple(sorted(settings.items()))
+    if key not in _image_probers: _image_probers[key] = ImageProber(**settings)
+    return _image_probers[key]
+
+
+def get_many_image_dimensions(image_urls, input_image_dir=None, **kwargs):
+    # type: (List[AnyStr], DirPath, **Any) -> Dict[AnyStr, Dimensions]
+    """Size each distinct image once, from local files where possible and remotely otherwise."""
+    local_index = get_local_image_index(input_image_dir) if input_image_dir else {}
+    dimensions = {} # type: Dict[AnyStr, Dimensions]
+    remote_urls = []
+    for image_url in set(u for u in image_urls if u):
+        local_path = local_index.get(get_id_from_url(image_url))
+        if local_path is not None: dimensions[image_url] = get_local_image_dimensions(local_path)
+        if dimensions.get(image_url) is None: remote_urls.append(image_url)
+    if remote_urls:
+        prober = get_image_prober(**kwargs)
+        dimensions.update(zip(remote_urls, prober.probe_many(remote_urls)))
+    return dimensions
+
+
 def get_image_dimensions(image_url, **kwargs):
     # type: (AnyStr, **Any) -> Optional[Size]
-    if image_url is None: return {"width": None, "height": None} 
-    try:
-        with requests.get(image_url, stream=True) as r:
-            parser = ImageFile.Parser()
-            for chunk in r.iter_content(chunk_size=1024): 
-                if chunk:
-                    parser.feed(chunk)
-                    if parser.image:
-                        width, height = parser.image.size
-                        return {"width": width, "height": height}
-    except: logger.warning("Image not found. Size could not be determined.")
-    return {"width": None, "height": None}
+    if image_url is None: return {"width": None, "height": None}
+    dimensions = get_many_image_dimensions([image_url], **kwargs).get(image_url)
+    if dimensions is None: return {"width": None, "height": None}
+    width, height = dimensions
+    return {"width": width, "height": height}
 
 
 def get_id_from_url(image_file):
@@ -79,13 +264,24 @@ def extract_image_links(text, **kwargs):
 
 def extract_image_dimensions(text, **kwargs):
     # type: (AnyStr, **Any) -> Dict[AnyStr, AnyStr]
-    image_dimensions = get_image_dimensions(text)
+    image_dimensions = get_image_dimensions(text, **kwargs)
     return {
         "image_height": image_dimensions.get("height", None),
         "image_width": image_dimensions.get("width", None)
     }
 
 
+def batch_extract_image_dimensions(input_dataframe, **kwargs):
+    # type: (DataFrame, **Any) -> DataFrame
+    image_urls = [u if pd.notnull(u) and u else None for u in input_dataframe.iloc[:, 0]]
+    dimensions = get_many_image_dimensions(image_urls, **kwargs)
+    sizes = [dimensions.get(u) if u else None for u in image_urls]
+    return pd.DataFrame({
+        "image_height": [size[1] if size else None for size in sizes],
+        "image_width": [size[0] if size else None for size in sizes],
+    }, index=input_dataframe.index)
+
+
 ##########################################################
 # Main
 
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""
+Stand-in for the Mappify geocode endpoint, for running parse_locations
+offline. Responses are derived deterministically from the request so
+repeated runs return identical coordinates.
+
+    python -m thickshake.augment.parser.local_geocoder 8765
+    MAPPIFY_BASE_URL=http://127.0.0.1:8765/ thickshake augment run_parsers
+"""
+##########################################################
+# Python Compatibility
+
+from __future__ import print_function, division, absolute_import
+from builtins import int, str
+from future import standard_library
+standard_library.install_aliases()
+
+##########################################################
+# Standard Library Imports
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import hashlib
+import json
+import logging
+import sys
+import threading
+
+##########################################################
+# Third Party Imports
+
+##########################################################
+# Local Imports
+
+##########################################################
+# Typing Configuration
+
+from typing import Any, Dict, Optional, Tuple, AnyStr
+Url = AnyStr
+
+##########################################################
+# Constants
+
+LOCAL_GEOCODER_HOST = "127.0.0.1"
+LOCAL_GEOCODER_PORT = 8765
+PERTH_LAT, PERTH_LON = -31.9505, 115.8605
+
+##########################################################
+# Logging Configuration
+
+logger = logging.getLogger(__name__)
+
+##########################################################
+# Functions
+
+
+def make_result(params):
+    # type: (Dict[AnyStr, Any]) -> Optional[Dict[AnyStr, Any]]
+    """Build a Mappify-shaped result, or None for requests without a suburb."""
+    suburb = params.get("suburb")
+    if not suburb: return None
+    street_parts = (params.get("streetAddress") or "").split()
+    number = street_parts[0] if street_parts and street_parts[0].isdigit() else None
+    if number is not None: street_parts = street_parts[1:]
+    digest = hashlib.md5(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+    offset_lat = (int(digest[:4], 16) / 0xffff - 0.5) * 0.2
+    offset_lon = (int(digest[4:8], 16) / 0xffff - 0.5) * 0.2
+    return {
+        "buildingName": None,
+        "numberFirst": number,
+        "numberLast": None,
+        "streetName": " ".join(street_parts[:-1]) if len(street_parts) > 1 else " ".join(street_parts),
+        "streetType": street_parts[-1] if len(street_parts) > 1 else None,
+        "suburb": suburb.upper(),
+        "state": params.get("state"),
+        "postCode": "6%03d" % (int(digest[8:12], 16) % 1000),
+        "location": {"lat": PERTH_LAT + offset_lat, "lon": PERTH_LON + offset_lon},
+    }
+
+
+class LocalGeocoderHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        # type: () -> None
+        length = int(self.headers.get("Content-Length", 0))
+        try: params = json.loads(self.rfile.read(length).decode("utf-8"))
+        except ValueError:
+            self.send_error(400, "Invalid JSON")
+            return
+        with self.server.lock:
+            self.server.request_count += 1
+        result = make_result(params)
+        body = {"type": "geocodeResult", "result": result, "confidence": 0.9 if result else 0.0}
+        content = json.dumps(body).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def make_local_geocoder(host=LOCAL_GEOCODER_HOST, port=LOCAL_GEOCODER_PORT):
+    # type: (AnyStr, int) -> HTTPServer
+    server = HTTPServer((host, port), LocalGeocoderHandler)
+    server.lock = threading.Lock()
+    server.request_count = 0
+    return server
+
+
+def start_local_geocoder(host=LOCAL_GEOCODER_HOST, port=0):
+    # type: (AnyStr, int) -> Tuple[HTTPServer, Url]
+    """Serve the stand-in geocoder on a background thread; port 0 picks a free port."""
+    server = make_local_geocoder(host, port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    api_url = "http://%s:%d/" % server.server_address
+    return server, api_url
+
+
+##########################################################
+# Main
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else LOCAL_GEOCODER_PORT
+    server = make_local_geocoder(port=port)
+    print("Serving local geocoder on http://%s:%d/" % server.server_address)
+    try: server.serve_forever()
+    except KeyboardInterrupt: server.server_close()
+
+
+if __name__ == "__main__":
+    main()
+
+
+##########################################################
@@ -199,6 +199,8 @@ def convert(input_metadata_file, output_metadata_file=None, output_metadata_type
 
 @cli.command(cls=CommandWithConfigFile(), context_settings=context_settings)
 @click.option("-i", "--input-metadata-file", required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option("-b", "--load-batch-size", required=False, type=int, default=None, help="records written per transaction")
+@click.option("-w", "--workers", required=False, type=int, default=None, help="number of parsing processes")
 @common_params
 def load(input_metadata_file, **kwargs):
     # type: (FilePath, **Any) -> None
@@ -291,8 +293,9 @@ def augment_parsers(**kwargs):
 def augment_processors(input_image_dir, output_image_dir, **kwargs):
     # type: (DirPath, DirPath, **Any) -> None
     """Runs all image processing functions."""
-    from thickshake.augment import detect_faces, identify_faces, read_text, caption_images
+    from thickshake.augment import detect_faces, cluster_faces, identify_faces, read_text, caption_images
     detect_faces(input_image_dir, output_image_dir=output_image_dir, **kwargs)
+    cluster_faces(input_image_dir, output_image_dir=output_image_dir, **kwargs)
     identify_faces(input_image_dir, output_image_dir=output_image_dir, **kwargs)
     read_text(input_image_dir, output_image_dir=output_image_dir, **kwargs)
     caption_images(input_image_dir, output_image_dir=output_image_dir, **kwargs)
@@ -307,13 +310,14 @@ def augment_all(input_image_dir, output_image_dir, **kwargs):
     """Runs all augment functions."""
     from thickshake.augment import (
         parse_locations, parse_dates, parse_links, parse_sizes,
-        detect_faces, identify_faces, read_text, caption_images
+        detect_faces, cluster_faces, identify_faces, read_text, caption_images
     )
     parse_locations(**kwargs)
     parse_dates(**kwargs)
     parse_links(**kwargs)
     parse_sizes(**kwargs)
     detect_faces(input_image_dir, output_image_dir=output_image_dir, **kwargs)
+    cluster_faces(input_image_dir, output_image_dir=output_image_dir, **kwargs)
     identify_faces(input_image_dir, output_image_dir=output_image_dir, **kwargs)
     read_text(input_image_dir, output_image_dir=output_image_dir, **kwargs)
     caption_images(input_image_dir, output_image_dir=output_image_dir, **kwargs)
@@ -322,6 +326,7 @@ def augment_all(input_image_dir, output_image_dir, **kwargs):
 @augment.command(cls=CommandWithConfigFile(), context_settings=context_settings)
 @click.option("-ii", "--input-image-dir", required=False, type=click.Path(exists=True, file_okay=False))
 @click.option("-oi", "--output-image-dir", required=False, type=click.Path(exists=False, file_okay=False))
+@click.option("-w", "--workers", required=False, type=int, default=None, help="number of face detection processes")
 @common_params
 def detect_faces(input_image_dir, output_image_dir, **kwargs):
     # type: (DirPath, DirPath, **Any) -> None
@@ -330,6 +335,18 @@ def detect_faces(input_image_dir, output_image_dir, **kwargs):
     detect_faces(input_image_dir, output_image_dir=output_image_dir, **kwargs)
 
 
+@augment.command(cls=CommandWithConfigFile(), context_settings=context_settings)
+@click.option("-ii", "--input-image-dir", required=False, type=click.Path(exists=True, file_okay=False))
+@click.option("-oi", "--output-image-dir", required=False, type=click.Path(exists=False, file_okay=False))
+@click.option("-t", "--face-cluster-threshold", required=False, type=float, default=None, help="largest embedding distance joining two faces")
+@common_params
+def cluster_faces(input_image_dir, output_image_dir, **kwargs):
+    # type: (DirPath, DirPath, **Any) -> None
+    """Groups detected faces that look like the same person."""
+    from thickshake.augment import cluster_faces
+    cluster_faces(input_image_dir, output_image_dir=output_image_dir, **kwargs)
+
+
 @augment.command(cls=CommandWithConfigFile(), context_settings=context_settings)
 @click.option("-ii", "--input-image-dir", required=False, type=click.Path(exists=True, file_okay=False))
 @click.option("-oi", "--output-image-dir", required=False, type=click.Path(exists=False, file_okay=False))
@@ -341,13 +358,36 @@ def identify_faces(input_image_dir, output_image_dir, **kwargs):
     identify_faces(input_image_dir, output_image_dir=output_image_dir, **kwargs)
 
 
+@augment.command(cls=CommandWithConfigFile(), context_settings=context_settings)
+@click.option("-id", "--face-id", required=False, help="stored face to match against")
+@click.option("-q", "--query-file", required=False, type=click.Path(exists=True, dir_okay=False), help=".npy file of query embeddings")
+@click.option("-k", "--top-k", required=False, type=int, default=5, help="matches returned per query")
+@click.option("-n", "--nprobe", "face_index_nprobe", required=False, type=int, default=None, help="index lists scanned per query")
+@click.option("-r", "--rebuild", is_flag=True, default=False, help="rebuild the index from the store")
+@common_params
+def search_faces(face_id, query_file, top_k, **kwargs):
+    # type: (AnyStr, FilePath, int, **Any) -> None
+    """Finds the stored faces most similar to a face."""
+    import time
+    from thickshake.augment import search_faces
+    start = time.time()
+    results = search_faces(face_id=face_id, query_file=query_file, top_k=top_k, **kwargs)
+    for i, matches in enumerate(results):
+        click.echo("Query %d:" % i)
+        for match_id, distance in matches:
+            click.echo("    %s\t%.4f" % (match_id, distance))
+    click.echo("Searched in %.1f ms." % ((time.time() - start) * 1000))
+
+
 @augment.command(cls=CommandWithConfigFile(), context_settings=context_settings)
 @click.option("-ii", "--input-image-dir", required=False, type=click.Path(exists=True, file_okay=False))
 @click.option("-oi", "--output-image-dir", required=False, type=click.Path(exists=False, file_okay=False))
+@click.option("-w", "--workers", required=False, type=int, default=None, help="number of text search processes")
+@click.option("-ct", "--ocr-channel-threads", required=False, type=int, default=None, help="number of threads detecting text per image")
 @common_params
 def read_text(input_image_dir, output_image_dir, **kwargs):
     # type: (DirPath, DirPath, **Any) -> None
-    """[TODO] Reads text embedded in images."""
+    """Reads text embedded in images."""
     from thickshake.augment import augment
     augment.read_text(input_image_dir, output_image_dir=output_image_dir, **kwargs)
 
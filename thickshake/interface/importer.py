@@ -13,14 +13,17 @@ standard_library.install_aliases()
 ##########################################################
 # Standard Library Imports
 
-from collections import defaultdict
+from collections import defaultdict, deque
 import logging
+from multiprocessing import Pool
 import os
 from pprint import pprint
+import time
 
 ##########################################################
 # Third Party Imports
 
+from envparse import env
 import pymarc
 from tqdm import tqdm
 
@@ -28,13 +31,14 @@ from tqdm import tqdm
 # Local Imports
 
 from thickshake.interface.reader import read_file
-from thickshake.interface.utils import load_config_file, get_subfield_from_tag, get_loaders
+from thickshake.interface.utils import load_config_file, get_subfield, LoaderPlan
 from thickshake.storage import Database
+from thickshake.utils import iter_chunks
 
 ##########################################################
 # Typing Configuration
 
-from typing import Text, Optional, Union, List, Dict, Any, Tuple, AnyStr
+from typing import Text, Optional, Union, List, Dict, Any, Tuple, Iterable, Iterator, AnyStr
 
 Tag = Dict[AnyStr, Optional[AnyStr]]
 PymarcField = Any
@@ -42,83 +46,161 @@ PymarcRecord = Any
 FilePath = Text
 DBSession = Any
 DBObject = Any
+Batch = Dict[AnyStr, List[Any]]
 
 ##########################################################
 # Constants
 
+LOAD_BATCH_SIZE = env.int("LOAD_BATCH_SIZE", default=500)
 
 ##########################################################
 # Logging Configuration
 
 logger = logging.getLogger(__name__)
+_worker_plan = None # type: Optional[LoaderPlan]
 
 ##########################################################
 # Functions
 
 
-def get_data(data, loader, config):
-    # type: (Union[PymarcField, PymarcRecord], Dict[AnyStr, Any], Dict[AnyStr, Any]) -> List[Union[PymarcField, PymarcRecord]]
-    fields = [] # type: List[AnyStr]
-    if not isinstance(data, pymarc.Field): 
-        for k,v in loader.items():
-            if not k.startswith(config["GENERATED_FIELD_PREFIX"]) and not k.startswith(config["TABLE_PREFIX"]):
-                if config["TAG_DELIMITER"] in str(v):
-                    field = str(v).split(config["TAG_DELIMITER"])[0]
-                    fields.append(field)
-        if len(set(fields)) == 1:
-            return data.get_fields(fields[0])
+def get_data(data, plan):
+    # type: (Union[PymarcField, PymarcRecord], LoaderPlan) -> List[Union[PymarcField, PymarcRecord]]
+    if plan.group_field is not None and not isinstance(data, pymarc.Field):
+        return data.get_fields(plan.group_field)
     return [data]
 
 
-def parse_record(record, loader, config, foreign_keys):
-    # type: (Union[PymarcField, PymarcRecord], Dict[AnyStr, Any], Dict[AnyStr, Any], Dict[AnyStr, AnyStr]) -> Dict[AnyStr, Any]
-    parsed_record = {} # type: Dict[AnyStr, Optional[AnyStr]]
-    for k,v in loader.items():
-        if not k.startswith(config["TABLE_PREFIX"]):
-            table_name, column = k.split(".")
-            if k.startswith(config["GENERATED_FIELD_PREFIX"]):
-                parsed_value = None
-            elif str(v).startswith(config["TABLE_PREFIX"]):
-                table = str(v).replace(config["TABLE_PREFIX"], "").lower()
-                if foreign_keys[table]:
-                    parsed_value = foreign_keys[table][-1]
-                else: parsed_value = None
-            elif config["TAG_DELIMITER"] in str(v):
-                parsed_value = get_subfield_from_tag(record, v, tag_delimiter=config["TAG_DELIMITER"])
-            else: parsed_value = v
-            parsed_record[column] = parsed_value
+def parse_record(record, plan, foreign_keys):
+    # type: (Union[PymarcField, PymarcRecord], LoaderPlan, Dict[AnyStr, List[Any]]) -> Dict[AnyStr, Any]
+    parsed_record = {} # type: Dict[AnyStr, Any]
+    for column, field, subfield in plan.columns:
+        parsed_record[column] = get_subfield(record, field, subfield)
+    for column, value in plan.constants:
+        parsed_record[column] = value
+    for column, table in plan.references:
+        parsed_record[column] = foreign_keys[table][-1] if foreign_keys[table] else None
     return parsed_record
 
 
-def store_record(parsed_record, foreign_keys, table_name, database, **kwargs):
-    # type: (Dict[AnyStr, Any], Dict[AnyStr, AnyStr], AnyStr, Database, **Any) -> Dict[AnyStr, AnyStr]
-    with database.manage_db_session(**kwargs) as session:
-        db_object = database.merge_record(table_name, parsed_record, foreign_keys, **kwargs)
-        if hasattr(db_object, "uuid"): return db_object.uuid
-    return None
-
-
-def load_record(data, loader, config, database, table_name="record", foreign_keys=None, **kwargs):
-    # type: (Union[PymarcField, PymarcRecord], Dict[AnyStr, Any], Dict[AnyStr, Any], Database, AnyStr, Dict[AnyStr, Any], **Any) -> None
-    if foreign_keys is None: foreign_keys = defaultdict(list)
-    records = get_data(data, loader, config)
-    sub_loaders = get_loaders(loader, config)
+class PendingRow(object):
+    """A parsed row held in memory until its batch is written."""
+    __slots__ = ("table_name", "values", "references", "uuid")
+
+    def __init__(self, table_name):
+        # type: (AnyStr) -> None
+        self.table_name = table_name
+        self.values = {} # type: Dict[AnyStr, Any]
+        self.references = {} # type: Dict[AnyStr, PendingRow]
+        self.uuid = None # type: Optional[int]
+
+
+def collect_row(record, plan, batch, parents):
+    # type: (Union[PymarcField, PymarcRecord], LoaderPlan, Batch, Dict[AnyStr, List[Any]]) -> Optional[PendingRow]
+    table_name = plan.table_name
+    parsed_record = parse_record(record, plan, parents)
+    if parents[table_name] and parents[table_name][-1] is not None:
+        row = parents[table_name][-1] # nested loaders update their ancestor row
+    elif not parsed_record or all(v is None for v in parsed_record.values()):
+        return None
+    else:
+        row = PendingRow(table_name)
+        batch[table_name].append(row)
+    for column, value in parsed_record.items():
+        if isinstance(value, PendingRow): row.references[column] = value
+        elif value is not None: row.values[column] = value
+    return row
+
+
+def collect_rows(data, plan, batch, parents=None):
+    # type: (Union[PymarcField, PymarcRecord], LoaderPlan, Batch, Dict[AnyStr, List[Any]]) -> None
+    if parents is None: parents = defaultdict(list)
+    for record in get_data(data, plan):
+        row = collect_row(record, plan, batch, parents)
+        parents[plan.table_name].append(row)
+        for child in plan.children:
+            collect_rows(record, child, batch, parents=parents)
+        parents[plan.table_name].pop()
+
+
+def collect_batch(records, plan):
+    # type: (List[PymarcRecord], LoaderPlan) -> Batch
+    batch = defaultdict(list) # type: Batch
     for record in records:
-        parsed_record = parse_record(record, loader, config, foreign_keys)
-        new_primary_key = store_record(parsed_record, foreign_keys, table_name, database, **kwargs) if parsed_record else None
-        foreign_keys[table_name].append(new_primary_key)
-        for sub_table, sub_loader in sub_loaders.items():
-            for sub_loader_i in sub_loader:
-                load_record(data=record, table_name=sub_table, loader=sub_loader_i, config=config, database=database, foreign_keys=foreign_keys)
-        foreign_keys[table_name].pop()
+        collect_rows(record, plan, batch)
+    return batch
 
 
-def load_database(records, loader_config_file=None, **kwargs):
-    # type: (List[PymarcRecord], FilePath, **Any) -> None
+def write_batch(batch, database, **kwargs):
+    # type: (Batch, Database, **Any) -> None
+    """Write a batch table by table in one transaction, resolving references as parents get uuids."""
+    with database.manage_db_session(**kwargs) as session:
+        for table_name in database.get_sorted_table_names():
+            rows = batch.get(table_name)
+            if not rows: continue
+            for row in rows:
+                for column, parent in row.references.items():
+                    row.values[column] = parent.uuid
+            uuids = database.bulk_merge_records(table_name, [row.values for row in rows], **kwargs)
+            for row, uuid in zip(rows, uuids):
+                row.uuid = uuid
+
+
+def _init_worker(loader_config_file):
+    # type: (FilePath) -> None
+    global _worker_plan
+    _worker_plan = load_config_file(loader_config_file)
+
+
+def _collect_batch_in_worker(records):
+    # type: (List[PymarcRecord]) -> Batch
+    return collect_batch(records, _worker_plan)
+
+
+def iter_serial_batches(records, loader_config_file=None, load_batch_size=LOAD_BATCH_SIZE, **kwargs):
+    # type: (Iterable[PymarcRecord], FilePath, int, **Any) -> Iterator[Tuple[int, Batch]]
+    plan = load_config_file(loader_config_file)
+    for records_batch in iter_chunks(records, load_batch_size):
+        yield len(records_batch), collect_batch(records_batch, plan)
+
+
+def iter_parallel_batches(records, loader_config_file=None, load_batch_size=LOAD_BATCH_SIZE, workers=1, **kwargs):
+    # type: (Iterable[PymarcRecord], FilePath, int, int, **Any) -> Iterator[Tuple[int, Batch]]
+    """Parse record ranges across a process pool, keeping at most two ranges in flight per worker."""
+    pool = Pool(workers, initializer=_init_worker, initargs=(loader_config_file,))
+    try:
+        in_flight = deque() # type: deque
+        for records_batch in iter_chunks(records, load_batch_size):
+            in_flight.append((len(records_batch), pool.apply_async(_collect_batch_in_worker, (records_batch,))))
+            if len(in_flight) >= workers * 2:
+                size, result = in_flight.popleft()
+                yield size, result.get()
+        while in_flight:
+            size, result = in_flight.popleft()
+            yield size, result.get()
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def load_database(records, loader_config_file=None, load_batch_size=LOAD_BATCH_SIZE, workers=1, **kwargs):
+    # type: (Iterable[PymarcRecord], FilePath, int, int, **Any) -> None
+    """Load records into the database. Workers parse record ranges; keys are assigned and written here."""
     database = Database(**kwargs)
-    loader_map, loader_config = load_config_file(loader_config_file)
-    for record in tqdm(records, desc="Loading Records"):
-        load_record(data=record, loader=loader_map, config=loader_config, database=database, **kwargs)
+    if workers is not None and workers > 1:
+        batches = iter_parallel_batches(records, loader_config_file, load_batch_size, workers)
+    else: batches = iter_serial_batches(records, loader_config_file, load_batch_size)
+    start_time = time.time()
+    total = 0
+    with tqdm(desc="Loading Records", unit="records") as progress:
+        for size, batch in batches:
+            write_batch(batch, database, **kwargs)
+            total += size
+            progress.update(size)
+    database.refresh_counts(**kwargs)
+    elapsed = time.time() - start_time
+    rate = total / elapsed if elapsed else 0
+    logger.info("Loaded %d records in %.1fs (%.1f records/s).", total, elapsed, rate)
 
 
 ##########################################################
@@ -6,38 +6,43 @@
 # Python Compatibility
 
 from __future__ import print_function, division, absolute_import
+from builtins import open
 from future import standard_library
 standard_library.install_aliases()
 
 ##########################################################
 # Standard Library Imports
 
+import json
 import logging
-import random
+import xml.etree.ElementTree as ET
 
 ##########################################################
 # Third Party Imports
 
-from pymarc import parse_xml_to_array
-from pymarc.reader import MARCReader, JSONReader
+from pymarc import Record, Field
+from pymarc.reader import MARCReader
 
 ##########################################################
 # Local Imports
 
-from thickshake.utils import open_file, get_file_type, sample_items, FileType
+from thickshake.utils import get_file_type, sample_items, FileType
 
 ##########################################################
 # Typing Configuration
 
-from typing import Text, List, Any, Union, Dict, Callable, Optional, AnyStr
+from typing import Text, List, Any, Union, Dict, Callable, Optional, Iterator, AnyStr
 
 FilePath = Text
 File = Any
 PymarcRecord = Any
+Element = Any
 
 ##########################################################
 # Constants
 
+JSON_READ_SIZE = 65536
+JSON_SEPARATORS = " \t\r\n,["
 
 ##########################################################
 # Initializations
@@ -48,29 +53,108 @@ logger = logging.getLogger(__name__)
 # Functions
 
 
-def read_marc(input_file, **kwargs):
-    # type: (FilePath, **Any) -> List[PymarcRecord]
-    return list(MARCReader(open_file(input_file)))
+def strip_namespace(tag):
+    # type: (AnyStr) -> AnyStr
+    return tag.rsplit("}", 1)[-1]
+
+
+def element_to_record(element):
+    # type: (Element) -> PymarcRecord
+    """Convert a MARCXML record element into a pymarc record."""
+    record = Record()
+    for child in element:
+        name = strip_namespace(child.tag)
+        if name == "leader":
+            record.leader = child.text or ""
+        elif name == "controlfield":
+            record.add_field(Field(tag=child.get("tag"), data=child.text or ""))
+        elif name == "datafield":
+            subfields = [] # type: List[AnyStr]
+            for subfield in child:
+                subfields.extend([subfield.get("code"), subfield.text or ""])
+            indicators = [child.get("ind1", " "), child.get("ind2", " ")]
+            record.add_field(Field(tag=child.get("tag"), indicators=indicators, subfields=subfields))
+    return record
+
+
+def json_to_record(data):
+    # type: (Dict[AnyStr, Any]) -> PymarcRecord
+    """Convert a MARC-in-JSON object into a pymarc record."""
+    record = Record()
+    record.leader = data["leader"]
+    for field in data["fields"]:
+        tag, value = list(field.items())[0]
+        if hasattr(value, "get") and "subfields" in value:
+            subfields = [] # type: List[AnyStr]
+            for subfield in value["subfields"]:
+                for code, text in subfield.items():
+                    subfields.extend([code, text])
+            record.add_field(Field(tag=tag, indicators=[value["ind1"], value["ind2"]], subfields=subfields))
+        else: record.add_field(Field(tag=tag, data=value))
+    return record
 
 
-def read_marc_xml(input_file, sample_size=0, **kwargs):
-    # type: (FilePath, int, **Any) -> List[PymarcRecord]
-    return parse_xml_to_array(input_file)
+def read_marc(input_file, **kwargs):
+    # type: (FilePath, **Any) -> Iterator[PymarcRecord]
+    with open(input_file, "rb") as f:
+        for record in MARCReader(f):
+            yield record
 
 
-def read_marc_json(input_file, **kwargs):
-    # type: (FilePath, **Any) -> List[PymarcRecord]
-    return list(JSONReader(open_file(input_file)))
+def read_marc_xml(input_file, **kwargs):
+    # type: (FilePath, **Any) -> Iterator[PymarcRecord]
+    """Incrementally parse MARCXML, clearing each record element once it is converted."""
+    context = ET.iterparse(input_file, events=("start", "end"))
+    _, root = next(context)
+    for event, element in context:
+        if event == "end" and strip_namespace(element.tag) == "record":
+            yield element_to_record(element)
+            element.clear()
+            root.clear()
 
 
-def read_file(input_metadata_file, sample=None, **kwargs):
-    # type: (FilePath, Optional[int], **Any) -> List[PymarcRecord]
+def read_marc_json(input_file, **kwargs):
+    # type: (FilePath, **Any) -> Iterator[PymarcRecord]
+    """Incrementally decode a JSON array of records, one object at a time.
+
+    A record split across reads is retried with a read twice as large each
+    time, so a record that never decodes costs linear, not quadratic, work
+    before the error is raised at the end of the file.
+    """
+    decoder = json.JSONDecoder(strict=False)
+    with open(input_file, "r", encoding="utf-8") as f:
+        buffer = ""
+        offset = 0
+        read_size = JSON_READ_SIZE
+        while True:
+            stripped = buffer.lstrip(JSON_SEPARATORS)
+            offset += len(buffer) - len(stripped)
+            buffer = stripped
+            if buffer.startswith("]"): return
+            try: data, end = decoder.raw_decode(buffer)
+            except ValueError as e:
+                chunk = f.read(read_size)
+                if not chunk:
+                    raise ValueError("Malformed JSON record in %s at character %d: %s" % (input_file, offset, e))
+                buffer += chunk
+                read_size *= 2
+                continue
+            yield json_to_record(data)
+            buffer = buffer[end:]
+            offset += end
+            read_size = JSON_READ_SIZE
+
+
+def read_file(input_metadata_file, sample=None, stream=True, **kwargs):
+    # type: (FilePath, Optional[int], bool, **Any) -> Union[Iterator[PymarcRecord], List[PymarcRecord]]
+    """Read records lazily from any supported format (set stream=False to materialise a list)."""
     file_type = get_file_type(input_metadata_file)
     if file_type == FileType.MARC: records = read_marc(input_metadata_file)
     elif file_type == FileType.XML: records = read_marc_xml(input_metadata_file)
     elif file_type == FileType.JSON: records = read_marc_json(input_metadata_file)
     else: raise NotImplementedError
-    if sample is not None: records = sample_items(records, sample)
+    if sample: records = sample_items(records, sample)
+    if not stream: records = list(records)
     return records
 
 
@@ -13,7 +13,7 @@ standard_library.install_aliases()
 ##########################################################
 # Standard Library Imports
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
 import logging
 import os
 
@@ -29,7 +29,7 @@ import yaml
 ##########################################################
 # Typing Configuration
 
-from typing import Text, Any, Dict, Tuple, Optional, Union, AnyStr
+from typing import Text, Any, Dict, List, Tuple, Optional, Union, AnyStr
 FilePath = Text
 Tag = Dict[AnyStr, Optional[AnyStr]]
 PymarcField = Any
@@ -46,15 +46,34 @@ logger = logging.getLogger(__name__)
 CURRENT_FILE_DIR, _ = os.path.split(__file__)
 INTERNAL_MARC_LOADER_PATH = "%s/../_config/marc.yaml" % CURRENT_FILE_DIR
 
+##########################################################
+# Classes
+
+LoaderPlan = namedtuple("LoaderPlan", [
+    "table_name", # table the loader writes to
+    "columns", # ((column, field, subfield), ...) read from MARC tags
+    "constants", # ((column, value), ...)
+    "references", # ((column, table_name), ...) uuids of enclosing rows
+    "generated", # ((field, ((subfield, column), ...)), ...) written back on export
+    "group_field", # tag whose repeated fields each produce a row, if any
+    "children", # (LoaderPlan, ...)
+])
+
+_compiled_plans = {} # type: Dict[FilePath, LoaderPlan]
+
 ##########################################################
 # Functions
 
 
-def load_config_file(loader_config_file):
-    if os.path.exists(loader_config_file):
-        return _load_config_file(loader_config_file)
-    else: 
-        return _load_config_file(INTERNAL_MARC_LOADER_PATH)
+def load_config_file(loader_config_file=None):
+    # type: (Optional[FilePath]) -> LoaderPlan
+    """Load and compile a loader config, once per path per process."""
+    if loader_config_file is None or not os.path.exists(loader_config_file):
+        loader_config_file = INTERNAL_MARC_LOADER_PATH
+    if loader_config_file not in _compiled_plans:
+        loader_map, loader_config = _load_config_file(loader_config_file)
+        _compiled_plans[loader_config_file] = compile_loader(loader_map, loader_config)
+    return _compiled_plans[loader_config_file]
 
 
 def _load_config_file(loader_config_file):
@@ -68,6 +87,41 @@ def _load_config_file(loader_config_file):
         return loader_map, loader_config
 
 
+def compile_loader(loader, config, table_name="record"):
+    # type: (Dict[AnyStr, Any], Dict[AnyStr, Any], AnyStr) -> LoaderPlan
+    """Compile a loader mapping into an immutable plan so records can be parsed without string handling."""
+    columns, constants, references = [], [], [] # type: List[Any], List[Any], List[Any]
+    generated = defaultdict(list) # type: Dict[AnyStr, List[Tuple[AnyStr, AnyStr]]]
+    for k, v in loader.items():
+        if k.startswith(config["TABLE_PREFIX"]): continue
+        column = k.split(config["TABLE_DELIMITER"])[-1]
+        tag = split_tag_key(str(v), config["TAG_DELIMITER"])
+        if k.startswith(config["GENERATED_FIELD_PREFIX"]):
+            if tag is not None:
+                codes = generated[tag["field"]]
+                if tag["subfield"] is not None: codes.append((tag["subfield"], column))
+        elif str(v).startswith(config["TABLE_PREFIX"]):
+            references.append((column, str(v).replace(config["TABLE_PREFIX"], "").lower()))
+        elif config["TAG_DELIMITER"] in str(v):
+            if tag is None: constants.append((column, None))
+            else: columns.append((column, tag["field"], tag["subfield"]))
+        else: constants.append((column, v))
+    fields = set(field for _, field, _ in columns)
+    children = [] # type: List[LoaderPlan]
+    for child_table, sub_loaders in get_loaders(loader, config).items():
+        for sub_loader in sub_loaders:
+            children.append(compile_loader(sub_loader, config, table_name=child_table))
+    return LoaderPlan(
+        table_name=table_name,
+        columns=tuple(columns),
+        constants=tuple(constants),
+        references=tuple(references),
+        generated=tuple((field, tuple(codes)) for field, codes in generated.items()),
+        group_field=fields.pop() if len(fields) == 1 else None,
+        children=tuple(children),
+    )
+
+
 def get_loaders(loader, config):
     # type: (Dict[AnyStr, Any], Dict[AnyStr, Any]) -> Dict[AnyStr, Any]
     loaders = defaultdict(list) # type: Dict[AnyStr, Any]
@@ -93,12 +147,9 @@ def get_subfield_from_record(record, field_key, subfield_key):
     return subfield
 
 
-def get_subfield_from_tag(record_or_field, tag_key, tag_delimiter="$"):
-    # type: (Union[PymarcRecord, PymarcField], AnyStr, AnyStr) -> Optional[AnyStr]
-    tag = split_tag_key(tag_key, tag_delimiter)
-    if tag is None: return None
-    field_key = tag["field"]
-    subfield_key = tag["subfield"]
+def get_subfield(record_or_field, field_key, subfield_key):
+    # type: (Union[PymarcRecord, PymarcField], Optional[AnyStr], Optional[AnyStr]) -> Optional[AnyStr]
+    """Look up a pre-split tag on a record or field."""
     if isinstance(record_or_field, pymarc.Record):
         if field_key is None or subfield_key is None: return None
         return get_subfield_from_record(record_or_field, field_key, subfield_key)
@@ -108,6 +159,13 @@ def get_subfield_from_tag(record_or_field, tag_key, tag_delimiter="$"):
     else: return None
 
 
+def get_subfield_from_tag(record_or_field, tag_key, tag_delimiter="$"):
+    # type: (Union[PymarcRecord, PymarcField], AnyStr, AnyStr) -> Optional[AnyStr]
+    tag = split_tag_key(tag_key, tag_delimiter)
+    if tag is None: return None
+    return get_subfield(record_or_field, tag["field"], tag["subfield"])
+
+
 def split_tag_key(tag_key, tag_delimiter="$"):
     # type: (AnyStr, AnyStr) -> Optional[Dict[AnyStr, Any]]
     """Split tag into a tuple of the field and subfield."""
@@ -30,7 +30,7 @@ from thickshake.utils import open_file, get_file_type, sample_items, FileType
 ##########################################################
 # Typing Configuration
 
-from typing import Text, Any, List, Union, Dict, Callable, Optional, AnyStr
+from typing import Text, Any, List, Iterable, Union, Dict, Callable, Optional, AnyStr
 
 FilePath = Text
 File = Any
@@ -49,7 +49,7 @@ logger = logging.getLogger(__name__)
 
 
 def _write_file(records, output_file, writer, force=False, dry_run=False, sample=0, **kwargs):
-    # type: (List[PymarcRecord], FilePath, Any, bool, bool, int, **Any) -> None
+    # type: (Iterable[PymarcRecord], FilePath, Any, bool, bool, int, **Any) -> None
     if not force and os.path.exists(output_file): raise IOError
     records = sample_items(records, sample)
     for record in tqdm(records, desc="Writing Records"):
@@ -58,7 +58,7 @@ def _write_file(records, output_file, writer, force=False, dry_run=False, sample
 
 
 def write_file(records, output_file, **kwargs):
-    # type: (List[PymarcRecord], FilePath, **Any) -> None
+    # type: (Iterable[PymarcRecord], FilePath, **Any) -> None
     file_type = get_file_type(output_file)
     if file_type == FileType.MARC: writer = MARCWriter(open_file(output_file, "wb+"))
     elif file_type == FileType.XML: writer = XMLWriter(open_file(output_file, "wb+"))
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""
+"""
+##########################################################
+# Python Compatibility
+
+from __future__ import print_function, division, absolute_import
+from builtins import dict
+from future import standard_library
+standard_library.install_aliases()
+
+##########################################################
+# Standard Library Imports
+
+from collections import defaultdict, OrderedDict
+import logging
+
+##########################################################
+# Third Party Imports
+
+##########################################################
+# Local Imports
+
+##########################################################
+# Typing Configuration
+
+from typing import Optional, Dict, Tuple, Iterable, Any, AnyStr
+Key = Tuple[Any, ...]
+
+##########################################################
+# Logging Configuration
+
+logger = logging.getLogger(__name__)
+
+##########################################################
+# Classes
+
+
+class IdentityCache(object):
+    """Per-table LRU map from natural keys to uuids.
+
+    Entries written inside a session are staged until the session commits,
+    so a rollback never leaves uuids for rows that do not exist.
+    """
+
+    def __init__(self, max_size=100000):
+        # type: (int) -> None
+        self.max_size = max_size
+        self.entries = defaultdict(OrderedDict) # type: Dict[AnyStr, OrderedDict]
+        self.pending = defaultdict(dict) # type: Dict[AnyStr, Dict[Key, int]]
+        self.hits = 0
+        self.misses = 0
+
+
+    def get(self, table_name, key):
+        # type: (AnyStr, Key) -> Optional[int]
+        uuid = self.pending[table_name].get(key)
+        if uuid is None:
+            entries = self.entries[table_name]
+            uuid = entries.get(key)
+            if uuid is not None: entries.move_to_end(key)
+        if uuid is None: self.misses += 1
+        else: self.hits += 1
+        return uuid
+
+
+    def put(self, table_name, key, uuid):
+        # type: (AnyStr, Key, Optional[int]) -> None
+        if uuid is None or any(k is None for k in key): return None
+        self.pending[table_name][key] = uuid
+
+
+    def warm(self, table_name, items):
+        # type: (AnyStr, Iterable[Tuple[Key, int]]) -> None
+        entries = self.entries[table_name]
+        for key, uuid in items:
+            entries[key] = uuid
+            if len(entries) > self.max_size: entries.popitem(last=False)
+
+
+    def commit(self):
+        # type: () -> None
+        for table_name, pending in self.pending.items():
+            self.warm(table_name, pending.items())
+        self.pending.clear()
+
+
+    def rollback(self):
+        # type: () -> None
+        self.pending.clear()
+
+
+    def invalidate(self, table_name=None):
+        # type: (Optional[AnyStr]) -> None
+        if table_name is None:
+            self.entries.clear()
+            self.pending.clear()
+        else:
+            self.entries.pop(table_name, None)
+            self.pending.pop(table_name, None)
+
+
+##########################################################
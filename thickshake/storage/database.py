@@ -13,7 +13,7 @@ standard_library.install_aliases()
 ##########################################################
 # Standard Library Imports
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from contextlib import contextmanager
 import logging
 
@@ -22,7 +22,8 @@ import logging
 
 from envparse import env
 import pandas as pd
-from sqlalchemy import create_engine, text, func, inspect
+from sqlalchemy import create_engine, text, func, inspect, bindparam
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.engine import url
 from sqlalchemy.exc import IntegrityError, DataError
 from sqlalchemy.orm import scoped_session, sessionmaker, load_only
@@ -31,7 +32,8 @@ from tqdm import tqdm
 ##########################################################
 # Local Imports
 
-from thickshake.storage.schema import Base
+from thickshake.storage.cache import IdentityCache
+from thickshake.storage.schema import Base, AGGREGATE_COUNTS
 from thickshake.utils import maybe_make_directory, Borg
 
 ##########################################################
@@ -64,6 +66,9 @@ DB_CONFIG["database"] = env.str("POSTGRES_DB", default="thickshake")
 DB_CONFIG["username"] = env.str("POSTGRES_USER", default="postgres")
 DB_CONFIG["password"] = env.str("POSTGRES_PASSWORD", default="thickshake")
 
+BULK_SELECT_SIZE = 500 # keep IN (...) lists under SQLite's bound parameter limit
+IDENTITY_CACHE_SIZE = env.int("DB_IDENTITY_CACHE_SIZE", default=100000) # entries per table
+
 ##########################################################
 # Initializations
 
@@ -77,16 +82,21 @@ class Database(Borg):
     engine = None
     session = None
     base = None
+    identity_cache = None
+    unique_columns = None
 
-    def __init__(self, db_config=DB_CONFIG, force=False, **kwargs):
-        # type: (DBConfig, bool, **Any) -> None
+    def __init__(self, db_config=DB_CONFIG, force=False, identity_cache_size=IDENTITY_CACHE_SIZE, **kwargs):
+        # type: (DBConfig, bool, int, **Any) -> None
         Borg.__init__(self)
         if self.engine is None:
             self.engine = self.make_engine(db_config, **kwargs)
             self.base = Base
+            self.identity_cache = IdentityCache(max_size=identity_cache_size)
+            self.unique_columns = {}
             if force: self.remove_db_tables()
             self.make_db_tables()
-            
+            if identity_cache_size: self.warm_identity_cache()
+
 
     def make_engine(self, db_config, verbosity="INFO", **kwargs):
         # type: (DBConfig, AnyStr, **Any) -> DBEngine
@@ -108,6 +118,8 @@ class Database(Borg):
         # type: () -> None
         self.base.metadata.reflect(self.engine)
         self.base.metadata.drop_all(self.engine)
+        self.identity_cache.invalidate()
+        self.unique_columns.clear()
 
 
     @contextmanager
@@ -117,47 +129,208 @@ class Database(Borg):
         self.session = scoped_session(Session)
         try:
             yield self.session
-            if not dry_run: self.session.commit()
+            if not dry_run:
+                self.session.commit()
+                self.identity_cache.commit()
+            else: self.identity_cache.rollback()
         except IntegrityError as e:
             self.session.rollback()
+            self.identity_cache.rollback()
             raise e
         except BaseException:
             self.session.rollback()
+            self.identity_cache.rollback()
             raise
         finally:
             self.session.close()
 
 
+    def warm_identity_cache(self):
+        # type: () -> None
+        """Pre-load natural key to uuid mappings for every table with unique columns."""
+        if self.engine is None: return None
+        with self.manage_db_session() as session:
+            for table_name in self.get_sorted_table_names():
+                unique_columns = self.get_unique_columns(table_name)
+                if not unique_columns: continue
+                table = self.base.metadata.tables[table_name]
+                q = session.query(table.c.uuid, *[table.c[c] for c in unique_columns])
+                q = q.order_by(table.c.uuid.desc()).limit(self.identity_cache.max_size)
+                self.identity_cache.warm(table_name, reversed([(tuple(row[1:]), row[0]) for row in q]))
+
+
     def merge_record(self, table_name, parsed_record, foreign_keys, **kwargs):
         # type: (AnyStr, Dict[AnyStr, Any], Dict[AnyStr, AnyStr], **Any) -> DBObject
         model = self.get_class_by_table_name(table_name)
         db_object = model(**parsed_record)
+        unique_columns = self.get_unique_columns(table_name)
+        key = tuple(parsed_record.get(col) for col in unique_columns)
+        cached_uuid = self.identity_cache.get(table_name, key) if unique_columns else None
         try: 
             if foreign_keys[table_name] and foreign_keys[table_name][-1] is not None:
                 db_object.uuid = foreign_keys[table_name][-1]
                 self.session.merge(db_object)
+            elif cached_uuid is not None:
+                db_object.uuid = cached_uuid
+                self.session.merge(db_object)
             else:
                 if not parsed_record or all(v is None for v in parsed_record.values()): return None
                 self.session.add(db_object)
             self.session.flush()
         except IntegrityError as e:
             self.session.rollback()
+            self.identity_cache.rollback()
             if not parsed_record or all(v is None for v in parsed_record.values()): return None
             try: 
                 self.session.merge(db_object)
                 self.session.flush()
             except IntegrityError as e:
                 self.session.rollback()
-                unique_columns = self.get_unique_columns(table_name)
+                self.identity_cache.rollback()
                 q = self.session.query(model)
                 for col in unique_columns:
                     try: q = q.filter(getattr(model, col).like(getattr(db_object, col)))
                     except: q = q.filter(getattr(model, col) == getattr(db_object, col))
                 matched_obj = q.first()
                 db_object = matched_obj
+        if unique_columns and db_object is not None:
+            self.identity_cache.put(table_name, key, db_object.uuid)
         return db_object
 
 
+    def get_sorted_table_names(self):
+        # type: () -> List[AnyStr]
+        """Table names ordered so that referenced tables come first."""
+        return [table.name for table in self.base.metadata.sorted_tables]
+
+
+    def get_merge_keys(self, table_name):
+        # type: (AnyStr) -> Tuple[List[AnyStr], bool]
+        """Natural key for merging rows, and whether the database enforces it."""
+        table = self.base.metadata.tables[table_name]
+        unique_columns = self.get_unique_columns(table_name)
+        if unique_columns: return unique_columns, True
+        pk_columns = [c.name for c in table.primary_key.columns if c.name != "uuid"]
+        return pk_columns, False
+
+
+    def get_required_columns(self, table_name):
+        # type: (AnyStr) -> List[AnyStr]
+        table = self.base.metadata.tables[table_name]
+        return [
+            c.name for c in table.columns
+            if not c.nullable and c.default is None and c.server_default is None
+            and not (c.primary_key and c.autoincrement is True)
+        ]
+
+
+    def bulk_merge_records(self, table_name, records, **kwargs):
+        # type: (AnyStr, List[Dict[AnyStr, Any]], **Any) -> List[Optional[int]]
+        """Insert or update many records in the current session, returning their uuids in input order."""
+        table = self.base.metadata.tables[table_name]
+        key_columns, is_constrained = self.get_merge_keys(table_name)
+        required_columns = self.get_required_columns(table_name)
+        keyed = OrderedDict() # type: Dict[Tuple[Any, ...], Dict[AnyStr, Any]]
+        keyless = [] # type: List[Dict[AnyStr, Any]]
+        positions = [] # type: List[Any]
+        for record in records:
+            if any(record.get(c) is None for c in required_columns):
+                positions.append(None)
+                continue
+            key = tuple(record.get(c) for c in key_columns)
+            if not key_columns or any(k is None for k in key):
+                positions.append(len(keyless))
+                keyless.append(record)
+            else:
+                positions.append(key)
+                merged = keyed.setdefault(key, {})
+                merged.update({k: v for k, v in record.items() if v is not None})
+        key_uuids = self._merge_keyed_records(table, key_columns, is_constrained, list(keyed.values()))
+        for key, uuid in key_uuids.items():
+            self.identity_cache.put(table_name, key, uuid)
+        keyless_uuids = self._insert_keyless_records(table, keyless)
+        uuids = [] # type: List[Optional[int]]
+        for position in positions:
+            if position is None: uuids.append(None)
+            elif isinstance(position, tuple): uuids.append(key_uuids.get(position))
+            else: uuids.append(keyless_uuids[position])
+        return uuids
+
+
+    def _merge_keyed_records(self, table, key_columns, is_constrained, records):
+        # type: (Any, List[AnyStr], bool, List[Dict[AnyStr, Any]]) -> Dict[Tuple[Any, ...], int]
+        if not records: return {}
+        columns = sorted(set(c for record in records for c in record))
+        value_columns = [c for c in columns if c not in key_columns]
+        rows = [{c: record.get(c) for c in columns} for record in records]
+        if is_constrained and self.engine.dialect.name == "postgresql":
+            stmt = pg_insert(table).values(rows)
+            update_values = {c: func.coalesce(stmt.excluded[c], table.c[c]) for c in value_columns}
+            update_values["modified_at"] = func.now()
+            stmt = stmt.on_conflict_do_update(index_elements=key_columns, set_=update_values)
+            stmt = stmt.returning(table.c.uuid, *[table.c[c] for c in key_columns])
+            return {tuple(row[1:]): row[0] for row in self.session.execute(stmt)}
+        keys = [tuple(row[c] for c in key_columns) for row in rows]
+        key_uuids = {} # type: Dict[Tuple[Any, ...], int]
+        for key in keys:
+            uuid = self.identity_cache.get(table.name, key)
+            if uuid is not None: key_uuids[key] = uuid
+        key_uuids.update(self._select_uuids(table, key_columns, [k for k in keys if k not in key_uuids]))
+        existing_rows = [row for key, row in zip(keys, rows) if key in key_uuids]
+        new_rows = [row for key, row in zip(keys, rows) if key not in key_uuids]
+        if existing_rows and value_columns:
+            stmt = table.update().where(table.c.uuid == bindparam("_uuid"))
+            stmt = stmt.values({c: func.coalesce(bindparam("_%s" % c), table.c[c]) for c in value_columns})
+            params = [
+                dict({"_%s" % c: row[c] for c in value_columns}, _uuid=key_uuids[tuple(row[c] for c in key_columns)])
+                for row in existing_rows
+            ]
+            self.session.execute(stmt, params)
+        if new_rows:
+            self.session.execute(table.insert(), new_rows)
+            new_keys = [tuple(row[c] for c in key_columns) for row in new_rows]
+            key_uuids.update(self._select_uuids(table, key_columns, new_keys))
+        return key_uuids
+
+
+    def _select_uuids(self, table, key_columns, keys):
+        # type: (Any, List[AnyStr], List[Tuple[Any, ...]]) -> Dict[Tuple[Any, ...], int]
+        if not keys: return {}
+        key_set = set(keys)
+        first_values = sorted(set(key[0] for key in keys), key=str)
+        columns = [table.c.uuid] + [table.c[c] for c in key_columns]
+        key_uuids = {} # type: Dict[Tuple[Any, ...], int]
+        for i in range(0, len(first_values), BULK_SELECT_SIZE):
+            chunk = first_values[i:i + BULK_SELECT_SIZE]
+            q = self.session.query(*columns).filter(table.c[key_columns[0]].in_(chunk))
+            for row in q:
+                key = tuple(row[1:])
+                if key in key_set: key_uuids[key] = row[0]
+        return key_uuids
+
+
+    def _insert_keyless_records(self, table, records):
+        # type: (Any, List[Dict[AnyStr, Any]]) -> List[int]
+        if not records: return []
+        columns = sorted(set(c for record in records for c in record))
+        rows = [{c: record.get(c) for c in columns} for record in records]
+        if self.engine.dialect.name == "postgresql":
+            stmt = table.insert().values(rows).returning(table.c.uuid)
+            return [row[0] for row in self.session.execute(stmt)]
+        return [self.session.execute(table.insert().values(row)).inserted_primary_key[0] for row in rows]
+
+
+    def refresh_counts(self, **kwargs):
+        # type: (**Any) -> None
+        """Recompute aggregated relationship counts after bulk writes bypass the ORM."""
+        with self.manage_db_session(**kwargs) as session:
+            for table_name, count_column, child_table, child_column in AGGREGATE_COUNTS:
+                sql_text =  "UPDATE %s SET %s = (\n" % (table_name, count_column)
+                sql_text += "SELECT COUNT(*) FROM %s\n" % child_table
+                sql_text += "WHERE %s.%s = %s.uuid)\n" % (child_table, child_column, table_name)
+                session.execute(text(sql_text))
+
+
     def get_records(self, table_name="record", **kwargs):
         # type: (AnyStr, **Any) -> List[DBObject]
         model = self.get_class_by_table_name(table_name)
@@ -184,9 +357,12 @@ class Database(Borg):
 
     def get_unique_columns(self, table_name):
         # type: (AnyStr) -> List[AnyStr]
-        insp = inspect(self.engine)
-        unique_constraints = insp.get_unique_constraints(table_name)
-        return [unique_constraint["column_names"][0] for unique_constraint in unique_constraints]
+        """Unique columns of a table, reflected once per process."""
+        if table_name not in self.unique_columns:
+            insp = inspect(self.engine)
+            unique_constraints = insp.get_unique_constraints(table_name)
+            self.unique_columns[table_name] = [uc["column_names"][0] for uc in unique_constraints]
+        return self.unique_columns[table_name]
 
     def get_relationships(self, table_name):
         # type: (AnyStr) -> List[Any]
@@ -218,17 +394,53 @@ class Database(Borg):
         result = self.execute_text_query(sql_text, **kwargs)
         return result
 
-    def load_columns(self, table, columns, **kwargs):
-        # type: (AnyStr, List[AnyStr], **Any) -> DataFrame
+    def count_records(self, table_name):
+        # type: (AnyStr) -> int
         with self.manage_db_session() as session:
-            model = self.get_class_by_table_name(table)
-            result = session.query(model).all()
-            pk = self.get_primary_keys(model=model)
-            records = [record.__dict__ for record in result]
-            df = pd.DataFrame(data=records)
-            df.set_index(keys=pk, inplace=True, drop=False)
-            df = df[columns]
-            return df
+            model = self.get_class_by_table_name(table_name)
+            return session.query(func.count('*')).select_from(model).scalar()
+
+
+    def load_columns(self, table, columns, chunk_size=None, sample=0, **kwargs):
+        # type: (AnyStr, List[AnyStr], Optional[int], int, **Any) -> Union[DataFrame, Iterator[DataFrame]]
+        """Select the primary key and requested columns, as one DataFrame or (given chunk_size) an iterator of chunks."""
+        chunks = self.iter_columns(table, columns, chunk_size=chunk_size or BULK_SELECT_SIZE, sample=sample)
+        if chunk_size is not None: return chunks
+        frames = list(chunks)
+        if frames: return pd.concat(frames)
+        return self._make_column_frame(table, columns, [])
+
+
+    def iter_columns(self, table, columns, chunk_size=BULK_SELECT_SIZE, sample=0):
+        # type: (AnyStr, List[AnyStr], int, int) -> Iterator[DataFrame]
+        """Page through a table by uuid so no read transaction stays open while chunks are processed."""
+        model = self.get_class_by_table_name(table)
+        pk = self.get_primary_keys(model=model)
+        selected = [getattr(model, c) for c in pk + [c for c in columns if c not in pk]]
+        if sample:
+            with self.manage_db_session() as session:
+                rows = session.query(*selected).order_by(func.random()).limit(sample).all()
+            for i in range(0, len(rows), chunk_size):
+                yield self._make_column_frame(table, columns, rows[i:i + chunk_size])
+            return
+        last_uuid = None
+        while True:
+            with self.manage_db_session() as session:
+                q = session.query(*selected).order_by(model.uuid)
+                if last_uuid is not None: q = q.filter(model.uuid > last_uuid)
+                rows = q.limit(chunk_size).all()
+            if not rows: return
+            last_uuid = rows[-1].uuid
+            yield self._make_column_frame(table, columns, rows)
+
+
+    def _make_column_frame(self, table, columns, rows):
+        # type: (AnyStr, List[AnyStr], List[Any]) -> DataFrame
+        pk = self.get_primary_keys(table_name=table)
+        selected = pk + [c for c in columns if c not in pk]
+        df = pd.DataFrame.from_records(rows, columns=selected)
+        df.set_index(keys=pk, inplace=True, drop=False)
+        return df[columns]
 
 
     def get_remote_fk_name(self, input_table, output_table):
@@ -241,25 +453,70 @@ class Database(Borg):
         return None
 
 
-    def save_record(self, input_table, output_table, output_map, data, **kwargs):
+    def bulk_update_records(self, table_name, records, **kwargs):
+        # type: (AnyStr, List[Dict[AnyStr, Any]], **Any) -> None
+        """Update many rows by uuid in the current session."""
+        groups = defaultdict(list) # type: Dict[Tuple[AnyStr, ...], List[Dict[AnyStr, Any]]]
+        for record in records:
+            if record.get("uuid") is None: continue
+            groups[tuple(sorted(c for c in record if c != "uuid"))].append(record)
+        table = self.base.metadata.tables[table_name]
+        for columns, rows in groups.items():
+            if not columns: continue
+            for i in range(0, len(rows), BULK_SELECT_SIZE):
+                chunk = rows[i:i + BULK_SELECT_SIZE]
+                if self.engine.dialect.name == "postgresql":
+                    self._update_from_values(table, list(columns), chunk)
+                else:
+                    stmt = table.update().where(table.c.uuid == bindparam("_uuid"))
+                    stmt = stmt.values({c: bindparam("_%s" % c) for c in columns})
+                    params = [dict({"_%s" % c: row[c] for c in columns}, _uuid=row["uuid"]) for row in chunk]
+                    self.session.execute(stmt, params)
+
+
+    def _update_from_values(self, table, columns, rows):
+        # type: (Any, List[AnyStr], List[Dict[AnyStr, Any]]) -> None
+        all_columns = ["uuid"] + columns
+        types = [table.c[c].type.compile(dialect=self.engine.dialect) for c in all_columns]
+        params = {} # type: Dict[AnyStr, Any]
+        values = []
+        for i, row in enumerate(rows):
+            placeholders = []
+            for j, (column, column_type) in enumerate(zip(all_columns, types)):
+                params["p%i_%i" % (i, j)] = row[column]
+                placeholders.append("CAST(:p%i_%i AS %s)" % (i, j, column_type))
+            values.append("(%s)" % ", ".join(placeholders))
+        sql_text =  "UPDATE %s SET %s, modified_at = now()\n" % (table.name, ", ".join("%s = v.%s" % (c, c) for c in columns))
+        sql_text += "FROM (VALUES %s) AS v (%s)\n" % (", ".join(values), ", ".join(all_columns))
+        sql_text += "WHERE %s.uuid = v.uuid\n" % table.name
+        self.session.execute(text(sql_text), params)
+
+
+    def save_records(self, input_table, output_table, output_map, data, **kwargs):
         # type: (AnyStr, AnyStr, Dict[AnyStr, AnyStr], DataFrame, **Any) -> None
-        data.reset_index(drop=False, inplace=True)
-        data.rename(columns=output_map, inplace=True)
-        new_columns = list(output_map.values())
-        data = data.where((pd.notnull(data)), None)
+        """Write parser output for many input rows in one transaction."""
+        if data.empty: return None
+        # Output maps key the input row's uuid as "index", whatever the parser named its index.
+        data = data.rename_axis("index").reset_index(drop=False)
+        data = data.rename(columns=output_map)
+        data = data[[c for c in output_map.values() if c in data.columns]]
         data = data.astype('object')
-        record = data.squeeze().to_dict()
-        foreign_keys = defaultdict(list) # type: Dict[AnyStr, Any]
-        remote_fk_value = None
-        with self.manage_db_session() as session:
-            db_object = self.merge_record(output_table, record, foreign_keys, **kwargs)
-            if hasattr(db_object, "uuid"): remote_fk_value = db_object.uuid
-        if input_table != output_table and remote_fk_value is not None:
-            with self.manage_db_session() as session:
-                local_fk_value = record["%s_uuid" % input_table]
-                remote_fk_name = self.get_remote_fk_name(input_table, output_table)
-                record = {"uuid": local_fk_value, remote_fk_name: remote_fk_value}
-                self.merge_record(input_table, record, foreign_keys, **kwargs)
+        data = data.where((pd.notnull(data)), None)
+        records = data.to_dict("records")
+        with self.manage_db_session(**kwargs) as session:
+            if input_table == output_table:
+                self.bulk_update_records(output_table, records, **kwargs)
+                return None
+            local_fk_name = "%s_uuid" % input_table
+            local_fk_values = [record.pop(local_fk_name) for record in records]
+            remote_fk_values = self.bulk_merge_records(output_table, records, **kwargs)
+            remote_fk_name = self.get_remote_fk_name(input_table, output_table)
+            updates = [
+                {"uuid": local_fk_value, remote_fk_name: remote_fk_value}
+                for local_fk_value, remote_fk_value in zip(local_fk_values, remote_fk_values)
+                if remote_fk_value is not None
+            ]
+            self.bulk_update_records(input_table, updates, **kwargs)
 
 
     def inspect_database(self):
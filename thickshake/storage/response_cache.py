@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+#!/usr/bin/env python
+"""
+"""
+##########################################################
+# Python Compatibility
+
+from __future__ import print_function, division, absolute_import
+from builtins import dict, str
+from future import standard_library
+standard_library.install_aliases()
+
+##########################################################
+# Standard Library Imports
+
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+
+##########################################################
+# Third Party Imports
+
+##########################################################
+# Local Imports
+
+from thickshake.utils import maybe_make_directory
+
+##########################################################
+# Typing Configuration
+
+from typing import Text, Any, Dict, List, Optional, Tuple, AnyStr
+FilePath = Text
+Payload = Dict[AnyStr, Any]
+Response = Optional[Dict[AnyStr, Any]]
+
+##########################################################
+# Logging Configuration
+
+logger = logging.getLogger(__name__)
+
+##########################################################
+# Classes
+
+
+class ResponseCache(object):
+    """SQLite-backed cache of JSON responses, keyed on a normalised request payload.
+
+    A response of None is a negative entry (the service had no answer) and
+    expires after negative_ttl rather than ttl.
+    """
+
+    def __init__(self, cache_path, ttl=2592000, negative_ttl=86400, ignore_keys=None):
+        # type: (FilePath, int, int, List[AnyStr]) -> None
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.ignore_keys = set(ignore_keys or [])
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if os.path.dirname(cache_path): maybe_make_directory(cache_path)
+        self.connection = sqlite3.connect(cache_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, response TEXT, created_at REAL NOT NULL)"
+        )
+
+
+    def make_key(self, payload):
+        # type: (Payload) -> AnyStr
+        normalised = {}
+        for key, value in payload.items():
+            if key in self.ignore_keys: continue
+            if isinstance(value, str): value = re.sub(r"\s+", " ", value).strip().lower()
+            normalised[key] = value
+        return json.dumps(normalised, sort_keys=True, separators=(",", ":"))
+
+
+    def get(self, payload):
+        # type: (Payload) -> Tuple[bool, Response]
+        """Return (found, response); expired entries count as not found."""
+        key = self.make_key(payload)
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT response, created_at FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+        if row is not None:
+            response_text, created_at = row
+            ttl = self.ttl if response_text is not None else self.negative_ttl
+            if time.time() - created_at < ttl:
+                self.hits += 1
+                return True, json.loads(response_text) if response_text is not None else None
+        self.misses += 1
+        return False, None
+
+
+    def put(self, payload, response):
+        # type: (Payload, Response) -> None
+        key = self.make_key(payload)
+        response_text = json.dumps(response) if response is not None else None
+        with self.lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at) VALUES (?, ?, ?)",
+                (key, response_text, time.time())
+            )
+
+
+    def purge_expired(self):
+        # type: () -> int
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.execute(
+                "DELETE FROM responses WHERE (response IS NOT NULL AND created_at < ?) OR (response IS NULL AND created_at < ?)",
+                (now - self.ttl, now - self.negative_ttl)
+            )
+        return cursor.rowcount
+
+
+    def close(self):
+        # type: () -> None
+        with self.lock:
+            self.connection.close()
+
+
+##########################################################
@@ -228,6 +228,23 @@ class RecordTopic(Base):
     topic = relationship("Topic", lazy="joined")
 
 
+##########################################################
+# Aggregates
+
+# (table, count column, child table, child foreign key), refreshed after bulk loads
+AGGREGATE_COUNTS = [
+    ("record", "image_count", "image", "record_uuid"),
+    ("record", "subject_count", "record_subject", "record_uuid"),
+    ("record", "topic_count", "record_topic", "record_uuid"),
+    ("subject", "record_count", "record_subject", "subject_uuid"),
+    ("subject", "image_count", "image_subject", "subject_uuid"),
+    ("image", "subject_count", "image_subject", "image_uuid"),
+    ("location", "image_count", "image", "location_uuid"),
+    ("location", "record_count", "record", "location_uuid"),
+    ("topic", "record_count", "record_topic", "topic_uuid"),
+]
+
+
 ##########################################################
 
 
@@ -18,6 +18,8 @@ import logging
 # Third Party Imports
 
 from envparse import env
+import h5py
+import numpy as np
 import pandas as pd
 import tables
 
@@ -29,15 +31,22 @@ from thickshake.utils import Borg, maybe_make_directory
 ##########################################################
 # Typing Configuration
 
-from typing import Text, Any, Iterable, Dict, List, AnyStr
+from typing import Text, Any, Iterable, Dict, List, Optional, Tuple, AnyStr
 FilePath = Text
 Series = Any
 DataFrame = Any
+NPArray = Any
 
 ##########################################################
 # Constants
 
 STORE_PATH = env.str("STORE", default="/home/app/data/output/store.hdf5")
+ARRAY_CHUNK_ROWS = env.int("STORE_ARRAY_CHUNK_ROWS", default=1024)
+ARRAY_COMPLEVEL = env.int("STORE_ARRAY_COMPLEVEL", default=5)
+ARRAY_COPY_ROWS = 65536
+ARRAY_TMP_SUFFIX = "_tmp"
+FACE_EMBEDDINGS_PATH = "/faces/embeddings"
+FACE_STORE_INDEX = ["image_id", "box_number"]
 
 ##########################################################
 # Logging Configuration
@@ -57,6 +66,57 @@ def fix_unicode_columns(df):
     return df
 
 
+def map_array(store_path, array_path, mmap_mode="r"):
+    # type: (FilePath, AnyStr, AnyStr) -> Optional[NPArray]
+    """Map an array without copying it, or return None if it is chunked and cannot be mapped."""
+    with h5py.File(store_path, "r") as f:
+        dataset = f[array_path]
+        offset = dataset.id.get_offset()
+        if dataset.chunks is None and offset is not None:
+            return np.memmap(store_path, dtype=dataset.dtype, mode=mmap_mode, offset=offset, shape=dataset.shape)
+    logger.debug("%s is chunked; reading it into memory instead of mapping.", array_path)
+    return None
+
+
+def read_array(store_path, array_path, start=None, stop=None, mmap_mode=None):
+    # type: (FilePath, AnyStr, Optional[int], Optional[int], Optional[AnyStr]) -> NPArray
+    """Read an array in one contiguous read, or map it without copying if it is stored contiguously."""
+    if mmap_mode is not None:
+        array = map_array(store_path, array_path, mmap_mode)
+        if array is not None: return array[start:stop]
+    with tables.open_file(store_path, "r") as f:
+        node = f.get_node(array_path)
+        # PyTables reads a single row when only start is given.
+        if stop is None: stop = node.nrows
+        return node.read(start=start, stop=stop)
+
+
+def read_array_rows(store_path, array_path, rows):
+    # type: (FilePath, AnyStr, NPArray) -> NPArray
+    """Read the given increasing rows of an array, touching only the pages or chunks that hold them."""
+    array = map_array(store_path, array_path)
+    if array is not None: return np.asarray(array[rows])
+    with tables.open_file(store_path, "r") as f:
+        node = f.get_node(array_path)
+        return node[(rows.tolist(),) + (slice(None),) * (len(node.shape) - 1)]
+
+
+def split_face_id(face_id):
+    # type: (AnyStr) -> Tuple[AnyStr, AnyStr]
+    face_id_parts = face_id.split("_")
+    image_id = "_".join(face_id_parts[0:2])
+    box_number = face_id_parts[2]
+    return image_id, box_number
+
+
+def read_face_embeddings(store_path, embeddings_path=FACE_EMBEDDINGS_PATH, mmap_mode=None):
+    # type: (FilePath, AnyStr, Optional[AnyStr]) -> Tuple[List[AnyStr], NPArray]
+    """Return face ids and the (n_faces, 128) float32 embedding matrix, in the same row order."""
+    face_ids = [face_id.decode("utf-8") for face_id in read_array(store_path, embeddings_path + "/face_ids")]
+    embeddings = read_array(store_path, embeddings_path + "/vectors", mmap_mode=mmap_mode)
+    return face_ids, embeddings
+
+
 class Store(Borg):
     store_path = None
     write_mode = "a"
@@ -77,13 +137,75 @@ class Store(Borg):
         # type: (AnyStr, DataFrame, List[AnyStr], **Any) -> None
         df = fix_unicode_columns(df)
         with pd.HDFStore(self.store_path, "a") as store:
-            store.append(dataset_path, df, index=index, min_itemsize=50)
+            store.append(dataset_path, df, index=index, data_columns=index, min_itemsize=50)
+
+
+    def save_many(self, datasets, index, **kwargs):
+        # type: (Dict[AnyStr, DataFrame], List[AnyStr], **Any) -> None
+        """Append several datasets with a single open of the store file."""
+        with pd.HDFStore(self.store_path, "a") as store:
+            for dataset_path, df in datasets.items():
+                if df.empty: continue
+                store.append(dataset_path, fix_unicode_columns(df), index=index, data_columns=index, min_itemsize=50)
+
+
+    def append_arrays(self, arrays, chunk_rows=ARRAY_CHUNK_ROWS, complevel=ARRAY_COMPLEVEL, **kwargs):
+        # type: (Dict[AnyStr, NPArray], int, int, **Any) -> None
+        """Append rows to fixed-shape, chunked and compressed arrays, creating them on first write.
+
+        An array compacted by compact_array is first copied back into an
+        appendable one.
+        """
+        filters = tables.Filters(complevel=complevel, complib="zlib") if complevel else None
+        with tables.open_file(self.store_path, "a") as f:
+            for array_path, array in arrays.items():
+                if len(array) == 0: continue
+                if array_path in f and isinstance(f.get_node(array_path), tables.EArray):
+                    f.get_node(array_path).append(array)
+                    continue
+                where, name = array_path.rsplit("/", 1)
+                node = f.create_earray(
+                    where or "/", name + ARRAY_TMP_SUFFIX, atom=tables.Atom.from_dtype(array.dtype),
+                    shape=(0,) + array.shape[1:], filters=filters,
+                    chunkshape=(chunk_rows,) + array.shape[1:], createparents=True
+                )
+                if array_path in f:
+                    old_node = f.get_node(array_path)
+                    for start in range(0, old_node.nrows, ARRAY_COPY_ROWS):
+                        node.append(old_node.read(start, min(start + ARRAY_COPY_ROWS, old_node.nrows)))
+                    old_node.remove()
+                node.append(array)
+                node.rename(name)
+
+
+    def read_array(self, array_path, start=None, stop=None, mmap_mode=None):
+        # type: (AnyStr, Optional[int], Optional[int], Optional[AnyStr]) -> NPArray
+        return read_array(self.store_path, array_path, start=start, stop=stop, mmap_mode=mmap_mode)
+
+
+    def compact_array(self, array_path):
+        # type: (AnyStr) -> None
+        """Rewrite an array as a single contiguous, uncompressed block so it can be memory-mapped.
+
+        HDF5 does not reclaim the space of the array it replaces.
+        """
+        with tables.open_file(self.store_path, "a") as f:
+            if array_path not in f: return None
+            old_node = f.get_node(array_path)
+            if not isinstance(old_node, tables.EArray): return None
+            where, name = old_node._v_parent._v_pathname, old_node.name
+            node = f.create_array(where, name + ARRAY_TMP_SUFFIX, atom=old_node.atom, shape=old_node.shape)
+            for start in range(0, old_node.nrows, ARRAY_COPY_ROWS):
+                stop = min(start + ARRAY_COPY_ROWS, old_node.nrows)
+                node[start:stop] = old_node.read(start, stop)
+            old_node.remove()
+            node.rename(name)
 
 
     def contains(self, dataset_path):
         # type: (AnyStr) -> bool
-        with pd.HDFStore(self.store_path, 'r') as store:
-            return dataset_path in store and not store[dataset_path].shape is None
+        with tables.open_file(self.store_path, "r") as f:
+            return dataset_path in f
 
 
     def get_file(self):
@@ -19,6 +19,7 @@ import logging
 import os
 import random
 import shutil
+import threading
 import time
 
 ##########################################################
@@ -30,7 +31,7 @@ import time
 ##########################################################
 # Typing Configuration
 
-from typing import Text, Any, Dict, List, Optional, Callable, AnyStr
+from typing import Text, Any, Dict, List, Iterable, Optional, Callable, AnyStr
 
 FilePath = Text
 DirPath = Text
@@ -60,6 +61,33 @@ class Borg(object):
         self.__dict__ = self._shared_state
 
 
+class RateLimiter(object):
+    """Thread-safe token bucket: wait() blocks until a call is allowed under the rate."""
+
+    def __init__(self, rate=0, burst=None):
+        # type: (float, Optional[float]) -> None
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated_at = time.time()
+        self.lock = threading.Lock()
+
+
+    def wait(self):
+        # type: () -> None
+        if not self.rate: return
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
 ##########################################################
 # Functions
 
@@ -157,10 +185,28 @@ def generate_output_path(input_path, output_dir=None, sub_folder=None):
 
 
 def sample_items(items, sample=0, **kwargs):
-    # type: (List[Any], int, **Any) -> List[Any]
-    """Randomly samples a list of items."""
-    if sample == 0: return items
-    else: return random.sample(items, sample)
+    # type: (Iterable[Any], int, **Any) -> Iterable[Any]
+    """Randomly samples items from a list or stream (reservoir sampling)."""
+    if not sample: return items
+    reservoir = [] # type: List[Any]
+    for i, item in enumerate(items):
+        if i < sample: reservoir.append(item)
+        else:
+            j = random.randint(0, i)
+            if j < sample: reservoir[j] = item
+    return reservoir
+
+
+def iter_chunks(items, chunk_size):
+    # type: (Iterable[Any], int) -> Iterable[List[Any]]
+    """Groups a list or stream of items into lists of at most chunk_size items."""
+    chunk = [] # type: List[Any]
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk: yield chunk
 
 
 def check_output_directory(output_dir=None, force=True, **kwargs):